@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+"""Compares the cost of the key/value store codec with YAML
+
+Encodes and decodes the rank map of a 10k VM cluster and reports the
+time per operation and the payload size.
+
+Usage: PYTHONPATH=lib python benchmarks/bench_codec.py [num_vms]
+
+"""
+import sys
+import timeit
+import yaml
+
+from pcocc.Misc import encode_value, decode_value
+
+def bench(name, encode, decode, value, number):
+    data = encode(value)
+    assert decode(data) == value
+    enc = min(timeit.repeat(lambda: encode(value), number=number,
+                            repeat=3)) / number
+    dec = min(timeit.repeat(lambda: decode(data), number=number,
+                            repeat=3)) / number
+    print '{0:<8} encode {1:10.3f} ms  decode {2:10.3f} ms  ' \
+        'size {3:8d} bytes'.format(name, enc * 1000, dec * 1000, len(data))
+
+def main():
+    num_vms = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    # Slurm style rank map with 4 VMs per host
+    rank_map = [i // 4 for i in xrange(num_vms)]
+
+    print 'Rank map of {0} VMs'.format(num_vms)
+    bench('yaml', yaml.dump, yaml.safe_load, rank_map, 3)
+    bench('codec', encode_value, decode_value, rank_map, 50)
+
+if __name__ == '__main__':
+    main()
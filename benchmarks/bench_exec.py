@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Measures the throughput of the pcocc exec output path
+
+In local mode, data produced on a socket is forwarded to a pipe the
+way command outputs are, with the current output path and with the
+previous one (4 KB reads written through sys.stdout). In exec mode, a
+guest command printing the requested amount of data is run through
+pcocc exec with its output piped to /dev/null.
+
+Usage: PYTHONPATH=lib python benchmarks/bench_exec.py local [size_gb]
+       PYTHONPATH=lib python benchmarks/bench_exec.py exec [size_gb] \\
+           [pcocc exec options]
+
+"""
+import os
+import sys
+import time
+import socket
+import threading
+import subprocess
+
+from pcocc.Hypervisor import Qemu
+from pcocc.Misc import FdWriter
+
+GB = 1024 ** 3
+CHUNK = '\0' * (1024 * 1024)
+
+class Channel(object):
+    def __init__(self, sock):
+        self.stdout = sock.makefile('rb', 0)
+
+def produce(sock, size):
+    while size > 0:
+        sock.sendall(CHUNK[:size])
+        size -= len(CHUNK)
+    sock.close()
+
+def forward(size, output, step):
+    """Forwards size bytes from a socket, returns the elapsed time"""
+    ours, theirs = socket.socketpair()
+    producer = threading.Thread(target=produce, args=(ours, size))
+    producer.daemon = True
+
+    start = time.time()
+    producer.start()
+    channel = Channel(theirs)
+    while step(channel, output):
+        pass
+    elapsed = time.time() - start
+
+    producer.join()
+    theirs.close()
+    return elapsed
+
+def legacy_step(channel, output):
+    data = os.read(channel.stdout.fileno(), 4096)
+    if data:
+        output(data)
+    return len(data)
+
+def bench_local(size):
+    hyp = Qemu()
+    sink = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                            stdout=open(os.devnull, 'w'), close_fds=True)
+    stream = os.fdopen(os.dup(sink.stdin.fileno()), 'w')
+
+    for name, output, step in [
+        ('legacy', stream.write, legacy_step),
+        ('fd write', FdWriter(sink.stdin.fileno()).__call__,
+         hyp._forward_io),
+        ('splice', FdWriter(sink.stdin.fileno()), hyp._forward_io)]:
+        elapsed = forward(size, output, step)
+        stream.flush()
+        print '{0:<10} {1:8.2f} s {2:10.1f} MB/s'.format(
+            name, elapsed, size / elapsed / 1024 ** 2)
+
+    stream.close()
+    sink.stdin.close()
+    sink.wait()
+
+def bench_exec(size, options):
+    cmd = (['pcocc', 'exec'] + options +
+           ['head', '-c', str(size), '/dev/zero'])
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        exec_proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        sink = subprocess.Popen(['cat'], stdin=exec_proc.stdout,
+                                stdout=devnull)
+        exec_proc.stdout.close()
+        sink.wait()
+        ret = exec_proc.wait()
+        elapsed = time.time() - start
+
+    if ret:
+        sys.exit('pcocc exec failed with status {0}'.format(ret))
+    print 'pcocc exec {0:8.2f} s {1:10.1f} MB/s'.format(
+        elapsed, size / elapsed / 1024 ** 2)
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'local'
+    size = int(float(sys.argv[2]) * GB) if len(sys.argv) > 2 else 10 * GB
+
+    print 'Forwarding {0:.1f} GB of output'.format(size / float(GB))
+    if mode == 'local':
+        bench_local(size)
+    elif mode == 'exec':
+        bench_exec(size, sys.argv[3:])
+    else:
+        sys.exit(__doc__)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Measures IDAllocator allocation throughput
+
+Allocates and frees ids against an in-memory key/value store holding
+the ids of many running jobs, with the cached schema validators and
+with the legacy behaviour of parsing and validating schemas on each
+call.
+
+Usage: PYTHONPATH=lib python benchmarks/bench_idallocator.py [num_jobs]
+
+"""
+import sys
+import time
+import yaml
+import jsonschema
+
+import pcocc.Misc
+from pcocc.Config import Config
+from pcocc.Misc import IDAllocator
+
+class FakeBatch(object):
+    """Minimal in-memory batch manager for IDAllocator"""
+    def __init__(self, num_jobs):
+        self.kv = {}
+        self.batchid = num_jobs
+        self._jobs = range(num_jobs + 1)
+
+    def list_all_jobs(self, refresh=False):
+        return self._jobs
+
+    def atom_update_key(self, key_type, key, func, *args):
+        value, ret = func(*(args + (self.kv.get(key),)))
+        self.kv[key] = value
+        return ret
+
+def legacy_validate_schema(instance, schema, raw=None):
+    jsonschema.validate(instance, yaml.safe_load(schema))
+
+def run(batch, num_jobs, iterations):
+    ida = IDAllocator('bench/ids', num_jobs * 4 + 16)
+
+    # Fill the allocator with the ids of running jobs
+    for batchid in xrange(num_jobs):
+        batch.batchid = batchid
+        ida.alloc(4)
+
+    batch.batchid = num_jobs
+    start = time.time()
+    for _ in xrange(iterations):
+        ids = ida.alloc(4)
+        ida.free(ids)
+    return iterations / (time.time() - start)
+
+def main():
+    num_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 250
+    iterations = 50
+
+    config = Config()
+    config.batch = FakeBatch(num_jobs)
+    cached = run(config.batch, num_jobs, iterations)
+
+    pcocc.Misc.validate_schema = legacy_validate_schema
+    pcocc.Misc.mark_validated = lambda raw, schema: None
+    config.batch = FakeBatch(num_jobs)
+    legacy = run(config.batch, num_jobs, iterations)
+
+    print 'alloc+free cycles per second with {0} jobs ({1} ids):'.format(
+        num_jobs, num_jobs * 4)
+    print '  legacy validation  {0:10.1f}'.format(legacy)
+    print '  cached validators  {0:10.1f}'.format(cached)
+
+if __name__ == '__main__':
+    main()
@@ -60,12 +60,15 @@ titles = {
 'scp': 'Transfer files to a VM via scp',
 'ssh': 'Connect to a VM via ssh',
 'exec': 'Execute commands through the pcocc guest agent',
+'cp': 'Copy files to or from VMs through the pcocc guest agent',
 'display': 'Display the graphical output of a VM',
 'reset': 'Reset a VM',
 'ckpt': 'Checkpoint a virtual cluster',
+'consolidate': 'Merge a checkpoint with the checkpoints it is based on',
 'dump': 'Dump the memory of a VM to a file',
 'monitor-cmd': 'Send a command to the monitor',
 'save': 'Save the disk of a VM',
+'stats': 'Display statistics about a virtual cluster',
 'batch.yaml': 'Batch environment configuration file',
 'networks.yaml': 'Networks configuration file',
 'resources.yaml': 'Resource sets configuration file',
@@ -0,0 +1,532 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Persistent guest agent sessions and file transfers
+
+The process running a VM holds a session with each of its guest
+agents and serves it to clients through a proxy socket. Clients only
+have to synchronize with the proxy, which is immediate, instead of
+going through the agent channel handshake on each connection.
+
+Guest files are streamed through the agent in fixed-size chunks with
+several requests in flight.
+
+"""
+
+import os
+import base64
+import socket
+import logging
+import threading
+
+from collections import deque
+
+from .Error import PcoccError
+from .QMP import Connection, QGAClient, QMPError, QMPConnectionError
+from .Relay import target_opener
+
+# Pseudo command answered by the proxy with the reply to a command
+# whose client went away, such as an exec interrupted by a checkpoint
+REATTACH_COMMAND = 'pcocc-reattach'
+
+RECONNECT_MIN_INTERVAL = 0.01
+RECONNECT_MAX_INTERVAL = 5
+
+MAX_ORPHANS = 16
+
+# Size of file transfer chunks and number of chunk requests in flight
+FILE_CHUNK_SIZE = 1024 * 1024
+FILE_PIPELINE_DEPTH = 4
+
+class FileTransferError(PcoccError):
+    """Exception raised when the agent fails to transfer a file"""
+    def __init__(self, path, error):
+        super(FileTransferError, self).__init__(
+            'Unable to transfer guest file {0}: {1}'.format(path, error))
+
+def _error_response(err):
+    return {'error': {'class': err.error_class or 'GenericError',
+                      'desc': str(err)}}
+
+def _response(reply):
+    try:
+        return {'return': reply.result()}
+    except QMPError as err:
+        return _error_response(err)
+
+class AgentSession(object):
+    """Long-lived connection to a guest agent socket
+
+    path is the UNIX socket of a virtio-serial port or a vsock target.
+
+    Commands are queued until the session is synchronized with the
+    agent. When the connection is lost, the session reconnects and
+    resynchronizes with an exponential backoff.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.on_disconnect = lambda: None
+        self._lock = threading.Lock()
+        self._agent = None
+        self._queue = []
+        self._orphans = deque(maxlen=MAX_ORPHANS)
+        self._orphan_waiters = deque()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def synced(self):
+        return self._agent is not None
+
+    def start(self):
+        self._thread = threading.Thread(None, self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            agent = self._agent
+        if agent:
+            agent.close()
+
+    def _connect(self):
+        sock = target_opener(self.path)
+        return QGAClient(sock, orphan_handler=self.add_orphan)
+
+    def _run(self):
+        interval = RECONNECT_MIN_INTERVAL
+        while not self._stop.is_set():
+            try:
+                agent = self._connect()
+            except socket.error:
+                self._stop.wait(interval)
+                interval = min(interval * 2, RECONNECT_MAX_INTERVAL)
+                continue
+
+            closed = agent.subscribe([])
+            try:
+                agent.sync()
+            except QMPConnectionError:
+                agent.close()
+                self._stop.wait(interval)
+                interval = min(interval * 2, RECONNECT_MAX_INTERVAL)
+                continue
+
+            logging.debug('Agent session on %s synchronized', self.path)
+            interval = RECONNECT_MIN_INTERVAL
+            with self._lock:
+                self._agent = agent
+                queue, self._queue = self._queue, []
+
+            for command, arguments, callback in queue:
+                self._send(agent, command, arguments, callback)
+
+            # None is received when the connection is closed
+            closed.get()
+            agent.close()
+
+            with self._lock:
+                self._agent = None
+            logging.debug('Agent session on %s lost', self.path)
+            self.on_disconnect()
+
+    def _send(self, agent, command, arguments, callback):
+        try:
+            reply = agent.execute_async(command, arguments)
+        except QMPError as err:
+            callback(_error_response(err))
+            return
+        reply.add_callback(lambda r: callback(_response(r)))
+
+    def execute(self, command, arguments, callback):
+        """Sends a command and calls callback with the response"""
+        with self._lock:
+            agent = self._agent
+            if agent is None:
+                self._queue.append((command, arguments, callback))
+                return
+        self._send(agent, command, arguments, callback)
+
+    def add_orphan(self, msg):
+        """Keeps a reply which has no client to be reattached"""
+        response = dict((k, v) for k, v in msg.iteritems()
+                        if k in ('return', 'error'))
+        with self._lock:
+            if not self._orphan_waiters:
+                self._orphans.append(response)
+                return
+            callback = self._orphan_waiters.popleft()
+        callback(response)
+
+    def wait_orphan(self, callback):
+        """Calls callback with the next reply which has no client"""
+        with self._lock:
+            if not self._orphans:
+                self._orphan_waiters.append(callback)
+                return
+            response = self._orphans.popleft()
+        callback(response)
+
+class _ProxyClient(Connection):
+    """Connection of a client to an agent proxy"""
+    reset_byte = '\xff'
+
+    def __init__(self, proxy, sock):
+        self._proxy = proxy
+        super(_ProxyClient, self).__init__(sock)
+
+    def _dispatch(self, msg):
+        if 'execute' not in msg:
+            return
+
+        if msg['execute'] in ('guest-sync', 'guest-sync-delimited'):
+            self._sync(msg)
+            return
+
+        def respond(response):
+            if 'id' in msg:
+                reply = dict(response, id=msg['id'])
+            else:
+                reply = response
+
+            with self._lock:
+                if not self.closed:
+                    try:
+                        self._send(reply)
+                        return
+                    except QMPConnectionError:
+                        pass
+
+            # Keep exec results for a client reattaching later
+            if msg['execute'] in ('guest-cmd-exec', REATTACH_COMMAND):
+                self._proxy.session.add_orphan(response)
+
+        if msg['execute'] == REATTACH_COMMAND:
+            self._proxy.session.wait_orphan(respond)
+        else:
+            self._proxy.session.execute(msg['execute'],
+                                        msg.get('arguments'),
+                                        respond)
+
+    def _sync(self, msg):
+        """Answers a sync request of the client
+
+        Syncs only flush the client connection, the session is
+        synchronized with the agent on its own, so the id is echoed
+        back without involving the agent.
+
+        """
+        reply = {'return': (msg.get('arguments') or {}).get('id')}
+        if 'id' in msg:
+            reply['id'] = msg['id']
+        prefix = ''
+        if msg['execute'] == 'guest-sync-delimited':
+            prefix = self.reset_byte
+
+        with self._lock:
+            if not self.closed:
+                try:
+                    self._send(reply, prefix)
+                except QMPConnectionError:
+                    pass
+
+    def _handle_close(self):
+        super(_ProxyClient, self)._handle_close()
+        self._proxy.remove_client(self)
+
+class AgentProxy(object):
+    """Serves an agent session to clients on a UNIX socket
+
+    Clients use the guest agent protocol. Their requests are
+    forwarded through the session and replies are sent back with the
+    client request ids. Sync requests are answered by the proxy.
+
+    """
+    def __init__(self, session, path):
+        self.session = session
+        self.path = path
+        self._lock = threading.Lock()
+        self._clients = set()
+        self._server = None
+        session.on_disconnect = self._disconnect_clients
+
+    def start(self):
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen(128)
+        self.session.start()
+
+        thread = threading.Thread(None, self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.session.stop()
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._server.close()
+        self._disconnect_clients()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except socket.error:
+                return
+
+            # The client starts being served as soon as it is created:
+            # it must be known by _disconnect_clients by then
+            with self._lock:
+                self._clients.add(_ProxyClient(self, sock))
+
+    def remove_client(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def _disconnect_clients(self):
+        # Clients see the connection closed as if the agent socket was
+        # closed by Qemu
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.close()
+
+class GuestFileWriter(object):
+    """File-like object writing a guest file through an agent
+
+    Data is sent in FILE_CHUNK_SIZE chunks without waiting for the
+    previous chunks to be written, up to FILE_PIPELINE_DEPTH chunks.
+    progress is called with the number of bytes written after each
+    chunk.
+
+    """
+    def __init__(self, agent, path, mode='w', progress=None):
+        self.path = path
+        self.written = 0
+        self._agent = agent
+        self.progress = progress
+        self._pending = []
+        self._pending_size = 0
+        self._inflight = deque()
+        self._handle = self._execute('guest-file-open', {'path': path,
+                                                         'mode': mode})
+
+    def _execute(self, command, arguments):
+        try:
+            return self._agent.execute(command, arguments)
+        except QMPError as err:
+            raise FileTransferError(self.path, str(err))
+
+    def write(self, data):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= FILE_CHUNK_SIZE:
+            try:
+                self._flush(FILE_CHUNK_SIZE)
+            except FileTransferError:
+                self.abort()
+                raise
+
+    def _flush(self, min_size):
+        data = ''.join(self._pending)
+        offset = 0
+        while len(data) - offset >= min_size and len(data) > offset:
+            self._send(data[offset:offset + FILE_CHUNK_SIZE])
+            offset += FILE_CHUNK_SIZE
+        self._pending = [data[offset:]]
+        self._pending_size = len(self._pending[0])
+
+    def _send(self, chunk):
+        while len(self._inflight) >= FILE_PIPELINE_DEPTH:
+            self._complete()
+
+        try:
+            reply = self._agent.execute_async(
+                'guest-file-write', {'handle': self._handle,
+                                     'buf-b64': base64.b64encode(chunk)})
+        except QMPError as err:
+            raise FileTransferError(self.path, str(err))
+        self._inflight.append((reply, len(chunk)))
+
+    def _complete(self):
+        reply, size = self._inflight.popleft()
+        try:
+            count = reply.result()['count']
+        except QMPError as err:
+            raise FileTransferError(self.path, str(err))
+
+        if count != size:
+            raise FileTransferError(self.path,
+                                    'wrote only {0} out of {1} bytes'.format(
+                                        count, size))
+        self.written += size
+        if self.progress:
+            self.progress(self.written)
+
+    def close(self):
+        """Writes the remaining data and closes the guest file"""
+        try:
+            self._flush(1)
+            while self._inflight:
+                self._complete()
+        except FileTransferError:
+            self.abort()
+            raise
+        self._execute('guest-file-close', {'handle': self._handle})
+
+    def abort(self):
+        """Closes the guest file without writing the remaining data"""
+        if self._handle is None:
+            return
+        self._pending = []
+        self._pending_size = 0
+        _close_guest_file(self._agent, self._handle, self._inflight)
+        self._handle = None
+
+class GuestFileReader(object):
+    """File-like object reading a guest file through an agent
+
+    Chunks are requested ahead of reads, up to FILE_PIPELINE_DEPTH
+    chunks. progress is called with the number of bytes received after
+    each chunk.
+
+    """
+    def __init__(self, agent, path, progress=None):
+        self.path = path
+        self.received = 0
+        self._agent = agent
+        self.progress = progress
+        self._chunks = deque()
+        self._offset = 0
+        self._inflight = deque()
+        self._eof = False
+        self._handle = self._execute('guest-file-open', {'path': path,
+                                                         'mode': 'r'})
+
+    def _execute(self, command, arguments):
+        try:
+            return self._agent.execute(command, arguments)
+        except QMPError as err:
+            raise FileTransferError(self.path, str(err))
+
+    def size(self):
+        """Returns the size of the guest file, before reading from it"""
+        size = self._execute('guest-file-seek', {'handle': self._handle,
+                                                 'offset': 0,
+                                                 'whence': 2})['position']
+        self._execute('guest-file-seek', {'handle': self._handle,
+                                          'offset': 0,
+                                          'whence': 0})
+        return size
+
+    def _request(self):
+        while not self._eof and len(self._inflight) < FILE_PIPELINE_DEPTH:
+            try:
+                self._inflight.append(self._agent.execute_async(
+                        'guest-file-read', {'handle': self._handle,
+                                            'count': FILE_CHUNK_SIZE}))
+            except QMPError as err:
+                raise FileTransferError(self.path, str(err))
+
+    def _receive(self):
+        try:
+            ret = self._inflight.popleft().result()
+        except QMPError as err:
+            raise FileTransferError(self.path, str(err))
+
+        data = base64.b64decode(ret.get('buf-b64', ''))
+        if ret.get('eof') or not data:
+            self._eof = True
+        if data:
+            self._chunks.append(data)
+            self.received += len(data)
+            if self.progress:
+                self.progress(self.received)
+        self._request()
+
+    def read(self, size=-1):
+        parts = []
+        while size:
+            if not self._chunks:
+                if self._eof:
+                    break
+                try:
+                    self._request()
+                    self._receive()
+                except FileTransferError:
+                    self.abort()
+                    raise
+                continue
+
+            chunk = self._chunks[0]
+            if size < 0 or len(chunk) - self._offset <= size:
+                part = chunk[self._offset:]
+                self._chunks.popleft()
+                self._offset = 0
+            else:
+                part = chunk[self._offset:self._offset + size]
+                self._offset += size
+
+            parts.append(part)
+            if size > 0:
+                size -= len(part)
+
+        return ''.join(parts)
+
+    def close(self):
+        """Closes the guest file"""
+        # Wait for reads in flight, which may follow an EOF
+        while self._inflight:
+            try:
+                self._inflight.popleft().result()
+            except QMPError:
+                pass
+        self._execute('guest-file-close', {'handle': self._handle})
+
+    def abort(self):
+        """Closes the guest file after a failed transfer"""
+        if self._handle is None:
+            return
+        self._eof = True
+        self._chunks.clear()
+        _close_guest_file(self._agent, self._handle, self._inflight)
+        self._handle = None
+
+def _close_guest_file(agent, handle, inflight):
+    """Closes a guest file once its pending requests are done
+
+    Errors are ignored as the transfer has already failed.
+
+    """
+    while inflight:
+        try:
+            inflight.popleft().result()
+        except QMPError:
+            pass
+    try:
+        agent.execute('guest-file-close', {'handle': handle})
+    except QMPError:
+        pass
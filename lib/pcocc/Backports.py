@@ -17,6 +17,9 @@
 #  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
 
 """Some useful functions from future Python"""
+import os
+import time
+import ctypes
 import subprocess
 
 def subprocess_check_output(*popenargs, **kwargs):
@@ -303,3 +306,29 @@ class OrderedDict(dict):
 def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), **named)
     return type('Enum', (), enums)
+
+
+CLOCK_MONOTONIC = 1
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+def _libc_monotonic():
+    libc = ctypes.CDLL(None, use_errno=True)
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+        t = _Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)):
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    return monotonic
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = _libc_monotonic()
@@ -31,23 +31,28 @@ import logging
 import jsonschema
 import etcd
 import etcd.auth
+import urllib
 import atexit
 import binascii
 import stat
 import psutil
 import signal
 import argparse
+import bisect
 import uuid
 import threading
+import time
+import tempfile
 
 from ClusterShell.NodeSet  import NodeSet, NodeSetException
 from ClusterShell.NodeSet  import RangeSet
 
 from .Config import Config
-from .Backports import subprocess_check_output
+from .Backports import subprocess_check_output, OrderedDict
 from .Error import PcoccError, InvalidConfigurationError
 from .Misc import fake_signalfd, wait_or_term_child
 from .Misc import CHILD_EXIT, datetime_to_epoch, stop_threads
+from .Misc import encode_value, decode_value, validate_schema
 from abc import ABCMeta, abstractmethod
 
 class BatchError(PcoccError):
@@ -119,6 +124,20 @@ properties:
           - password
           - munge
           - none
+      etcd-api:
+        enum:
+          - v2
+          - v3
+      etcd-cache-size:
+        type: integer
+        minimum: 0
+      etcd-cache-ttl:
+        type: object
+        additionalProperties:
+          type: number
+      slurm-cache-ttl:
+        type: number
+        minimum: 0
     additionalProperties: false
     required:
       - etcd-servers
@@ -146,6 +165,15 @@ class ProcessType(object):
 
 ETCD_PASSWORD_BYTES = 16
 
+# Default expiry in seconds of cached keystore reads by path prefix. Keys
+# of the current job are kept coherent by a watch so they can live
+# longer than global keys which are only refreshed when they expire.
+DEFAULT_CACHE_TTL = {'/pcocc/cluster': 60,
+                     '/pcocc/global': 2}
+
+# Default expiry in seconds of the Slurm job list snapshot
+DEFAULT_SLURM_CACHE_TTL = 5
+
 
 class BatchManager(object):
     __metaclass__ = ABCMeta
@@ -162,8 +190,7 @@ class BatchManager(object):
             raise InvalidConfigurationError(str(err))
 
         try:
-            jsonschema.validate(batch_config,
-                                yaml.safe_load(batch_config_schema))
+            validate_schema(batch_config, batch_config_schema)
         except jsonschema.exceptions.ValidationError as err:
             raise InvalidConfigurationError(str(err))
 
@@ -192,6 +219,7 @@ class BatchManager(object):
         self.nodeset = None
         self.node_rank = None
         self.cluster_state_dir = None
+        self.node_state_dir = None
         self.vm_state_dir_prefix = None
         self.pcocc_state_dir = None
 
@@ -253,11 +281,7 @@ class BatchManager(object):
         """
         self._only_in_a_job()
         # Assume we've been bound to our cores by the batch manager
-        taskset = subprocess_check_output(['hwloc-bind', '--get']).strip()
-        coreset = subprocess_check_output(['hwloc-calc', '--intersect', 'Core',
-                                           taskset]).strip()
-
-        return RangeSet(coreset)
+        return Config().topology.process_coreset()
 
     @property
     def num_cores(self):
@@ -321,6 +345,214 @@ def _retry_on_cred_expiry(func):
     return _wrapped_func
 
 
+def _paths_overlap(path1, path2):
+    """Checks if a path is equal to, contains or is below another"""
+    path1 = path1.rstrip('/')
+    path2 = path2.rstrip('/')
+    return (path1 == path2 or
+            path1.startswith(path2 + '/') or
+            path2.startswith(path1 + '/'))
+
+class KeyCache(object):
+    """Size bounded cache of keystore reads
+
+    Entries expire after a delay which depends on the longest matching
+    path prefix and the least recently used entries are evicted first
+    when the cache is full.
+
+    A change may be notified between the read of a value and its
+    insertion in the cache. The modification index of the last
+    invalidation of each path is kept so that such stale values are
+    not cached.
+
+    """
+    def __init__(self, max_entries, ttls):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._invalidations = OrderedDict()
+        # Values read before this index may have missed an invalidation
+        # which is no longer recorded
+        self._min_index = 0
+        self._lock = threading.Lock()
+        self._ttls = sorted(ttls.iteritems(),
+                            key=lambda x: len(x[0]), reverse=True)
+
+    def get(self, kind, path):
+        """Returns the cached value or None if absent or expired"""
+        with self._lock:
+            try:
+                expiry, value = self._entries.pop((kind, path))
+            except KeyError:
+                return None
+
+            if expiry < time.time():
+                return None
+
+            # Reinsert as most recently used
+            self._entries[(kind, path)] = (expiry, value)
+            return value
+
+    def put(self, kind, path, value, index=None):
+        """Caches a value if its path has a positive ttl
+
+        index is the keystore index at which the value was read. The
+        value is not cached if path was invalidated by a later change.
+
+        """
+        ttl = self.ttl(path)
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            if index is not None and self._invalidated_after(path, index):
+                return
+
+            self._entries.pop((kind, path), None)
+            while len(self._entries) >= self._max_entries:
+                self._entries.popitem(last=False)
+            self._entries[(kind, path)] = (time.time() + ttl, value)
+
+    def invalidate(self, path, index=None):
+        """Drops entries which may be affected by a change to path
+
+        This includes the path itself, all directories containing it
+        and everything below it. index is the modification index of
+        the change, if known.
+
+        """
+        path = path.rstrip('/')
+        with self._lock:
+            for entry in self._entries.keys():
+                if _paths_overlap(entry[1], path):
+                    del self._entries[entry]
+
+            if index is None:
+                return
+
+            index = max(index, self._invalidations.pop(path, 0))
+            while len(self._invalidations) >= self._max_entries:
+                _, old_index = self._invalidations.popitem(last=False)
+                self._min_index = max(self._min_index, old_index)
+            self._invalidations[path] = index
+
+    def _invalidated_after(self, path, index):
+        if index < self._min_index:
+            return True
+        return any(inval_index > index and _paths_overlap(inval_path, path)
+                   for inval_path, inval_index
+                   in self._invalidations.iteritems())
+
+    def ttl(self, path):
+        for prefix, ttl in self._ttls:
+            if path.startswith(prefix):
+                return ttl
+        return 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DirWatcher(object):
+    """Incrementally maintained copy of a keystore directory
+
+    The directory is read once, then each watch event is applied as a
+    delta to the in-memory copy. The directory is only read again if
+    the watch index falls out of the keystore event history.
+
+    """
+    def __init__(self, manager, key_path):
+        self._manager = manager
+        self.key_path = key_path.rstrip('/')
+        self.children = {}
+        self.index = None
+
+    def _try_renew_credential(self, e):
+        self._manager._try_renew_credential(e)
+
+    def _relative(self, key):
+        return key.rstrip('/')[len(self.key_path) + 1:]
+
+    @_retry_on_cred_expiry
+    def sync(self):
+        """Reads the whole directory
+
+        Returns the list of (name, old value, new value) changes
+        from the previous copy.
+
+        """
+        children = {}
+        try:
+            ret = self._manager.keyval_client.read(self.key_path,
+                                                   recursive=True)
+            for child in ret.children:
+                if not child.dir and child.key.rstrip('/') != self.key_path:
+                    children[self._relative(child.key)] = child.value
+            self.index = max(ret.modifiedIndex, ret.etcd_index)
+        except etcd.EtcdKeyNotFound as e:
+            self.index = e.payload['index']
+
+        changes = [(name, value, children.get(name))
+                   for name, value in self.children.iteritems()
+                   if children.get(name) != value]
+        changes += [(name, None, value)
+                    for name, value in children.iteritems()
+                    if name not in self.children]
+        self.children = children
+
+        return changes
+
+    def apply(self, ret):
+        """Applies a watch event and returns the resulting changes"""
+        changes = []
+        self.index = ret.modifiedIndex
+        key = ret.key.rstrip('/')
+
+        if ret.action in ('delete', 'expire', 'compareAndDelete'):
+            # Deleting a directory removes everything below it
+            if key == self.key_path:
+                prefix = ''
+            else:
+                prefix = self._relative(key) + '/'
+
+            for name in self.children.keys():
+                if name.startswith(prefix) or name + '/' == prefix:
+                    changes.append((name, self.children.pop(name), None))
+        elif not ret.dir and key != self.key_path:
+            name = self._relative(key)
+            old_value = self.children.get(name)
+            if old_value != ret.value:
+                self.children[name] = ret.value
+                changes.append((name, old_value, ret.value))
+
+        return changes
+
+    @_retry_on_cred_expiry
+    def wait(self, timeout=0):
+        """Waits for the next change in the directory
+
+        Returns the list of (name, old value, new value) changes, which
+        may be empty. Raises KeyTimeoutError if nothing happens before
+        the timeout.
+
+        """
+        try:
+            ret = self._manager.keyval_client.watch(self.key_path,
+                                                    recursive=True,
+                                                    index=self.index + 1,
+                                                    timeout=timeout)
+        except etcd.EtcdWatchTimedOut:
+            logging.info("Timeout while waiting for key " + self.key_path)
+            raise KeyTimeoutError(self.key_path)
+        except etcd.EtcdEventIndexCleared:
+            logging.debug('Missed events on %s, reading it again',
+                          self.key_path)
+            return self.sync()
+
+        # Do not wait for the cache watcher to notice the change
+        self._manager._cache_invalidate(ret.key, ret.modifiedIndex)
+        return self.apply(ret)
+
+
 class EtcdManager(BatchManager):
     """Common class for batch managers based on etcd"""
     def __init__(self, batchid, batchname, default_batchname, settings,
@@ -336,9 +568,23 @@ class EtcdManager(BatchManager):
         self._etcd_client_port = settings['etcd-client-port']
         self._etcd_protocol = settings['etcd-protocol']
         self._etcd_auth_type = settings['etcd-auth-type']
+        self._etcd_api = settings.get('etcd-api', 'v2')
         if self._etcd_auth_type == 'password':
             self._etcd_password = None
 
+        # Keys to be written along with the next call to write_keys
+        self._deferred_writes = []
+
+        # Optional read cache, disabled unless a size is configured
+        cache_ttls = dict(DEFAULT_CACHE_TTL)
+        cache_ttls.update(settings.get('etcd-cache-ttl', {}))
+        cache_size = settings.get('etcd-cache-size', 0)
+        if cache_size > 0:
+            self._cache = KeyCache(cache_size, cache_ttls)
+        else:
+            self._cache = None
+        self._cache_watchers = {}
+
     def _init_vm_dir(self):
         self._only_in_a_job()
         try:
@@ -368,6 +614,64 @@ class EtcdManager(BatchManager):
         """ Return path to store cluster state file """
         return os.path.join(self.cluster_state_dir, name)
 
+    def get_node_state_path(self, name):
+        """ Return path to store state shared by the VMs of a node """
+        self._only_in_a_job()
+        try:
+            os.mkdir(self.node_state_dir, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise PcoccError('Failed to create node state '
+                                 'directory: ' + str(e))
+
+        # The directory is in /tmp: make sure it wasn't created by
+        # someone else
+        st = os.lstat(self.node_state_dir)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            raise PcoccError('Node state directory {0} is not owned by '
+                             'the current user'.format(self.node_state_dir))
+
+        return os.path.join(self.node_state_dir, name)
+
+    def clean_node_state_dir(self):
+        """ Remove state shared by the VMs of a node
+
+        This is called as root on a directory of /tmp created by the
+        job owner. It is only removed if it is a private directory of
+        the job owner, with the privileges of the owner, so that
+        symlinks planted in the directory cannot be used to remove
+        other files.
+
+        """
+        self._only_in_a_job()
+        try:
+            st = os.lstat(self.node_state_dir)
+        except OSError:
+            return
+
+        owner = pwd.getpwnam(self.batchuser)
+        if (not stat.S_ISDIR(st.st_mode) or st.st_uid != owner.pw_uid or
+            st.st_mode & 0o077):
+            logging.warning('Not removing node state directory %s which '
+                            'is not a private directory of %s',
+                            self.node_state_dir, self.batchuser)
+            return
+
+        if os.getuid() == owner.pw_uid:
+            shutil.rmtree(self.node_state_dir, ignore_errors=True)
+            return
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.initgroups(self.batchuser, owner.pw_gid)
+                os.setgid(owner.pw_gid)
+                os.setuid(owner.pw_uid)
+                shutil.rmtree(self.node_state_dir, ignore_errors=True)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
     def _get_vm_state_dir(self, rank):
         return '%s_%d' % (self.vm_state_dir_prefix, rank)
 
@@ -379,6 +683,71 @@ class EtcdManager(BatchManager):
         if not self._in_a_job:
             raise NoJobError()
 
+    def _cache_get(self, kind, key_type, key_path):
+        if self._cache is None:
+            return None
+
+        # Keys of the current job are watched to be notified of changes
+        if (key_type in ['cluster', 'cluster/user'] and
+            key_type not in self._cache_watchers):
+            # Start watching before anything is cached so that no
+            # update can be missed
+            watch_path = self.get_key_path(key_type, '')
+            watcher = threading.Thread(None, self._cache_watch_thread,
+                                       args=[watch_path,
+                                             self._watch_index(watch_path)])
+            watcher.daemon = True
+            self._cache_watchers[key_type] = watcher
+            watcher.start()
+
+        return self._cache.get(kind, key_path)
+
+    def _cache_put(self, kind, key_path, value, index):
+        if self._cache is not None:
+            self._cache.put(kind, key_path, value, index)
+
+    def _cache_invalidate(self, key_path, index=None):
+        if self._cache is not None:
+            self._cache.invalidate(key_path, index)
+
+    @_retry_on_cred_expiry
+    def _watch_index(self, key_path):
+        try:
+            return self.keyval_client.read(key_path).etcd_index
+        except etcd.EtcdKeyNotFound as e:
+            return e.payload['index']
+
+    def _cache_watch_thread(self, key_path, index):
+        """Invalidates cached keys below key_path as they are modified"""
+        while not stop_threads.is_set():
+            try:
+                if index is None:
+                    # We may have missed events, start again from scratch
+                    index = self._watch_index(key_path)
+                    self._cache.invalidate(key_path, index)
+
+                for ret in self.keyval_client.eternal_watch(key_path,
+                                                            index=index + 1,
+                                                            recursive=True):
+                    self._cache.invalidate(ret.key, ret.modifiedIndex)
+                    index = ret.modifiedIndex
+                    if stop_threads.is_set():
+                        return
+            except etcd.EtcdEventIndexCleared:
+                logging.debug('Cache watcher lost track of %s', key_path)
+                index = None
+            except Exception as e:
+                # Cached values cannot be trusted while we are not
+                # watching
+                logging.debug('Cache watcher error on %s: %s',
+                              key_path, e)
+                self._cache.invalidate(key_path)
+                index = None
+                try:
+                    self._try_renew_credential(e)
+                except Exception:
+                    stop_threads.wait(1)
+
     def read_key(self, key_type, key, blocking=False, timeout=0):
         """Reads a key from keystore
 
@@ -408,6 +777,11 @@ class EtcdManager(BatchManager):
 
         """
         key_path = self.get_key_path(key_type, key)
+        if not realindex:
+            cached = self._cache_get('key', key_type, key_path)
+            if cached:
+                return cached
+
         try:
             ret = self.keyval_client.read(key_path)
         except etcd.EtcdKeyNotFound as e:
@@ -416,6 +790,10 @@ class EtcdManager(BatchManager):
         if realindex:
             return ret.value, ret.modifiedIndex
         else:
+            self._cache_put('key', key_path, (ret.value,
+                                              max(ret.modifiedIndex,
+                                                  ret.etcd_index)),
+                            ret.etcd_index)
             return ret.value, max(ret.modifiedIndex,
                                   ret.etcd_index)
 
@@ -430,6 +808,26 @@ class EtcdManager(BatchManager):
         val, _ = self.read_dir_index(key_type, key)
         return val
 
+    def read_dir_values(self, key_type, key):
+        """Returns the values of the keys of a keystore directory
+
+        The values are returned in a dictionnary indexed by key name
+        relative to the directory.
+
+        """
+        path = self.get_key_path(key_type, key)
+        d = self.read_dir(key_type, key)
+        if d is None:
+            return {}
+
+        values = {}
+        for child in d.children:
+            if child.dir or child.key.rstrip('/') == path:
+                continue
+            values[child.key[len(path):].lstrip('/')] = child.value
+
+        return values
+
     @_retry_on_cred_expiry
     def read_dir_index(self, key_type, key):
         """Reads a directory from keystore
@@ -440,11 +838,18 @@ class EtcdManager(BatchManager):
 
         """
         key_path = self.get_key_path(key_type, key)
+        cached = self._cache_get('dir', key_type, key_path)
+        if cached:
+            return cached
+
         try:
             val = self.keyval_client.read(key_path, recurse = True)
         except etcd.EtcdKeyNotFound as e:
             return None, e.payload['index']
 
+        self._cache_put('dir', key_path, (val, max(val.modifiedIndex,
+                                                   val.etcd_index)),
+                        val.etcd_index)
         return val, max(val.modifiedIndex,
                               val.etcd_index)
 
@@ -452,18 +857,21 @@ class EtcdManager(BatchManager):
     def write_ttl(self, key_type, key, value, ttl):
         """Write a single key with a ttl"""
         key_path = self.get_key_path(key_type, key)
+        self._cache_invalidate(key_path)
         self.keyval_client.write(key_path, value, ttl=ttl)
 
     @_retry_on_cred_expiry
     def write_key(self, key_type, key, value):
         """Write a single key"""
         key_path = self.get_key_path(key_type, key)
+        self._cache_invalidate(key_path)
         return self.keyval_client.write(key_path, value)
 
     @_retry_on_cred_expiry
     def write_key_index(self, key_type, key, value, index):
         """Write a single key using compare and swap on the index"""
         key_path = self.get_key_path(key_type, key)
+        self._cache_invalidate(key_path)
         return self.keyval_client.write(key_path, value,
                                         prevIndex=index)
 
@@ -471,9 +879,42 @@ class EtcdManager(BatchManager):
     def write_key_new(self, key_type, key, value):
         """Write a single key if it didnt exist"""
         key_path = self.get_key_path(key_type, key)
+        self._cache_invalidate(key_path)
         return self.keyval_client.write(key_path, value,
                                         prevExist=False)
 
+    def defer_write_key(self, key_type, key, value):
+        """Queue a key to be written with the next call to write_keys"""
+        self._deferred_writes.append((self.get_key_path(key_type, key), value))
+
+    def flush_deferred_writes(self):
+        """Write the keys queued by defer_write_key, if any"""
+        if self._deferred_writes:
+            self.write_keys([])
+
+    @_retry_on_cred_expiry
+    def write_keys(self, keys):
+        """Write several keys along with all deferred keys
+
+        keys is a list of (key_type, key, value) tuples. With the v3
+        API, all keys are written in a single transaction.
+
+        """
+        items = self._deferred_writes + [
+            (self.get_key_path(key_type, key), value)
+            for key_type, key, value in keys]
+
+        for key_path, _ in items:
+            self._cache_invalidate(key_path)
+
+        if self._etcd_api == 'v3':
+            self.keyval_client.write_many(items)
+        else:
+            for key_path, value in items:
+                self.keyval_client.write(key_path, value)
+
+        self._deferred_writes = []
+
     @_retry_on_cred_expiry
     def atom_update_key(self, key_type, key, func, *args, **kwargs):
         """Wrap a function to atomically update a key
@@ -515,6 +956,7 @@ class EtcdManager(BatchManager):
     def make_dir(self, key_type, key):
         """Create a directory"""
         key_path = self.get_key_path(key_type, key)
+        self._cache_invalidate(key_path)
         self.keyval_client.write(key_path, False, dir = True)
 
     @_retry_on_cred_expiry
@@ -524,6 +966,7 @@ class EtcdManager(BatchManager):
         This fails for directories
         """
         key_path = self.get_key_path(key_type, key)
+        self._cache_invalidate(key_path)
         self.keyval_client.delete(key_path, recursive = False, dir = False)
 
     @_retry_on_cred_expiry
@@ -533,6 +976,7 @@ class EtcdManager(BatchManager):
         Also succeeds for keys
         """
         key_path = self.get_key_path(key_type, key)
+        self._cache_invalidate(key_path)
         try:
             self.keyval_client.delete(key_path, recursive = True, dir = True)
         except etcd.EtcdNotDir:
@@ -547,6 +991,9 @@ class EtcdManager(BatchManager):
             try:
                 ret = self.keyval_client.watch(key_path, recursive = True,
                                          index = index + 1, timeout = timeout)
+                # Do not wait for the cache watcher to notice the
+                # change the caller is about to read
+                self._cache_invalidate(ret.key, ret.modifiedIndex)
                 return ret, max(ret.modifiedIndex,
                               ret.etcd_index)
             except etcd.EtcdWatchTimedOut:
@@ -557,20 +1004,24 @@ class EtcdManager(BatchManager):
             except etcd.EtcdClusterIdChanged:
                 return None, e.payload['index']
 
-    @_retry_on_cred_expiry
+    def watch_dir(self, key_type, key):
+        """Returns a DirWatcher initialized with a directory content"""
+        watcher = DirWatcher(self, self.get_key_path(key_type, key))
+        watcher.sync()
+        return watcher
+
     def wait_child_count(self, key_type, key, count):
-        """Wait until a directory has the specified number of elements"""
-        while True:
-            ret, last_index  = self.read_dir_index(key_type, key)
-            if ret:
-                num_complete = len([child for child in ret.children])
-            else:
-                num_complete = 0
+        """Wait until a directory has the specified number of elements
 
-            if num_complete == count:
-                return ret
+        Returns a dict of the directory keys and values, indexed by
+        their path relative to the directory
 
-            self.wait_key_index(key_type, key, last_index, timeout=30)
+        """
+        watcher = self.watch_dir(key_type, key)
+        while len(watcher.children) != count:
+            watcher.wait(timeout=30)
+
+        return watcher.children
 
 
     def get_key_path(self, key_type, key):
@@ -608,14 +1059,29 @@ class EtcdManager(BatchManager):
             random.shuffle(hosts_tuple)
             hosts_tuple = tuple(hosts_tuple)
             logging.debug('Starting etcd client')
-            self._keyval_client = etcd.Client(
-                host=hosts_tuple,
-                ca_cert=self._etcd_ca_cert,
-                protocol=self._etcd_protocol,
-                allow_reconnect=True,
-                read_timeout=10,
-                username=self._get_keyval_username(),
-                password=self._get_keyval_credential())
+            if self._etcd_api == 'v3':
+                try:
+                    from .EtcdV3 import EtcdV3Client
+                except ImportError as e:
+                    raise InvalidConfigurationError(
+                        'etcd v3 API requires the etcd3 module: ' + str(e))
+
+                self._keyval_client = EtcdV3Client(
+                    hosts_tuple,
+                    ca_cert=self._etcd_ca_cert,
+                    protocol=self._etcd_protocol,
+                    read_timeout=10,
+                    username=self._get_keyval_username(),
+                    password=self._get_keyval_credential())
+            else:
+                self._keyval_client = etcd.Client(
+                    host=hosts_tuple,
+                    ca_cert=self._etcd_ca_cert,
+                    protocol=self._etcd_protocol,
+                    allow_reconnect=True,
+                    read_timeout=10,
+                    username=self._get_keyval_username(),
+                    password=self._get_keyval_credential())
 
             logging.info('Started etcd client')
             self._last_cred_renew = datetime.datetime.now()
@@ -723,6 +1189,10 @@ class EtcdManager(BatchManager):
     def init_cluster_keys(self):
         if self._etcd_auth_type != 'none':
             role = '{0}-pcocc'.format(self.batchuser)
+            if self._etcd_api == 'v3':
+                self._init_cluster_keys_v3(role)
+                return
+
             logging.info('Initializing etcd role %s', role)
             u = etcd.auth.EtcdRole(self.keyval_client, role)
             u.grant('/pcocc/cluster/*', 'R')
@@ -750,9 +1220,27 @@ class EtcdManager(BatchManager):
 
             self.make_dir('cluster/user', '')
 
+    def _init_cluster_keys_v3(self, role):
+        logging.info('Initializing etcd role %s and user %s', role,
+                     self.batchuser)
+        password = None
+        if self._etcd_auth_type == 'password':
+            requested_cred = os.environ.get('SPANK_PCOCC_REQUEST_CRED', '')
+            if len(requested_cred) == 2 * ETCD_PASSWORD_BYTES:
+                password = requested_cred
+
+        self.keyval_client.grant_user_role(
+            self.batchuser, role,
+            [('/pcocc/cluster/', 'R'),
+             ('/pcocc/global/public/', 'R'),
+             ('/pcocc/cluster/users/{0}/'.format(self.batchuser), 'RW'),
+             ('/pcocc/global/users/{0}/'.format(self.batchuser), 'RW')],
+            password)
+
     def cleanup_cluster_keys(self):
         try:
             logging.debug('Setting self-destruct on cluster etcd keystore')
+            # With the v3 API, this attaches all keys to a lease
             self.keyval_client.write(self.get_key_path('cluster', ''),
                                      None, dir=True, prevExist=True, ttl=600)
             self.keyval_client.write(self.get_key_path('cluster/user', ''),
@@ -764,7 +1252,36 @@ class EtcdManager(BatchManager):
         """ Populate environment variables with batch related info to propagate """
         os.putenv('PCOCC_JOB_ID', str(self.batchid))
 
-# Schema to validate the global pkey state in the key/value store
+# Schema to validate a local job record in the key/value store
+local_job_record_schema = """
+type: object
+properties:
+  batchname:
+    type: string
+  coreset:
+    type: string
+  definition:
+    type: string
+  uuid:
+    type: string
+  host:
+    type: string
+  user:
+    type: string
+  start:
+    type: integer
+required:
+  - batchname
+  - definition
+  - uuid
+  - host
+  - user
+  - start
+additionalProperties: no
+"""
+
+# Schema to validate the legacy job allocation table which held all
+# local jobs in a single key
 local_job_allocation_schema = """
 type: object
 properties:
@@ -1029,17 +1546,54 @@ class LocalManager(EtcdManager):
             raise InvalidJobError('Invalid characters in job name {0}'.format(
                 batchname))
 
-    def _job_allocation_key(self):
+    def _legacy_job_allocation_key(self):
         return 'public/batch-local/job_allocation_state'
 
+    def _next_batchid_key(self):
+        return 'public/batch-local/next_batchid'
+
+    def _job_dir(self):
+        return 'public/batch-local/jobs'
+
+    def _job_key(self, batchid):
+        return '{0}/{1}'.format(self._job_dir(), batchid)
+
+    def _job_uuid_dir(self):
+        return 'public/batch-local/by-uuid'
+
+    def _job_uuid_key(self, uuid):
+        return '{0}/{1}'.format(self._job_uuid_dir(), uuid)
+
+    def _job_names_dir(self):
+        return 'public/batch-local/by-name'
+
+    def _job_name_dir(self, user):
+        return '{0}/{1}'.format(self._job_names_dir(), user)
+
+    def _job_name_key(self, user, host, batchname):
+        return '{0}/{1}/{2}'.format(self._job_name_dir(user), host,
+                                    urllib.quote(batchname, safe=''))
+
+    def _list_job_records(self):
+        """Returns a dict of all job records indexed by batchid"""
+        jobs = {}
+        d = self.read_dir('global', self._job_dir())
+        if d is None:
+            return jobs
+
+        for child in d.children:
+            try:
+                batchid = int(os.path.split(child.key)[-1])
+            except ValueError:
+                continue
+            jobs[batchid] = self._validate_job_record(child.value)
+
+        return jobs
+
     def _cleanup_orphan_jobs(self):
         """Cleanup jobs which were not properly deleted
         """
-        job_alloc_state = self.read_key('global',
-                                        self._job_allocation_key())
-        job_alloc_state = self._validate_job_state(job_alloc_state)
-
-        for batchid, job in job_alloc_state['jobs'].iteritems():
+        for batchid, job in self._list_job_records().iteritems():
             if job['host'] == socket.gethostname().split('.')[0]:
                 f = None
                 try:
@@ -1054,7 +1608,69 @@ class LocalManager(EtcdManager):
                 if not pids:
                     logging.warning('Trying to clean orphan job %s', batchid)
                     subprocess.call(['pcocc'] + Config().verbose_opt +
-                                     ['internal', 'setup', 'delete', '-j', batchid, '--nolock'])
+                                     ['internal', 'setup', 'delete', '-j',
+                                      str(batchid), '--nolock'])
+
+        self._cleanup_orphan_index_keys()
+
+    def _cleanup_orphan_index_keys(self):
+        """Delete index keys referring to a missing job record
+
+        They may have been left by jobs allocated before records were
+        written ahead of their index keys.
+
+        """
+        for index_dir in [self._job_uuid_dir(), self._job_names_dir()]:
+            d = self.read_dir('global', index_dir)
+            if d is None:
+                continue
+
+            for child in d.children:
+                if getattr(child, 'dir', False):
+                    continue
+                batchid = decode_value(child.value)
+                if self.read_key('global',
+                                 self._job_key(batchid)) is not None:
+                    continue
+
+                key = child.key[len(self.get_key_path('global', '')):]
+                logging.warning('Deleting orphan job index key %s', key)
+                try:
+                    self.delete_key('global', key)
+                except etcd.EtcdKeyNotFound:
+                    pass
+
+    def _migrate_job_allocation_state(self):
+        """Splits the legacy job allocation table into per-job keys"""
+        legacy_state = self.read_key('global',
+                                     self._legacy_job_allocation_key())
+        if legacy_state is None:
+            return
+
+        job_alloc_state = decode_value(legacy_state)
+        validate_schema(job_alloc_state, local_job_allocation_schema)
+
+        logging.info('Migrating %d local jobs to per-job keys',
+                     len(job_alloc_state['jobs']))
+
+        for batchid, job in job_alloc_state['jobs'].iteritems():
+            self.write_key('global', self._job_key(batchid),
+                           encode_value(job))
+            self.write_key('global',
+                           self._job_name_key(job['user'], job['host'],
+                                              job['batchname']),
+                           encode_value(int(batchid)))
+            self.write_key('global', self._job_uuid_key(job['uuid']),
+                           encode_value(int(batchid)))
+
+        self.atom_update_key('global', self._next_batchid_key(),
+                             self._do_merge_next_batchid,
+                             job_alloc_state['next_batchid'])
+        try:
+            self.delete_key('global', self._legacy_job_allocation_key())
+        except etcd.EtcdKeyNotFound:
+            # Migrated concurrently from another host
+            pass
 
     def _list_alive_jobs(self):
         path = self.get_key_path('global/user', 'batch-local/heartbeat')
@@ -1083,22 +1699,16 @@ class LocalManager(EtcdManager):
                            '',
                            ttl)
 
-    def list_all_jobs(self, include_expired=False):
+    def list_all_jobs(self, include_expired=False, refresh=False):
         """List all jobs in the cluster
 
         Returns a list of the batchids of all jobs in the cluster
 
         """
-        job_alloc_state = self.read_key('global',
-                                        self._job_allocation_key())
-        job_alloc_state = self._validate_job_state(job_alloc_state)
-
-
         user_live_batchids = self._list_alive_jobs()
 
         batchids = []
-        for batchid, job in job_alloc_state['jobs'].iteritems():
-            batchid = int(batchid)
+        for batchid, job in self._list_job_records().iteritems():
             if (include_expired or
                 job['user'] != self.batchuser or
                 datetime_to_epoch(datetime.datetime.now()) - job['start'] < 5 or
@@ -1113,24 +1723,30 @@ class LocalManager(EtcdManager):
 
     def find_job_by_name(self, user, batchname,
                          host=None):
+        local_host = socket.gethostname().split('.')[0]
 
-        job_alloc_state = self.read_key('global',
-                                        self._job_allocation_key())
-        job_alloc_state = self._validate_job_state(job_alloc_state)
+        # Jobs on the requested or local host are found directly
+        batchid = self.read_key('global',
+                                self._job_name_key(user, host or local_host,
+                                                   batchname))
+        if batchid is not None:
+            return decode_value(batchid)
+
+        if host:
+            raise InvalidJobError('no valid match for name '+ batchname)
 
         batchids = []
         hosts = []
-        for batchid, job in job_alloc_state['jobs'].iteritems():
-            if (job['user'] == user and job['batchname'] == batchname):
-                if host and job['host'] == host:
-                    return batchid
-                elif not host:
-                    if job['host'] == socket.gethostname().split('.')[0]:
-                        return batchid
-                    else:
-                        batchids.append(int(batchid))
-                        hosts.append(job['host'])
-
+        d = self.read_dir('global', self._job_name_dir(user))
+        if d is not None:
+            for child in d.children:
+                # Skip empty directories left by deleted jobs
+                if getattr(child, 'dir', False):
+                    continue
+                job_host, name = child.key.split('/')[-2:]
+                if urllib.unquote(name) == batchname:
+                    batchids.append(decode_value(child.value))
+                    hosts.append(job_host)
 
         if not batchids:
             raise InvalidJobError('no valid match for name '+ batchname)
@@ -1142,97 +1758,108 @@ class LocalManager(EtcdManager):
         return batchids[0]
 
     def _get_job_record(self, batchid):
-        job_alloc_state = self.read_key('global',
-                                        self._job_allocation_key())
-        job_alloc_state = self._validate_job_state(job_alloc_state)
-
-        try:
-            return job_alloc_state['jobs'][str(batchid)]
-        except KeyError:
+        job_record = self.read_key('global', self._job_key(batchid))
+        if job_record is None:
             raise InvalidJobError('no job record for batchid ' + str(batchid))
 
-    def _do_alloc_job(self, user, batchname, uuid, definition, job_alloc_state):
-        """Helper to allocate a jobname"""
-        job_alloc_state = self._validate_job_state(job_alloc_state)
+        return self._validate_job_record(job_record)
 
-        try:
-            batchid = self._uuid_to_batchid(user, uuid, job_alloc_state)
-        except AllocationError:
-            batchid = -1
-
-        if batchid != -1:
-            raise AllocationError(
-                'uuid {0} already in use by job {1} on host {2}'.format(
-                    uuid, batchid, job_alloc_state['jobs'][str(batchid)]['host']))
+    def _do_next_batchid(self, value):
+        """Helper to increment the batchid counter"""
+        if value is None:
+            # Continue numbering from a table which was not migrated yet
+            legacy_state = self.read_key('global',
+                                         self._legacy_job_allocation_key())
+            if legacy_state is None:
+                batchid = 1
+            else:
+                batchid = decode_value(legacy_state)['next_batchid']
+        else:
+            batchid = decode_value(value)
 
+        return encode_value(batchid + 1), batchid
 
-        try:
-            batchid = self.find_job_by_name(user, batchname,
-                                            socket.gethostname().split('.')[0])
-        except InvalidJobError:
-            batchid = -1
+    def _do_merge_next_batchid(self, next_batchid, value):
+        """Helper to make sure the batchid counter is past next_batchid"""
+        if value is not None:
+            next_batchid = max(next_batchid, decode_value(value))
 
-        if batchid != -1:
-            raise AllocationError(
-                'Jobname {0} already in use by job {1} on host {2}'.format(
-                    batchname, batchid, job_alloc_state['jobs'][str(batchid)]['host']))
+        return encode_value(next_batchid), None
 
+    def _alloc_job(self, user, batchname, uuid, definition):
+        """Allocate a batchid and record a new job"""
+        host = socket.gethostname().split('.')[0]
+        batchid = self.atom_update_key('global',
+                                       self._next_batchid_key(),
+                                       self._do_next_batchid)
 
-        batchid = job_alloc_state['next_batchid']
-        job_alloc_state['next_batchid'] = batchid + 1
-
-        job_alloc_state['jobs'][str(batchid)] = {
+        # The record is written before the index keys, and deleted
+        # after them, so that index keys always refer to a record
+        job_record = self._validate_job_record({
             'batchname': batchname,
             'definition': definition,
             'uuid': str(uuid),
             'user': user,
-            'host': socket.gethostname().split('.')[0],
+            'host': host,
             'start': datetime_to_epoch(datetime.datetime.now())
-        }
-
-        job_alloc_state = self._validate_job_state(job_alloc_state)
-        return yaml.dump(job_alloc_state), batchid
-
-    def _do_free_job(self, user, uuid, job_alloc_state):
-        """Helper to allocate a jobname"""
-        job_alloc_state = self._validate_job_state(job_alloc_state)
+        })
+        self.write_key('global', self._job_key(batchid),
+                       encode_value(job_record))
 
-        batchid = self._uuid_to_batchid(user, uuid, job_alloc_state)
-        job_record = job_alloc_state['jobs'].pop(str(batchid))
+        # The name index ensures that job names are unique per host
+        name_key = self._job_name_key(user, host, batchname)
+        try:
+            self.write_key_new('global', name_key, encode_value(batchid))
+        except etcd.EtcdAlreadyExist:
+            self.delete_key('global', self._job_key(batchid))
+            raise AllocationError(
+                'Jobname {0} already in use by job {1} on host {2}'.format(
+                    batchname, self.find_job_by_name(user, batchname, host),
+                    host))
 
-        job_alloc_state = self._validate_job_state(job_alloc_state)
-        return yaml.dump(job_alloc_state), job_record
+        try:
+            self.write_key_new('global', self._job_uuid_key(uuid),
+                               encode_value(batchid))
+        except etcd.EtcdAlreadyExist:
+            self.delete_key('global', name_key)
+            self.delete_key('global', self._job_key(batchid))
+            raise AllocationError('uuid {0} already in use by job {1}'.format(
+                    uuid, self._uuid_to_batchid(user, uuid)))
+
+        return batchid
+
+    def _free_job(self, batchid, job_record):
+        """Delete a job record and its index keys"""
+        for key in [self._job_uuid_key(job_record['uuid']),
+                    self._job_name_key(job_record['user'],
+                                       job_record['host'],
+                                       job_record['batchname']),
+                    self._job_key(batchid)]:
+            try:
+                self.delete_key('global', key)
+            except etcd.EtcdKeyNotFound:
+                pass
 
-    def _validate_job_state(self, state):
-        if state is None:
-            job_alloc_state = {'jobs': {}, 'next_batchid': 1}
-        elif isinstance(state, dict):
-            job_alloc_state = state
+    def _validate_job_record(self, record):
+        if isinstance(record, dict):
+            validate_schema(record, local_job_record_schema)
         else:
-            job_alloc_state = yaml.safe_load(state)
-
-        schema = yaml.safe_load(local_job_allocation_schema)
-        jsonschema.validate(job_alloc_state, schema)
-
-        return job_alloc_state
+            raw = record
+            record = decode_value(raw)
+            validate_schema(record, local_job_record_schema, raw)
 
-    def _uuid_to_batchid(self, user, uuid, job_alloc_state=None):
-        if job_alloc_state is None:
-            job_alloc_state = self.read_key('global',
-                                            self._job_allocation_key())
+        return record
 
-        job_alloc_state = self._validate_job_state(job_alloc_state)
-
-        try:
-            for batchid, job in job_alloc_state['jobs'].iteritems():
-                if job['uuid'] == str(uuid):
-                    return int(batchid)
-        except KeyError:
-            pass
+    def _uuid_to_batchid(self, user, uuid):
+        batchid = self.read_key('global', self._job_uuid_key(uuid))
+        if batchid is None:
+            raise AllocationError(
+                'Unable to find job with uuid {0}'.format(uuid))
 
-        raise AllocationError('Unable to find job with uuid {0}'.format(uuid))
+        return decode_value(batchid)
 
     def init_node(self):
+        self._migrate_job_allocation_state()
         self._cleanup_orphan_jobs()
 
     def create_resources(self):
@@ -1252,14 +1879,10 @@ class LocalManager(EtcdManager):
         except Exception:
             raise AllocationError('Invalid uuid')
 
-        self.batchid = self.atom_update_key(
-            'global',
-            self._job_allocation_key(),
-            self._do_alloc_job,
-            self.batchuser,
-            req_jobname,
-            req_uuid,
-            self.cluster_definition)
+        self.batchid = self._alloc_job(self.batchuser,
+                                       req_jobname,
+                                       req_uuid,
+                                       self.cluster_definition)
         self._update_heartbeat()
 
 
@@ -1284,13 +1907,11 @@ class LocalManager(EtcdManager):
             cores = os.environ.get('PCOCC_LOCAL_CORE_SET', None)
             if cores:
                 cores = RangeSet(cores)
-                pus = subprocess_check_output(['hwloc-calc',
-                                               '--intersect', 'PU',
-                                               'cores:{0}'.format(cores)]).strip()
+                pus = Config().topology.core_pus(cores)
 
                 with open(os.path.join(self._cpuset_cluster(),
                                        'cpuset.cpus'), 'w') as f:
-                    f.write(str(pus))
+                    f.write(','.join(str(pu) for pu in pus))
         except Exception as e:
             raise BatchError('Unable to set requested cpuset: ' + str(e))
 
@@ -1345,13 +1966,7 @@ class LocalManager(EtcdManager):
                 f.close()
 
         try:
-            job_record = self.atom_update_key(
-                'global',
-                self._job_allocation_key(),
-                self._do_free_job,
-                self.batchuser,
-                job_record['uuid'])
-
+            self._free_job(self.batchid, job_record)
             self._update_heartbeat(0)
         except:
             logging.error('No allocation record to delete '
@@ -1370,6 +1985,270 @@ class LocalManager(EtcdManager):
 
 
 
+class SlurmJobCache(object):
+    """Snapshot of Slurm job information shared between processes
+
+    The job list is retrieved with a single squeue call and saved in a
+    per-user file so that all pcocc processes of the user on the node
+    can reuse it until it expires. Job details from scontrol are
+    parsed once and kept as long as the job is listed.
+
+    """
+    def __init__(self, ttl, path=None):
+        self._ttl = ttl
+        if path is None:
+            path = '/tmp/.pcocc_slurm_cache_{0}'.format(os.getuid())
+        self._path = path
+        self._data = None
+
+    def _expired(self, data):
+        return data is None or time.time() - data['time'] > self._ttl
+
+    def _load(self):
+        """Returns the cached data unless it has expired"""
+        if self._expired(self._data):
+            data = self._read()
+            if self._expired(data):
+                return None
+            self._data = data
+
+        return self._data
+
+    def _read(self):
+        try:
+            fd = os.open(self._path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            return None
+
+        try:
+            # Only trust a cache which could only have been written by us
+            st = os.fstat(fd)
+            if (st.st_uid != os.getuid() or
+                st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+                logging.warning('Ignoring Slurm cache file %s with unsafe '
+                                'permissions', self._path)
+                return None
+
+            with os.fdopen(os.dup(fd), 'r') as f:
+                data = decode_value(f.read())
+        except (OSError, IOError, ValueError) as e:
+            logging.debug('Unable to read Slurm cache: %s', e)
+            return None
+        finally:
+            os.close(fd)
+
+        if not isinstance(data, dict):
+            return None
+
+        return data
+
+    def _save(self, data):
+        self._data = data
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path),
+                                            prefix='.pcocc_slurm_cache')
+            with os.fdopen(fd, 'w') as f:
+                f.write(encode_value(data))
+            os.rename(tmp_path, self._path)
+        except (OSError, IOError) as e:
+            logging.debug('Unable to write Slurm cache: %s', e)
+            try:
+                os.unlink(tmp_path)
+            except (OSError, UnboundLocalError):
+                pass
+
+    def _fetch(self):
+        try:
+            output = subprocess_check_output(['squeue', '-h', '-o',
+                                              '%A|%u|%N|%j'])
+        except subprocess.CalledProcessError as err:
+            raise BatchError('Unable to retrieve SLURM job list: ' + str(err))
+
+        jobs = {}
+        for line in output.splitlines():
+            try:
+                batchid, user, nodes, name = line.split('|', 3)
+                jobs[str(int(batchid))] = {'user': user,
+                                           'nodes': nodes,
+                                           'name': name}
+            except ValueError:
+                logging.warning('Unexpected squeue output: %s', line)
+
+        # Keep details of jobs which are still there
+        details = {}
+        previous = self._data or self._read()
+        if previous is not None:
+            details = dict((batchid, d) for batchid, d
+                           in previous['details'].iteritems()
+                           if batchid in jobs)
+
+        return {'time': time.time(), 'jobs': jobs, 'details': details}
+
+    def jobs(self, refresh=False):
+        """Returns a dict of jobs indexed by batchid
+
+        Each job is described by its user, nodes and name. The
+        snapshot may be up to ttl seconds old unless refresh is True.
+
+        """
+        data = None
+        if not refresh:
+            data = self._load()
+
+        if data is None:
+            data = self._fetch()
+            self._save(data)
+
+        return dict((int(batchid), job) for batchid, job
+                    in data['jobs'].iteritems())
+
+    def job_details(self, batchid):
+        """Returns the fields of scontrol show job as a dict"""
+        data = self._load()
+        if data is None:
+            data = self._fetch()
+
+        details = data['details'].get(str(batchid))
+        if details is None:
+            raw_output = subprocess_check_output(
+                ['scontrol', 'show', 'jobid=%d' % (batchid)])
+            details = dict(re.findall(r'(\S+?)=(\S*)', raw_output))
+            data['details'][str(batchid)] = details
+            self._save(data)
+
+        return details
+
+
+class RankMap(object):
+    """Run-length encoded mapping of task ranks to host ranks
+
+    Tasks are distributed by blocks on consecutive hosts: the map is
+    a list of (ntasks, nnodes) groups, as in SLURM_TASKS_PER_NODE,
+    with the first task and host rank of each group precomputed so
+    that lookups are done by bisection on the groups.
+
+    """
+    def __init__(self, groups=None):
+        self.groups = []
+        self._first_rank = []
+        self._first_host = []
+        self._num_tasks = 0
+        self._num_hosts = 0
+
+        for ntasks, nnodes in groups or []:
+            self.append(ntasks, nnodes)
+
+    @classmethod
+    def from_tasks_per_node(cls, tasks_per_node):
+        """Builds the map from a SLURM_TASKS_PER_NODE string"""
+        rank_map = cls()
+        for node_def in tasks_per_node.split(','):
+            match = re.search(r'(\d+)\(x(\d+)\)', node_def)
+            if match:
+                ntasks = int(match.group(1))
+                nnodes = int(match.group(2))
+            else:
+                ntasks = int(node_def)
+                nnodes = 1
+            rank_map.append(ntasks, nnodes)
+
+        return rank_map
+
+    @classmethod
+    def from_list(cls, host_ranks):
+        """Builds the map from a list of host ranks indexed by task rank
+
+        Hosts without tasks are skipped in the list, they are added
+        as groups without tasks.
+
+        """
+        rank_map = cls()
+        prev_host = -1
+        ntasks = 0
+        for host_rank in host_ranks:
+            if host_rank != prev_host:
+                if ntasks:
+                    rank_map.append(ntasks, 1)
+                if host_rank < prev_host:
+                    raise BatchError('Unsupported rank map')
+                rank_map.append(0, host_rank - prev_host - 1)
+                prev_host = host_rank
+                ntasks = 0
+            ntasks += 1
+
+        if ntasks:
+            rank_map.append(ntasks, 1)
+
+        return rank_map
+
+    @classmethod
+    def decode(cls, data):
+        """Decodes a rank map stored in the key-value store
+
+        Maps stored as a flat list by previous versions are also
+        accepted.
+
+        """
+        value = decode_value(data)
+        if isinstance(value, dict):
+            return cls(value['groups'])
+
+        return cls.from_list(value)
+
+    def encode(self):
+        return encode_value({'groups': self.groups})
+
+    def append(self, ntasks, nnodes):
+        if nnodes <= 0:
+            return
+
+        # Merge with the previous group if possible
+        if self.groups and self.groups[-1][0] == ntasks:
+            self.groups[-1][1] += nnodes
+        else:
+            self.groups.append([ntasks, nnodes])
+            self._first_rank.append(self._num_tasks)
+            self._first_host.append(self._num_hosts)
+
+        self._num_tasks += ntasks * nnodes
+        self._num_hosts += nnodes
+
+    def __len__(self):
+        return self._num_tasks
+
+    def __getitem__(self, rank):
+        return self.locate(rank)[0]
+
+    @property
+    def num_hosts(self):
+        return self._num_hosts
+
+    def locate(self, rank):
+        """Returns the host rank and the rank on host of a task rank"""
+        if rank < 0 or rank >= self._num_tasks:
+            raise IndexError('task rank {0} out of range'.format(rank))
+
+        # Groups without tasks share their first rank with the next
+        # group, pick the last one
+        g = bisect.bisect_right(self._first_rank, rank) - 1
+        ntasks = self.groups[g][0]
+        offset = rank - self._first_rank[g]
+
+        return (self._first_host[g] + offset // ntasks,
+                offset % ntasks)
+
+    def ranks_on_host(self, host_rank):
+        """Returns the list of task ranks on a host"""
+        if host_rank < 0 or host_rank >= self._num_hosts:
+            raise IndexError('host rank {0} out of range'.format(host_rank))
+
+        g = bisect.bisect_right(self._first_host, host_rank) - 1
+        ntasks = self.groups[g][0]
+        start = (self._first_rank[g] +
+                 (host_rank - self._first_host[g]) * ntasks)
+
+        return range(start, start + ntasks)
+
 class SlurmManager(EtcdManager):
     def __init__(self, batchid, batchname, default_batchname, settings,
                  proc_type, batchuser):
@@ -1380,7 +2259,9 @@ class SlurmManager(EtcdManager):
 
         # At init time we get all the necessery info about the job state
         # from the batch scheduler
-        self._rank_map = []
+        self._rank_map = None
+        self._job_cache = SlurmJobCache(settings.get('slurm-cache-ttl',
+                                                     DEFAULT_SLURM_CACHE_TTL))
 
         # Find the uid: if we are executed as a management plugin, the uid will
         # be set as an env var, otherwise we can use the current user
@@ -1424,15 +2305,13 @@ class SlurmManager(EtcdManager):
             self.batchid == int(os.environ['SLURM_JOB_ID'])):
             self.nodeset = NodeSet(os.environ['SLURM_NODELIST'])
         else:
-            try:
-                self.nodeset = NodeSet(
-                    subprocess_check_output(['squeue', '-j',
-                                             str(self.batchid),
-                                             '-u', self.batchuser,
-                                             '-h', '-o', '%N']))
-            except subprocess.CalledProcessError:
+            job = self._find_job(lambda i, j: i == self.batchid and
+                                 j['user'] == self.batchuser)
+            if not job:
                 raise InvalidJobError('no valid match for id '+ str(self.batchid))
 
+            try:
+                self.nodeset = NodeSet(job.values()[0]['nodes'])
             except NodeSetException:
                 raise InvalidJobError('no valid match for id '+ str(self.batchid))
 
@@ -1477,64 +2356,64 @@ class SlurmManager(EtcdManager):
 
         """
 
-        cmd = [ 'squeue' , '-n', batchname, '-u', user,
-                '-h', '-o', '%i' ]
-        if host:
-            cmd += ['-w', host]
+        def match(batchid, job):
+            if job['user'] != user or job['name'] != batchname:
+                return False
+            try:
+                return not host or host in NodeSet(job['nodes'])
+            except NodeSetException:
+                return False
 
-        try:
-            batchid = subprocess_check_output(cmd)
-        except subprocess.CalledProcessError:
-            raise InvalidJobError('no valid match for name '+ batchname)
+        batchids = self._find_job(match).keys()
 
-        if not batchid:
+        if not batchids:
             raise InvalidJobError('no valid match for name '+ batchname)
 
-        try:
-            return int(batchid)
-        except ValueError:
+        if len(batchids) > 1:
             raise InvalidJobError('name %s is ambiguous' % batchname)
 
-    def list_all_jobs(self):
+        return batchids[0]
+
+    def _find_job(self, match):
+        """Returns the jobs for which match(batchid, job) is true
+
+        Jobs which were just submitted may be missing from the cached
+        job list which is refreshed before giving up.
+
+        """
+        for refresh in [False, True]:
+            jobs = dict((batchid, job) for batchid, job
+                        in self._job_cache.jobs(refresh).iteritems()
+                        if match(batchid, job))
+            if jobs:
+                break
+
+        return jobs
+
+    def list_all_jobs(self, refresh=False):
         """List all jobs in the cluster
 
-        Returns a list of the batchids of all jobs in the cluster
+        Returns a list of the batchids of all jobs in the cluster. The
+        list may be a few seconds old unless refresh is True: it must
+        be refreshed before considering that a job has terminated.
 
         """
-        try:
-            joblist = subprocess_check_output(['squeue', '-ho',
-                                               '%A']).split()
-            return [ int(j) for j in joblist ]
-        except subprocess.CalledProcessError as err:
-            raise BatchError('Unable to retrieve SLURM job list: ' + str(err))
+        return self._job_cache.jobs(refresh).keys()
 
     def _build_rank_map(self, tasks_per_node=None):
         self._only_in_a_job()
-        node_index = 0
 
         assert(not self._rank_map)
 
         if not tasks_per_node:
             tasks_per_node = os.environ['SLURM_TASKS_PER_NODE']
 
-        for node_def in tasks_per_node.split(','):
-            match = re.search(r'(\d+)\(x(\d+)\)', node_def)
-            if match:
-                ntasks = int(match.group(1))
-                nnodes = int(match.group(2))
-            else:
-                ntasks = int(node_def)
-                nnodes = 1
-
-            for _ in xrange(nnodes):
-                for _ in xrange(ntasks):
-                    self._rank_map.append(node_index)
-                node_index += 1
+        self._rank_map = RankMap.from_tasks_per_node(tasks_per_node)
 
         if (self.proc_type == ProcessType.SETUP and
             self.node_rank == 0):
             self.write_key('cluster', 'rank_map',
-                           yaml.dump(self._rank_map))
+                           self._rank_map.encode())
 
     def _load_rank_map(self):
         if self._rank_map:
@@ -1545,7 +2424,10 @@ class SlurmManager(EtcdManager):
         if not data:
             raise BatchError("Unable to load rank map")
 
-        self._rank_map = yaml.safe_load(data)
+        try:
+            self._rank_map = RankMap.decode(data)
+        except (ValueError, KeyError, TypeError) as e:
+            raise BatchError("Unable to load rank map: " + str(e))
 
 
     def run(self, cluster, run_opt, cmd):
@@ -1614,20 +2496,19 @@ class SlurmManager(EtcdManager):
         """Returns the amount of memory allocated per core in MB"""
         self._only_in_a_job()
 
-        raw_output = subprocess_check_output(
-            ['scontrol', 'show', 'jobid=%d' % (self.batchid)])
+        details = self._job_cache.job_details(self.batchid)
 
         # First, assume the memory was specified on a per cpu basis:
-        match = re.search(r'MinMemoryCPU=(\d+)M', raw_output)
+        match = re.match(r'(\d+)M$', details.get('MinMemoryCPU', ''))
         if match:
             return int(match.group(1))
 
         # Else, try a per node basis:
-        match = re.search(r'MinMemoryNode=(\d+)M', raw_output)
+        match = re.match(r'(\d+)M$', details.get('MinMemoryNode', ''))
         if match:
             return int(match.group(1)) // self.num_cores
 
-        match = re.search(r'MinMemoryNode=(\d+)G', raw_output)
+        match = re.match(r'(\d+)G$', details.get('MinMemoryNode', ''))
         if match:
             return int(match.group(1)) * 1024 // self.num_cores
 
@@ -1658,30 +2539,19 @@ class SlurmManager(EtcdManager):
         """
         self._only_in_a_job()
         # Assume we've been bound to our cores by SLURM
-        taskset = subprocess_check_output(['hwloc-bind', '--get']).strip()
-        coreset = subprocess_check_output(['hwloc-calc', '--intersect', 'Core',
-                                           taskset]).strip()
-
-        return RangeSet(coreset)
+        return Config().topology.process_coreset()
 
     def get_host_rank(self, rank):
         """Returns rank of the host where the specified task rank runs"""
         self._only_in_a_job()
-        return self._rank_map[rank]
+        return self._rank_map.locate(rank)[0]
 
     def get_rank_on_host(self, rank):
         """Returns the relative rank of the specified task rank on its host
 
         """
         self._only_in_a_job()
-        host_rank = self._rank_map[rank]
-        rank_on_host = 0
-
-        while ( (rank - rank_on_host >= 0) and
-                (self._rank_map[rank - rank_on_host] == host_rank) ):
-            rank_on_host = rank_on_host + 1
-
-        return rank_on_host - 1
+        return self._rank_map.locate(rank)[1]
 
     def populate_env(self):
         """ Populate environment variables with batch related info to propagate """
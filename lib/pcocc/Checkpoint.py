@@ -0,0 +1,410 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Checkpoint memory streams and manifests
+
+Qemu writes the memory of a VM as a migration stream to a shell
+pipeline which compresses it and writes it to the checkpoint
+directory. The pipeline ends with dd so that the file is written
+with large sequential blocks, bypassing the page cache when the
+filesystem supports O_DIRECT. The codec used for each checkpoint is
+recorded in a manifest so that the restore pipeline can be built
+accordingly.
+
+In live mode, VMs keep running while their memory is copied. Pages
+dirtied in the meantime are copied again in successive passes until
+the remaining data of every VM can be written within the downtime
+budget. All VMs are then paused together for the final pass, and
+their disks are saved before the memory transfers are completed.
+
+Disk images of checkpoints only hold the clusters written since the
+image or checkpoint they are based on, which is their backing file.
+Consolidating a checkpoint merges the checkpoints of its chain into
+its disk images so that older ones can be deleted.
+
+"""
+
+from __future__ import division
+
+import os
+import re
+import json
+import errno
+import pipes
+import tempfile
+import subprocess
+
+from .Error import PcoccError
+from .Backports import subprocess_check_output
+
+CHECKPOINT_BLOCK_SIZE = 4 * 1024 * 1024
+MANIFEST_FILE = 'manifest'
+MANIFEST_VERSION = 1
+
+DEFAULT_CODEC = 'zstd'
+
+# Maximum pause of VMs in live mode, in seconds
+DEFAULT_MAX_DOWNTIME = 1.0
+# Number of pre-copy passes after which VMs are paused even if their
+# estimated downtime exceeds the budget
+LIVE_CKPT_MAX_PASSES = 10
+
+# Dirty bitmap tracking the writes since the last disk checkpoint
+CKPT_BITMAP = 'pcocc-ckpt'
+
+class Codec(object):
+    """Compression program used for memory streams
+
+    Codecs which support threads are given the number of host cores
+    available to the VM.
+
+    """
+    name = None
+    levels = None
+    default_level = None
+    threaded = False
+
+    def check_level(self, level):
+        if level is None:
+            return self.default_level
+        if not self.levels:
+            raise PcoccError('codec {0} has no compression '
+                             'level'.format(self.name))
+        if not self.levels[0] <= level <= self.levels[1]:
+            raise PcoccError('compression level for {0} must be between '
+                             '{1} and {2}'.format(self.name, *self.levels))
+        return level
+
+    def compress_args(self, level, threads):
+        raise NotImplementedError
+
+    def decompress_args(self):
+        raise NotImplementedError
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    levels = (1, 19)
+    default_level = 1
+    threaded = True
+
+    def compress_args(self, level, threads):
+        # zstd -T0 uses as many threads as there are cores
+        return ['zstd', '-q', '-c', '-T{0}'.format(threads or 0),
+                '-{0}'.format(level)]
+
+    def decompress_args(self):
+        return ['zstd', '-q', '-dc']
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+    levels = (1, 12)
+    default_level = 1
+
+    def compress_args(self, level, threads):
+        return ['lz4', '-q', '-c', '-{0}'.format(level)]
+
+    def decompress_args(self):
+        return ['lz4', '-q', '-dc']
+
+class LzopCodec(Codec):
+    """Codec of checkpoints made before manifests were introduced"""
+    name = 'lzop'
+    levels = (1, 9)
+    default_level = 3
+
+    def compress_args(self, level, threads):
+        return ['lzop', '-c', '-{0}'.format(level)]
+
+    def decompress_args(self):
+        return ['lzop', '-dc']
+
+class NullCodec(Codec):
+    name = 'none'
+
+    def compress_args(self, level, threads):
+        return None
+
+    def decompress_args(self):
+        return None
+
+CODECS = dict((codec.name, codec())
+              for codec in [ZstdCodec, Lz4Codec, LzopCodec, NullCodec])
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise PcoccError('unknown compression codec: {0}'.format(name))
+
+class MemoryCompression(object):
+    """Compression settings of the memory streams of a checkpoint"""
+    def __init__(self, codec=DEFAULT_CODEC, level=None, threads=None):
+        self.codec = get_codec(codec)
+        self.level = self.codec.check_level(level)
+        if threads is not None and threads < 0:
+            raise PcoccError('invalid number of compression threads')
+        self.threads = threads
+
+    @classmethod
+    def from_manifest(cls, manifest):
+        memory = manifest['memory']
+        return cls(memory['codec'], memory.get('level'))
+
+    def to_manifest(self):
+        return {'codec': self.codec.name, 'level': self.level}
+
+    def save_pipeline(self, dest_file, cpus=None, direct=False, live=False):
+        """Returns a shell pipeline writing a stream to dest_file
+
+        If the list of host cpus available to the VM is known, the
+        compressor is bound to them, with one thread per cpu unless
+        specified otherwise. When the VM keeps running during the copy
+        (live), its cpus are busy: the compressor is not bound and uses
+        a single thread unless specified otherwise.
+
+        """
+        if live:
+            cpus = None
+        threads = self.threads
+        if threads is None and cpus:
+            threads = len(cpus)
+        elif threads is None and live:
+            threads = 1
+
+        commands = []
+        args = self.codec.compress_args(self.level, threads)
+        if args:
+            if cpus and self.codec.threaded:
+                args = ['taskset', '-c',
+                        ','.join(str(cpu) for cpu in cpus)] + args
+            commands.append(args)
+
+        commands.append(dd_args(dest_file, 'of', direct))
+        return pipeline(commands)
+
+    def restore_pipeline(self, src_file, direct=False):
+        """Returns a shell pipeline reading a stream from src_file"""
+        commands = [dd_args(src_file, 'if', direct)]
+        args = self.codec.decompress_args()
+        if args:
+            commands.append(args)
+        return pipeline(commands)
+
+def dd_args(path, direction, direct):
+    """Returns a dd command line to copy a file with large blocks
+
+    Pipes return partial blocks so they are accumulated to get
+    aligned writes, which O_DIRECT requires. The last partial block
+    is written without O_DIRECT by GNU dd.
+
+    """
+    args = ['dd', '{0}={1}'.format(direction, path),
+            'bs={0}'.format(CHECKPOINT_BLOCK_SIZE), 'status=none']
+    if direction == 'of':
+        args += ['iflag=fullblock']
+        if direct:
+            args += ['oflag=direct']
+    elif direct:
+        args += ['iflag=direct']
+    return args
+
+def pipeline(commands):
+    return ' | '.join(' '.join(pipes.quote(arg) for arg in args)
+                      for args in commands)
+
+def direct_io_supported(path):
+    """Checks if files can be opened with O_DIRECT
+
+    If path is a directory, a temporary file is created in it to run
+    the check.
+
+    """
+    if not hasattr(os, 'O_DIRECT'):
+        return False
+
+    tmp_path = None
+    try:
+        if os.path.isdir(path):
+            fd, tmp_path = tempfile.mkstemp(dir=path, prefix='.direct')
+            os.close(fd)
+            path = tmp_path
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+        os.close(fd)
+        return True
+    except OSError as err:
+        if err.errno == errno.EINVAL:
+            return False
+        raise PcoccError('unable to access {0}: {1}'.format(path,
+                                                             err.strerror))
+    finally:
+        if tmp_path:
+            os.unlink(tmp_path)
+
+def manifest_path(ckpt_dir):
+    return os.path.join(ckpt_dir, MANIFEST_FILE)
+
+def write_manifest(ckpt_dir, manifest):
+    manifest = dict(manifest, version=MANIFEST_VERSION)
+    path = manifest_path(ckpt_dir)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+            f.write('\n')
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        raise PcoccError('unable to write checkpoint manifest: '
+                         '{0}'.format(err))
+
+def read_manifest(ckpt_dir):
+    """Reads the manifest of a checkpoint
+
+    Checkpoints without a manifest were compressed with lzop.
+
+    """
+    try:
+        with open(manifest_path(ckpt_dir)) as f:
+            manifest = json.load(f)
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            return {'version': 0,
+                    'memory': {'codec': 'lzop', 'level': None}}
+        raise PcoccError('unable to read checkpoint manifest: '
+                         '{0}'.format(err))
+    except ValueError as err:
+        raise PcoccError('invalid checkpoint manifest: {0}'.format(err))
+
+    if manifest.get('version', 0) > MANIFEST_VERSION:
+        raise PcoccError('checkpoint manifest version {0} is not '
+                         'supported'.format(manifest['version']))
+    return manifest
+
+def estimate_downtime(status):
+    """Estimates the time to write the remaining memory of a VM
+
+    status is the output of the query-migrate monitor command. The
+    estimate is based on the throughput of the last pass. Returns
+    None if it is not known yet.
+
+    """
+    # The memory is entirely written once held before switchover
+    if status.get('status') in ['completed', 'pre-switchover']:
+        return 0.
+
+    ram = status.get('ram', {})
+    if ram.get('mbps'):
+        return ram.get('remaining', 0) * 8 / (ram['mbps'] * 1e6)
+
+    if 'expected-downtime' in status:
+        return status['expected-downtime'] / 1000.
+
+    return None
+
+def precopy_ready(statuses, max_downtime, max_passes=LIVE_CKPT_MAX_PASSES):
+    """Checks if VMs in live pre-copy can be paused
+
+    VMs are ready when each of them has written its memory at least
+    once and is expected to write the remaining memory within
+    max_downtime. If some VMs do not converge, VMs are still paused
+    once all have made max_passes passes. Returns whether VMs should
+    be paused and whether they converged.
+
+    """
+    converged = True
+    for status in statuses:
+        if status.get('status') in ['completed', 'pre-switchover']:
+            continue
+
+        passes = status.get('ram', {}).get('dirty-sync-count', 0)
+        downtime = estimate_downtime(status)
+        if passes >= 2 and downtime is not None and downtime <= max_downtime:
+            continue
+
+        converged = False
+        if passes < max_passes:
+            return False, False
+
+    return True, converged
+
+def is_checkpoint_disk(path):
+    return re.match(r'disk-vm\d+$', os.path.basename(path)) is not None
+
+def checkpoint_disks(ckpt_dir):
+    """Returns the names of the disk images of a checkpoint"""
+    return sorted((name for name in os.listdir(ckpt_dir)
+                   if is_checkpoint_disk(name)),
+                  key=lambda name: int(name[len('disk-vm'):]))
+
+def image_chain(path):
+    """Returns the information of the images in the backing chain of path
+
+    The image itself comes first.
+
+    """
+    try:
+        output = subprocess_check_output(['qemu-img', 'info',
+                                          '--backing-chain',
+                                          '--output=json', path])
+    except (OSError, subprocess.CalledProcessError) as err:
+        raise PcoccError('unable to read backing chain of {0}: '
+                         '{1}'.format(path, err))
+    return json.loads(output)
+
+def consolidation_base(chain):
+    """Returns the image a checkpoint disk must be rebased on
+
+    The base is the first image of the chain which is not a
+    checkpoint disk, or None if the disk should be standalone.
+    Returns False if the disk is already based on it.
+
+    """
+    for i, image in enumerate(chain[1:]):
+        if not is_checkpoint_disk(image['filename']):
+            if i == 0:
+                return False
+            return image
+
+    if len(chain) == 1:
+        return False
+    return None
+
+def consolidate_disk(path):
+    """Merges the checkpoint disks of the backing chain into a disk
+
+    Returns the new backing file, or False if there was nothing to
+    merge.
+
+    """
+    base = consolidation_base(image_chain(path))
+    if base is False:
+        return False
+
+    if base is None:
+        cmd = ['qemu-img', 'rebase', '-b', '', path]
+    else:
+        cmd = ['qemu-img', 'rebase', '-b', base['filename'],
+               '-F', base['format'], path]
+
+    try:
+        subprocess_check_output(cmd, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as err:
+        raise PcoccError('unable to rebase {0}: {1}'.format(path, err))
+
+    if base is None:
+        return None
+    return base['filename']
@@ -0,0 +1,207 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Cloud-init NoCloud seed images
+
+Seed images are ISO9660 filesystems with Joliet extensions for long
+file names, labeled cidata. They are built in memory and cached by
+content so that VMs with the same user-data share a single read-only
+image. Settings which differ between VMs, such as the hostname, are
+passed to cloud-init through the SMBIOS serial number instead.
+
+"""
+
+import os
+import re
+import errno
+import struct
+import hashlib
+import tempfile
+
+SECTOR_SIZE = 2048
+SEED_VOLUME_ID = 'cidata'
+
+# Sectors of the descriptors and metadata, file data follows
+_PVD_SECTOR = 16
+_SVD_SECTOR = 17
+_TERMINATOR_SECTOR = 18
+_PATH_TABLES_SECTOR = 19
+_ISO_ROOT_SECTOR = 23
+_JOLIET_ROOT_SECTOR = 24
+_DATA_SECTOR = 25
+
+# Unspecified dates keep images identical for identical contents
+_UNSPECIFIED_DATE = '0' * 16 + '\0'
+_RECORD_DATE = struct.pack('7B', 70, 1, 1, 0, 0, 0, 0)
+
+# Escape sequence of the UCS-2 level 3 Joliet character set
+_JOLIET_ESCAPE = '%/E'
+
+def _both16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+def _both32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+def _sectors(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+def _pad(data, size, fill=' '):
+    return (data + fill * size)[:size]
+
+def _ucs2(name):
+    return name.decode('ascii').encode('utf-16-be')
+
+def _iso_name(name, used):
+    """Returns a unique ISO9660 level 1 file identifier for name"""
+    base, _, ext = name.upper().partition('.')
+    base = re.sub('[^A-Z0-9_]', '_', base)[:8]
+    ext = re.sub('[^A-Z0-9_]', '_', ext)[:3]
+    ident = '{0}.{1};1'.format(base, ext)
+    count = 0
+    while ident in used:
+        count += 1
+        suffix = str(count)
+        ident = '{0}{1}.{2};1'.format(base[:8 - len(suffix)], suffix, ext)
+    used.add(ident)
+    return ident
+
+def _dir_record(ident, extent, size, is_dir=False):
+    length = 33 + len(ident) + (1 - len(ident) % 2)
+    record = (struct.pack('BB', length, 0) + _both32(extent) +
+              _both32(size) + _RECORD_DATE +
+              struct.pack('BBB', 2 if is_dir else 0, 0, 0) + _both16(1) +
+              struct.pack('B', len(ident)) + ident)
+    return _pad(record, length, '\0')
+
+def _directory(root_sector, entries):
+    """Returns the root directory sector with entries
+
+    entries are (identifier, extent, size) tuples sorted by
+    identifier.
+
+    """
+    data = (_dir_record('\0', root_sector, SECTOR_SIZE, True) +
+            _dir_record('\1', root_sector, SECTOR_SIZE, True))
+    for ident, extent, size in entries:
+        data += _dir_record(ident, extent, size)
+    if len(data) > SECTOR_SIZE:
+        raise ValueError('too many files in seed image')
+    return _pad(data, SECTOR_SIZE, '\0')
+
+def _path_table(root_sector, big_endian):
+    fmt = '>IH' if big_endian else '<IH'
+    return struct.pack('BB', 1, 0) + struct.pack(fmt, root_sector, 1) + '\0\0'
+
+def _volume_descriptor(joliet, volume_id, total_sectors):
+    if joliet:
+        vd_type, text = 2, lambda s, n: _pad(_ucs2(s), n, '\0 ')
+        root_sector, escape = _JOLIET_ROOT_SECTOR, _JOLIET_ESCAPE
+        path_sector = _PATH_TABLES_SECTOR + 2
+    else:
+        vd_type, text = 1, _pad
+        root_sector, escape = _ISO_ROOT_SECTOR, ''
+        path_sector = _PATH_TABLES_SECTOR
+
+    path_table_size = len(_path_table(0, False))
+    data = (struct.pack('B', vd_type) + 'CD001' + struct.pack('BB', 1, 0) +
+            text('', 32) + text(volume_id, 32) + '\0' * 8 +
+            _both32(total_sectors) + _pad(escape, 32, '\0') +
+            _both16(1) + _both16(1) + _both16(SECTOR_SIZE) +
+            _both32(path_table_size) +
+            struct.pack('<II', path_sector, 0) +
+            struct.pack('>II', path_sector + 1, 0) +
+            _dir_record('\0', root_sector, SECTOR_SIZE, True) +
+            text('', 128) * 4 + text('', 37) * 3 +
+            _UNSPECIFIED_DATE * 4 + struct.pack('BB', 1, 0))
+    return _pad(data, SECTOR_SIZE, '\0')
+
+def make_iso(volume_id, files):
+    """Returns an ISO9660 image with Joliet names holding files
+
+    files is a list of (name, data) tuples stored in the root
+    directory.
+
+    """
+    files = sorted(files)
+    extents = []
+    sector = _DATA_SECTOR
+    for _, data in files:
+        extents.append(sector)
+        sector += _sectors(len(data))
+    total_sectors = sector
+
+    used = set()
+    iso_entries = sorted((_iso_name(name, used), extent, len(data))
+                         for (name, data), extent in zip(files, extents))
+    joliet_entries = sorted((_ucs2(name), extent, len(data))
+                            for (name, data), extent in zip(files, extents))
+
+    image = ['\0' * SECTOR_SIZE * _PVD_SECTOR,
+             _volume_descriptor(False, volume_id, total_sectors),
+             _volume_descriptor(True, volume_id, total_sectors),
+             _pad('\xffCD001\x01', SECTOR_SIZE, '\0')]
+    for root_sector in (_ISO_ROOT_SECTOR, _JOLIET_ROOT_SECTOR):
+        for big_endian in (False, True):
+            image.append(_pad(_path_table(root_sector, big_endian),
+                              SECTOR_SIZE, '\0'))
+    image.append(_directory(_ISO_ROOT_SECTOR, iso_entries))
+    image.append(_directory(_JOLIET_ROOT_SECTOR, joliet_entries))
+    for _, data in files:
+        image.append(_pad(data, _sectors(len(data)) * SECTOR_SIZE, '\0'))
+
+    return ''.join(image)
+
+def smbios_serial(hostname):
+    """Returns a SMBIOS serial number passing hostname to cloud-init"""
+    return 'ds=nocloud;h={0}'.format(hostname)
+
+def seed_image(cache_dir, user_data, meta_data):
+    """Returns the path of a seed image in cache_dir
+
+    The image is named after a hash of its content and only built if
+    it is not already cached.
+
+    """
+    digest = hashlib.sha256()
+    for data in (user_data, meta_data):
+        digest.update('{0}\0'.format(len(data)))
+        digest.update(data)
+    path = os.path.join(cache_dir, 'seed-{0}.iso'.format(digest.hexdigest()))
+
+    if os.path.exists(path):
+        return path
+
+    try:
+        os.mkdir(cache_dir, 0o700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(make_iso(SEED_VOLUME_ID, [('meta-data', meta_data),
+                                              ('user-data', user_data)]))
+        os.chmod(tmp_path, 0o400)
+        os.rename(tmp_path, path)
+    except (OSError, IOError):
+        os.unlink(tmp_path)
+        raise
+
+    return path
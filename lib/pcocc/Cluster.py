@@ -17,17 +17,26 @@
 #  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
 
 
+import os
 import sys
-import yaml
 import time
 import logging
 from Queue import Queue
-from threading import Thread
+from threading import Thread, Lock
+
+from ClusterShell.NodeSet import NodeSet
 
 from . import Hypervisor
 from . import Batch
 from .Error import PcoccError
 from .Config import Config
+from .Misc import encode_value, decode_value, FdWriter
+from .Vsock import guest_cid
+from .Stats import StartupStats, transition
+from .Checkpoint import MemoryCompression, write_manifest
+from .Checkpoint import direct_io_supported, precopy_ready, estimate_downtime
+from .Checkpoint import DEFAULT_MAX_DOWNTIME
+from .Backports import monotonic
 from .scripts import click
 
 class InvalidClusterError(PcoccError):
@@ -50,6 +59,60 @@ class ClusterSetupError(PcoccError):
     def __init__(self, error):
         super(ClusterSetupError, self).__init__('Failed to start cluster: ' + error)
 
+class HostStateSummary(object):
+    """Incrementally updated summary of the host states of a cluster
+
+    Host states are indexed by priority so that the least advanced
+    state can be reported without going through all hosts.
+
+    """
+    def __init__(self, cluster, num_hosts):
+        self._cluster = cluster
+        self._num_hosts = num_hosts
+        self._states = {}
+        self._by_priority = {}
+        self.num_complete = 0
+
+    def update(self, changes):
+        """Applies (host rank, old value, new value) changes
+
+        Raises ClusterSetupError if a host failed.
+
+        """
+        for name, _, value in changes:
+            self._remove(name)
+            if value is not None:
+                self._add(name, self._cluster._unpack_host_state(value))
+
+    def _add(self, name, state):
+        if self._cluster._check_host_state(state):
+            self.num_complete += 1
+        self._states[name] = state
+        self._by_priority.setdefault(state['priority'], {})[name] = state
+
+    def _remove(self, name):
+        state = self._states.pop(name, None)
+        if state is None:
+            return
+
+        if state['state'] == 'complete':
+            self.num_complete -= 1
+
+        hosts = self._by_priority[state['priority']]
+        del hosts[name]
+        if not hosts:
+            del self._by_priority[state['priority']]
+
+    def status(self):
+        """Returns whether all hosts are configured and the state to show"""
+        if self.num_complete == self._num_hosts:
+            return True, next(self._states.itervalues())
+        elif len(self._states) != self._num_hosts:
+            return False, self._cluster._unpack_host_state(None)
+        else:
+            hosts = self._by_priority[min(self._by_priority)]
+            return False, next(hosts.itervalues())
+
 class Worker(Thread):
     """Thread executing tasks from a given tasks queue"""
     def __init__(self, pool):
@@ -87,17 +150,149 @@ class ThreadPool(object):
         if self.exception is not None:
             raise self.exception # pylint: disable-msg=E0702
 
-def do_checkpoint_vm(vm, ckpt_dir):
-    vm.checkpoint(ckpt_dir)
+# Default maximum number of commands executed concurrently
+DEFAULT_EXEC_FANOUT = 64
 
-def do_save_vm(vm, ckpt_dir):
+def fold_vm_names(indexes):
+    """Returns the folded names of a list of VM indexes"""
+    return str(NodeSet.fromlist(['vm%d' % index for index in indexes]))
+
+class ExecOutput(object):
+    """Output of a command executed on several VMs
+
+    By default, output is streamed as it arrives, with each line
+    prefixed by the VM name if prefix is set. In gathered mode,
+    outputs are printed once all commands have completed and VMs with
+    identical outputs are folded together. Exit codes and errors are
+    summarized in both modes, on the error stream.
+
+    Without prefix nor gathering, outputs are written directly to the
+    file descriptor of the output stream, if it has one.
+
+    """
+    def __init__(self, prefix=True, gather=False, out=None, err=None):
+        self.prefix = prefix
+        self.gather = gather
+        self._out = out or sys.stdout
+        self._err = err or sys.stderr
+        self._lock = Lock()
+        self._partial = {}
+        self._exits = {}
+        self._errors = {}
+
+    def writer(self, index):
+        """Returns a function writing the output of a VM"""
+        if not self.prefix and not self.gather:
+            try:
+                fd = self._out.fileno()
+            except (AttributeError, ValueError):
+                pass
+            else:
+                self._out.flush()
+                return FdWriter(fd)
+
+        return lambda data: self.write(index, data)
+
+    def write(self, index, data):
+        with self._lock:
+            if not self.prefix and not self.gather:
+                self._out.write(data)
+                self._out.flush()
+                return
+
+            # Chunks are only joined once complete lines are available
+            # (or at the end in gathered mode) to keep appends linear
+            chunks = self._partial.setdefault(index, [])
+            if self.gather or '\n' not in data:
+                chunks.append(data)
+                return
+
+            head, _, tail = data.rpartition('\n')
+            chunks.append(head)
+            lines = ''.join(chunks).split('\n')
+            self._partial[index] = [tail]
+            for line in lines:
+                self._out.write('vm%d: %s\n' % (index, line))
+            self._out.flush()
+
+    def exit(self, index, status):
+        with self._lock:
+            self._exits[index] = status
+
+    def error(self, index, err):
+        with self._lock:
+            self._errors[index] = str(err)
+
+    @property
+    def status(self):
+        """Aggregated exit code: the highest one or 255 on errors"""
+        codes = self._exits.values()
+        if self._errors:
+            codes.append(255)
+        return max(codes or [0])
+
+    def _write_groups(self, stream, values, fmt):
+        """Writes values grouped by VMs with the same value
+
+        fmt is called with the folded VM names, the number of VMs and
+        the value of each group.
+
+        """
+        groups = {}
+        for index, value in values.iteritems():
+            groups.setdefault(value, []).append(index)
+
+        for value, indexes in sorted(groups.iteritems(),
+                                     key=lambda group: min(group[1])):
+            stream.write(fmt(fold_vm_names(indexes), len(indexes), value))
+
+    def close(self):
+        """Flushes buffered output and writes the exit code summary"""
+        with self._lock:
+            if self.gather:
+                outputs = dict((index, ''.join(chunks)) for index, chunks
+                               in self._partial.iteritems())
+                outputs = dict((index, data) for index, data
+                               in outputs.iteritems() if data)
+                for index, data in outputs.iteritems():
+                    if not data.endswith('\n'):
+                        outputs[index] = data + '\n'
+                separator = '-' * 15 + '\n'
+                self._write_groups(self._out, outputs,
+                                   lambda names, count, data:
+                                   '%s%s (%d)\n%s%s' % (separator, names,
+                                                         count, separator,
+                                                         data))
+            elif self.prefix:
+                for index, chunks in sorted(self._partial.iteritems()):
+                    data = ''.join(chunks)
+                    if data:
+                        self._out.write('vm%d: %s\n' % (index, data))
+            self._partial = {}
+            self._out.flush()
+
+            self._write_groups(self._err,
+                               dict((index, status) for index, status
+                                    in self._exits.iteritems() if status),
+                               lambda names, _, status:
+                               '%s: exit %d\n' % (names, status))
+            self._write_groups(self._err, self._errors,
+                               lambda names, _, err:
+                               '%s: %s\n' % (names, err))
+
+def do_checkpoint_vm(vm, ckpt_dir, compression, direct):
+    vm.checkpoint(ckpt_dir, compression, direct)
+
+def do_save_vm(vm, ckpt_dir, disks):
     if not vm.image_dir is None:
-        vm.save(vm.checkpoint_img_file(ckpt_dir),
-                freeze=Hypervisor.VM_FREEZE_OPT.NO)
+        disks['vm%d' % vm.rank] = vm.checkpoint_disk(ckpt_dir)
 
 def do_quit_vm(vm):
     vm.quit()
 
+def do_resume_vm(vm):
+    vm.resume()
+
 
 class VM(object):
     def __init__(self, rank, template):
@@ -131,18 +326,34 @@ class VM(object):
     def run(self, ckpt_dir=None):
         Config().hyp.run(self, ckpt_dir)
 
-    def exec_cmd(self, cmd, user):
-        return Config().hyp.exec_cmd(self, cmd, user)
+    def exec_cmd(self, cmd, user, output=None):
+        return Config().hyp.exec_cmd(self, cmd, user, output)
 
-    def put_file(self, source, dest):
-        return Config().hyp.put_file(self, source, dest)
+    def put_file(self, source, dest, progress=None):
+        return Config().hyp.put_file(self, source, dest, progress)
 
-    def checkpoint(self, ckpt_dir):
-        Config().hyp.checkpoint(self, ckpt_dir)
+    def get_file(self, source, dest, recursive=False, progress=None):
+        return Config().hyp.get_file(self, source, dest, recursive, progress)
+
+    def read_console_log(self, request, output):
+        return Config().hyp.read_console_log(self, request, output)
+
+    def checkpoint(self, ckpt_dir, compression, direct=False):
+        Config().hyp.checkpoint(self, ckpt_dir, compression, direct)
+
+    def checkpoint_disk(self, ckpt_dir):
+        return Config().hyp.checkpoint_disk(self, ckpt_dir)
+
+    def live_checkpoint(self, ckpt_dir, compression, direct=False):
+        return Config().hyp.live_checkpoint(self, ckpt_dir, compression,
+                                            direct)
 
     def save(self, dest_file, full=False, freeze=Hypervisor.VM_FREEZE_OPT.TRY):
         Config().hyp.save(self, dest_file, full, freeze)
 
+    def resume(self):
+        Config().hyp.resume(self)
+
     def quit(self):
         Config().hyp.quit(self)
 
@@ -215,6 +426,14 @@ class VM(object):
     def remote_display(self):
         return self._template.remote_display
 
+    @property
+    def vsock(self):
+        return self._template.vsock
+
+    @property
+    def vsock_cid(self):
+        return guest_cid(Config().batch.batchid, self.rank)
+
     @property
     def wait_for_poweroff(self):
         if self._template.persistent_drives:
@@ -256,6 +475,7 @@ class Cluster(object):
     def __init__(self, template_string, vms_per_node="", resource_only=False):
         self.vms = VMList()
         self.resource_definition = ""
+        self._host_history = {}
         self.definition = template_string
         count = 0
 
@@ -300,20 +520,29 @@ class Cluster(object):
                                  None)
             raise
         try:
-            for net in Config().vnets.values():
-                net.alloc_node_resources(self)
-
-        except Exception as e:
-            self._set_host_state('failed',
-                                 -1,
-                                 'failed to setup network ' + net.name,
-                                 str(e))
-            raise
+            try:
+                for net in Config().vnets.values():
+                    net.alloc_node_resources(self)
 
-        self._set_host_state('complete',
-                             2,
-                             'done',
-                             None)
+            except Exception as e:
+                self._set_host_state('failed',
+                                     -1,
+                                     'failed to setup network ' + net.name,
+                                     str(e))
+                raise
+
+            self._set_host_state('complete',
+                                 2,
+                                 'done',
+                                 None)
+        finally:
+            # Network resources are normally written along with the
+            # host state but they must be recorded to be freed later
+            # even if it could not be updated
+            try:
+                Config().batch.flush_deferred_writes()
+            except Exception as e:
+                logging.error('Unable to record network resources: %s', e)
 
     def free_node_resources(self):
         Config().batch.cleanup_cluster_keys()
@@ -335,49 +564,255 @@ class Cluster(object):
     def run(self, ckpt_dir=None):
         self.vms[Config().batch.task_rank].run(ckpt_dir)
 
-    def exec_cmd(self, vmid_list, cmd, user):
-        #TODO: This should be launched in parallel ala clush
-        ret=[]
-        for vmid in vmid_list:
-            ret.append(self.vms[vmid].exec_cmd(cmd, user))
+    def _run_on_vms(self, vmid_list, func, output, fanout):
+        """Calls func on each VM of a list concurrently
 
-        return ret
+        At most fanout calls are made at the same time. Errors are
+        reported to output, an ExecOutput. Returns the list of results,
+        with None for VMs where func failed.
 
-    def checkpoint(self, ckpt_dir):
-        pool = ThreadPool(16)
+        """
+        ret = {}
+        def run_on_vm(vmid):
+            ret[vmid] = func(self.vms[vmid])
 
-        print "Checkpointing disks..."
-        for vm in self.vms:
-            pool.add_task(do_save_vm, vm, ckpt_dir)
-        pool.wait_completion()
+        def try_run_on_vm(vmid):
+            try:
+                run_on_vm(vmid)
+            except PcoccError as err:
+                ret[vmid] = None
+                output.error(vmid, err)
 
-        print "Checkpointing memory..."
-        for vm in self.vms:
-            pool.add_task(do_checkpoint_vm, vm, ckpt_dir)
+        if len(vmid_list) == 1:
+            # Errors are raised and the command can be interrupted
+            try:
+                run_on_vm(vmid_list[0])
+            finally:
+                output.close()
+            return [ret[vmid_list[0]]]
+
+        pool = ThreadPool(min(fanout, len(vmid_list)))
+        for vmid in vmid_list:
+            pool.add_task(try_run_on_vm, vmid)
         pool.wait_completion()
+        output.close()
+
+        return [ret[vmid] for vmid in vmid_list]
+
+    def exec_cmd(self, vmid_list, cmd, user, output=None,
+                 fanout=DEFAULT_EXEC_FANOUT, script=None):
+        """Executes a command on a list of VMs concurrently
+
+        At most fanout commands are executed at the same time. If
+        script is set, this file is first copied to /tmp in each VM.
+        Outputs, exit codes and errors are reported to output, an
+        ExecOutput. Returns the list of exit codes, with None for VMs
+        where the command could not be executed.
+
+        """
+        if output is None:
+            output = ExecOutput(prefix=len(vmid_list) > 1)
+
+        def run(vm):
+            if script:
+                vm.put_file(script, '/tmp/%s' % os.path.basename(script))
+            ret = vm.exec_cmd(cmd, user, output.writer(vm.rank))
+            output.exit(vm.rank, ret)
+            return ret
+
+        return self._run_on_vms(vmid_list, run, output, fanout)
+
+    def put_file(self, vmid_list, source, dest, output=None,
+                 fanout=DEFAULT_EXEC_FANOUT, progress=None):
+        """Copies a file or directory to a list of VMs concurrently
+
+        progress is only used when copying to a single VM. Errors are
+        reported to output. Returns the list of VMs where the copy
+        failed.
+
+        """
+        if output is None:
+            output = ExecOutput()
+
+        if len(vmid_list) > 1:
+            progress = None
+
+        ret = self._run_on_vms(vmid_list,
+                               lambda vm: vm.put_file(source, dest,
+                                                      progress) or True,
+                               output, fanout)
+        return [vmid for vmid, ok in zip(vmid_list, ret) if not ok]
+
+    def console_log(self, vmid_list, request, output=None,
+                    fanout=DEFAULT_EXEC_FANOUT):
+        """Streams the console logs of a list of VMs concurrently
+
+        At most fanout logs are read at the same time. Errors are
+        reported to output. Returns the list of offsets at which each
+        log stopped, with None for VMs where it could not be read.
+
+        """
+        if output is None:
+            output = ExecOutput(prefix=len(vmid_list) > 1)
+
+        return self._run_on_vms(vmid_list,
+                                lambda vm: vm.read_console_log(
+                                    request, output.writer(vm.rank)),
+                                output, fanout)
+
+    def checkpoint(self, ckpt_dir, compression=None, live=False,
+                   max_downtime=DEFAULT_MAX_DOWNTIME, keep_running=False):
+        """Saves the disks and memory of all VMs and terminates them
+
+        Memory streams are compressed according to compression, a
+        MemoryCompression instance, which is recorded in the manifest
+        of the checkpoint. In live mode, VMs are only paused to write
+        their last dirty pages, for about max_downtime seconds. If
+        keep_running is set, VMs are resumed instead of terminated
+        and their next checkpoints only save the disk blocks written
+        in the meantime.
+
+        """
+        if compression is None:
+            compression = MemoryCompression()
+        direct = direct_io_supported(ckpt_dir)
+
+        disks = {}
+        manifest = {'memory': compression.to_manifest(),
+                    'disks': disks,
+                    'live': live}
+        if live:
+            manifest['downtime'] = self._live_checkpoint(ckpt_dir,
+                                                         compression,
+                                                         direct,
+                                                         max_downtime,
+                                                         disks)
+        else:
+            pool = ThreadPool(16)
+
+            print "Checkpointing disks..."
+            for vm in self.vms:
+                pool.add_task(do_save_vm, vm, ckpt_dir, disks)
+            pool.wait_completion()
+
+            print "Checkpointing memory..."
+            for vm in self.vms:
+                pool.add_task(do_checkpoint_vm, vm, ckpt_dir, compression,
+                              direct)
+            pool.wait_completion()
+
+        write_manifest(ckpt_dir, manifest)
+
+        pool = ThreadPool(16)
 
         print "Checkpoint complete."
         for vm in self.vms:
-            pool.add_task(do_quit_vm, vm)
+            if keep_running:
+                pool.add_task(do_resume_vm, vm)
+            else:
+                pool.add_task(do_quit_vm, vm)
         pool.wait_completion()
 
+    def _live_checkpoint(self, ckpt_dir, compression, direct, max_downtime,
+                         disks):
+        """Checkpoints the memory of VMs while they are running
+
+        Once all VMs are ready, they are paused together to write the
+        pages dirtied during the pre-copy. Disks are saved while VMs
+        are paused, before memory transfers are allowed to complete,
+        so that they match the memory images. Returns the time during
+        which VMs were paused.
+
+        """
+        ckpts = {}
+        def start(vm):
+            ckpts[vm.rank] = vm.live_checkpoint(ckpt_dir, compression, direct)
+
+        # All VMs are paused at the same time
+        pool = ThreadPool(min(len(self.vms), DEFAULT_EXEC_FANOUT))
+
+        try:
+            print "Starting memory pre-copy..."
+            for vm in self.vms:
+                pool.add_task(start, vm)
+            pool.wait_completion()
+
+            print "Pre-copying memory..."
+            while True:
+                statuses = [ckpts[vm.rank].progress() for vm in self.vms]
+                ready, converged = precopy_ready(statuses, max_downtime)
+                if ready:
+                    break
+
+                remaining = sum(s.get('ram', {}).get('remaining', 0)
+                                for s in statuses)
+                downtimes = [estimate_downtime(s) for s in statuses]
+                if None in downtimes:
+                    print "%d MB remaining" % (remaining // (1024 * 1024))
+                else:
+                    print ("%d MB remaining, estimated "
+                           "downtime %.1fs") % (remaining // (1024 * 1024),
+                                                max(downtimes))
+                time.sleep(1)
+
+            if not converged:
+                sys.stderr.write('Memory pre-copy did not converge, '
+                                 'downtime may exceed %gs\n' % max_downtime)
+
+            print "Pausing VMs..."
+            pause_start = monotonic()
+            for ckpt in ckpts.itervalues():
+                pool.add_task(ckpt.pause, max_downtime)
+            pool.wait_completion()
+
+            for ckpt in ckpts.itervalues():
+                pool.add_task(ckpt.wait_switchover)
+            pool.wait_completion()
+
+            print "Checkpointing disks..."
+            for vm in self.vms:
+                pool.add_task(do_save_vm, vm, ckpt_dir, disks)
+            pool.wait_completion()
+
+            for ckpt in ckpts.itervalues():
+                pool.add_task(ckpt.complete)
+            pool.wait_completion()
+            downtime = monotonic() - pause_start
+        except:
+            for ckpt in ckpts.itervalues():
+                ckpt.abort()
+            raise
+        finally:
+            for ckpt in ckpts.itervalues():
+                ckpt.close()
+
+        print "VMs were paused for %.1fs" % downtime
+        return downtime
+
 
     def _set_host_state(self, state, priority, desc, value, host_rank=None):
-        Config().batch.write_key('cluster',
-                                       self._host_state_key(host_rank),
-                                       yaml.dump({'state': state,
+        history = self._host_history.setdefault(host_rank, [])
+        history.append(transition(state, desc))
+
+        # Deferred writes such as network resources are published
+        # along with the host state
+        Config().batch.write_keys([('cluster',
+                                    self._host_state_key(host_rank),
+                                    encode_value({'state': state,
                                                   'priority': priority,
                                                   'desc': desc,
-                                                  'value': value}))
+                                                  'value': value,
+                                                  'history': history}))])
 
     def _unpack_host_state(self, value):
         if value:
-            return yaml.safe_load(value)
+            return decode_value(value)
         else:
             return {'state': 'not-started',
                     'priority': 0,
                     'desc': 'waiting for batch manager',
-                    'value': None}
+                    'value': None,
+                    'history': []}
 
     def _host_state_dir(self):
         return "state/hosts"
@@ -398,25 +833,22 @@ class Cluster(object):
         else:
             return False
 
-    def _check_all_host_states(self, host_states):
-        if host_states == None:
-            return False, self._unpack_host_state(host_states)
-
-        host_states = [ self._unpack_host_state(s.value)
-                        for s in host_states.children ]
+    def startup_stats(self):
+        """Returns the startup statistics of the hosts and VMs"""
+        batch = Config().batch
+        stats = StartupStats()
 
-        num_complete = sum([ 1 for s in host_states if
-                             self._check_host_state(s)])
-
-        if num_complete == Config().batch.num_nodes:
-            return True, host_states[0]
-        elif len(host_states) != Config().batch.num_nodes:
-            return False, self._unpack_host_state(None)
-        else:
-            return False, min(host_states,
-                                 key=lambda x: x['priority'])
+        hosts = batch.read_dir_values('cluster', self._host_state_dir())
+        for host_rank, host in enumerate(batch.nodeset):
+            state = self._unpack_host_state(hosts.get(str(host_rank)))
+            stats.add('hosts', host, host, state.get('history', []))
 
+        vm_states = Config().hyp.read_vm_states([vm.rank for vm in self.vms])
+        for vm in self.vms:
+            stats.add('vms', 'vm{0}'.format(vm.rank), vm.get_host(),
+                      vm_states[vm.rank].get('history', []))
 
+        return stats
 
     def wait_host_config(self, host_rank=None):
         """Waits for hosts to be configured"""
@@ -428,9 +860,7 @@ class Cluster(object):
         i = 0
         for i in range(5):
             try:
-                host_states, index = batch.read_dir_index(
-                    'cluster',
-                    self._host_state_dir())
+                watcher = batch.watch_dir('cluster', self._host_state_dir())
                 break
             except Batch.KeyCredentialError:
                 if i == 0:
@@ -445,7 +875,11 @@ class Cluster(object):
             sys.stderr.write('User credentials added to keystore: '
                              'welcome to pcocc !\n')
 
-        done, last_state = self._check_all_host_states(host_states)
+        summary = HostStateSummary(self, batch.num_nodes)
+        summary.update([(name, None, value) for name, value
+                        in watcher.children.iteritems()])
+
+        done, last_state = summary.status()
         if done:
             return
 
@@ -463,16 +897,9 @@ class Cluster(object):
                 bar.update(0)
 
             while True:
-                batch.wait_key_index(
-                    'cluster',
-                    self._host_state_dir(),
-                    index)
-
-                host_states, index = batch.read_dir_index(
-                    'cluster',
-                    self._host_state_dir())
+                summary.update(watcher.wait())
 
-                done, last_state = self._check_all_host_states(host_states)
+                done, last_state = summary.status()
                 bar.current_item = last_state
                 if sys.stderr.isatty():
                     bar.update(1)
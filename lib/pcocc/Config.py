@@ -28,6 +28,7 @@ from .NetUtils import Tracker
 
 DEFAULT_CONF_DIR = '/etc/pcocc'
 DEFAULT_RUN_DIR = '/var/run/pcocc'
+DEFAULT_NODE_DIR = '/var/run/pcocc-node'
 DEFAULT_USER_CONF_DIR = os.environ.get('PCOCC_USER_CONF_DIR', '%homedir/.pcocc/')
 PCOCC_DEBUG_FLAG = False
 CKPT_RETRY_COUNT = 1
@@ -76,6 +77,8 @@ class Config(object):
         self.conf_dir = DEFAULT_CONF_DIR
         self._verbose = 0
         self._run_dir = DEFAULT_RUN_DIR
+        self._node_dir = DEFAULT_NODE_DIR
+        self._topology = None
 
     def load(self, conf_dir=DEFAULT_CONF_DIR, jobid=None, jobname=None,
              default_jobname=None, process_type=None, batchuser=None):
@@ -120,6 +123,12 @@ class Config(object):
         self.tracker = Tracker(os.path.join(self._run_dir,
                                             'net_tracker.db'))
 
+    def save_topology(self):
+        # The run dir is private, store node information which must be
+        # readable by users in a separate directory
+        self._init_node_dir()
+        Topology.Topology.detect().save(self.topology_file)
+
     def config_node(self):
         for vnet in self.vnets:
             self.vnets[vnet].init_node()
@@ -171,6 +180,36 @@ class Config(object):
                 raise
         os.chmod(self._run_dir, 0o700)
 
+    def _init_node_dir(self):
+        try:
+            os.makedirs(self._node_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        os.chmod(self._node_dir, 0o755)
+
+    @property
+    def topology_file(self):
+        return os.path.join(self._node_dir, 'topology')
+
+    @property
+    def topology(self):
+        """Topology of the current node
+
+        The topology saved at node setup is used if available, otherwise
+        it is detected with lstopo. The result is kept for the lifetime
+        of the process.
+
+        """
+        if self._topology is None:
+            topology = Topology.Topology.load(self.topology_file)
+            if topology is None:
+                logging.debug('Node topology not available, running lstopo')
+                topology = Topology.Topology.detect()
+            self._topology = topology
+
+        return self._topology
+
     @property
     def verbose(self):
         return self._verbose
@@ -201,3 +240,4 @@ from . import Resources # pylint: disable=W0611
 from . import Templates # pylint: disable=W0611
 from . import Batch
 from . import Hypervisor
+from . import Topology
@@ -0,0 +1,713 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""VM console proxy
+
+The serial console of a VM is proxied to a single interactive client
+and to any number of read-only watchers, while its output is kept in
+a log of bounded size on the host.
+
+The log is served by the proxy to clients which send a request
+selecting a window of the log. Positions in the log are absolute byte
+offsets since the VM started, which remain valid when older output is
+discarded.
+
+"""
+
+import os
+import json
+import time
+import errno
+import bisect
+import socket
+import select
+import logging
+from collections import deque
+
+from .Backports import monotonic
+from .Misc import FdWriter, IO_BUFFER_SIZE
+
+# Maximum size of the console log including its previous segment
+CONSOLE_LOG_MAX_SIZE = 32 * 1024 * 1024
+
+# Console output is written to the log in batches of this size or
+# after this number of seconds
+CONSOLE_LOG_FLUSH_SIZE = 256 * 1024
+CONSOLE_LOG_FLUSH_INTERVAL = 1
+
+# Clients which cannot keep up with the console output are
+# disconnected once this amount of data is pending
+CONSOLE_CLIENT_MAX_PENDING = 4 * 1024 * 1024
+
+# Resolution in seconds of the time index of the log. The resolution
+# is halved when the index reaches its maximum size.
+CONSOLE_LOG_INDEX_INTERVAL = 1
+CONSOLE_LOG_INDEX_MAX_SIZE = 64 * 1024
+
+# Size of the chunks read when looking for line starts
+CONSOLE_LOG_SCAN_SIZE = 64 * 1024
+
+CONSOLE_LOG_MAX_REQUEST = 4096
+
+class ConsoleLogReader(object):
+    """Reads a snapshot of the console log segments
+
+    Segments are opened when the reader is created so that they can
+    be read even if the log is rotated afterwards.
+
+    """
+    def __init__(self, segments):
+        self.start = segments[0][1]
+        self.end = segments[-1][2]
+        self._segments = []
+        try:
+            for path, start, end in segments:
+                if end > start:
+                    self._segments.append((os.open(path, os.O_RDONLY),
+                                           start, end))
+        except OSError:
+            self.close()
+            raise
+
+    def read(self, offset, size):
+        """Reads up to size bytes at an absolute offset"""
+        data = []
+        end = min(offset + size, self.end)
+        for fd, seg_start, seg_end in self._segments:
+            while seg_start <= offset < min(seg_end, end):
+                os.lseek(fd, offset - seg_start, os.SEEK_SET)
+                chunk = os.read(fd, min(seg_end, end) - offset)
+                if not chunk:
+                    return ''.join(data)
+                data.append(chunk)
+                offset += len(chunk)
+        return ''.join(data)
+
+    def line_start(self, end, count):
+        """Returns the offset of the last count lines before end"""
+        if count <= 0 or end <= self.start:
+            return end
+
+        # A newline at the end terminates the last line
+        newlines = count
+        if self.read(end - 1, 1) == '\n':
+            newlines += 1
+
+        pos = end
+        while pos > self.start:
+            size = min(CONSOLE_LOG_SCAN_SIZE, pos - self.start)
+            data = self.read(pos - size, size)
+            found = data.count('\n')
+            if found >= newlines:
+                index = len(data)
+                for _ in xrange(newlines):
+                    index = data.rindex('\n', 0, index)
+                return pos - size + index + 1
+            newlines -= found
+            pos -= size
+
+        return self.start
+
+    def close(self):
+        for fd, _, _ in self._segments:
+            os.close(fd)
+        self._segments = []
+
+class ConsoleLog(object):
+    """Size-capped log of the console output
+
+    Output is buffered and written in large batches. When the log
+    file reaches half the maximum size, it replaces the previous
+    segment at path.1 and a new file is started so that the most
+    recent output is always kept.
+
+    The wall clock time at which output is received is indexed with
+    a resolution of CONSOLE_LOG_INDEX_INTERVAL to select output by
+    time.
+
+    """
+    def __init__(self, path, max_size=CONSOLE_LOG_MAX_SIZE,
+                 flush_size=CONSOLE_LOG_FLUSH_SIZE,
+                 flush_interval=CONSOLE_LOG_FLUSH_INTERVAL):
+        self.path = path
+        self._segment_size = max(max_size // 2, 1)
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._pending = []
+        self._pending_size = 0
+        self._pending_since = None
+
+        # Absolute offsets of the segments and of the end of the log
+        self._previous_start = None
+        self._segment_start = 0
+        self.end = 0
+
+        # Wall clock times and offsets of received output
+        self._index_times = []
+        self._index_offsets = []
+
+        try:
+            os.unlink(self._previous_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        self._open()
+
+    @property
+    def _previous_path(self):
+        return self.path + '.1'
+
+    def _open(self):
+        self._fd = os.open(self.path,
+                           os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        self._write = FdWriter(self._fd)
+        self._size = 0
+
+    def _rotate(self):
+        os.close(self._fd)
+        os.rename(self.path, self._previous_path)
+        self._previous_start = self._segment_start
+        self._segment_start += self._size
+        self._open()
+
+        # Keep the last index entry before the start of the log
+        first = bisect.bisect_right(self._index_offsets, self.start) - 1
+        if first > 0:
+            del self._index_times[:first]
+            del self._index_offsets[:first]
+
+    @property
+    def start(self):
+        """Absolute offset of the oldest output kept"""
+        if self._previous_start is None:
+            return self._segment_start
+        return self._previous_start
+
+    def write(self, data):
+        now = time.time()
+        if (not self._index_times or
+            now - self._index_times[-1] >= CONSOLE_LOG_INDEX_INTERVAL):
+            self._index_times.append(now)
+            self._index_offsets.append(self.end)
+            if len(self._index_times) > CONSOLE_LOG_INDEX_MAX_SIZE:
+                self._index_times = self._index_times[::2]
+                self._index_offsets = self._index_offsets[::2]
+        self.end += len(data)
+
+        if not self._pending:
+            self._pending_since = monotonic()
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self._flush_size:
+            self.flush()
+
+    def timeout(self):
+        """Returns the number of seconds until buffered data is due
+
+        Returns None if there is no buffered data.
+
+        """
+        if not self._pending:
+            return None
+        return max(self._pending_since + self._flush_interval - monotonic(),
+                   0)
+
+    def flush_if_due(self):
+        if self._pending and self.timeout() == 0:
+            self.flush()
+
+    def flush(self):
+        data = ''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+
+        offset = 0
+        while offset < len(data):
+            count = min(len(data) - offset, self._segment_size - self._size)
+            self._write(buffer(data, offset, count))
+            offset += count
+            self._size += count
+            if self._size >= self._segment_size:
+                self._rotate()
+
+    def offset_at(self, wall_time, after=False):
+        """Returns the offset of the output received from wall_time
+
+        If after is set, output received at wall_time is excluded
+        instead.
+
+        """
+        if after:
+            index = bisect.bisect_right(self._index_times, wall_time)
+        else:
+            index = bisect.bisect_left(self._index_times, wall_time)
+
+        if index == len(self._index_offsets):
+            return self.end
+        return max(self._index_offsets[index], self.start)
+
+    def reader(self):
+        """Returns a reader for all the output logged so far"""
+        self.flush()
+        segments = []
+        if self._previous_start is not None:
+            segments.append((self._previous_path, self._previous_start,
+                             self._segment_start))
+        segments.append((self.path, self._segment_start, self.end))
+        return ConsoleLogReader(segments)
+
+    def window(self, reader, request):
+        """Returns the start and end offsets of a log request
+
+        The request is a dict which may restrict the window to output
+        received 'since' and 'until' wall clock times, starting at an
+        absolute 'offset', and to the last 'lines' or 'bytes'.
+
+        """
+        start, end = reader.start, reader.end
+        if request.get('until') is not None:
+            end = min(end, self.offset_at(request['until'], after=True))
+        if request.get('since') is not None:
+            start = max(start, self.offset_at(request['since']))
+        if request.get('offset') is not None:
+            start = max(start, request['offset'])
+        if request.get('bytes') is not None:
+            start = max(start, end - request['bytes'])
+        if request.get('lines') is not None:
+            start = max(start, reader.line_start(end, request['lines']))
+
+        return min(start, end), end
+
+    def close(self):
+        self.flush()
+        os.close(self._fd)
+
+class _ConsoleClient(object):
+    # Whether the client receives the console output as it arrives
+    live = True
+
+    def __init__(self, sock, read_only):
+        self.sock = sock
+        self.read_only = read_only
+        self.pending = deque()
+        self.pending_size = 0
+        sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def _send(self, data):
+        try:
+            return self.sock.send(data)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return 0
+            raise
+
+    def send(self, data):
+        """Sends or buffers data
+
+        Returns True if data remains to be sent.
+
+        """
+        if not self.pending:
+            count = self._send(data)
+            if count == len(data):
+                return False
+            data = data[count:]
+
+        self.pending.append(data)
+        self.pending_size += len(data)
+        return True
+
+    def send_pending(self):
+        """Sends as much buffered data as possible
+
+        Returns True if data remains to be sent.
+
+        """
+        while self.pending:
+            data = self.pending[0]
+            count = self._send(data)
+            self.pending_size -= count
+            if count < len(data):
+                self.pending[0] = data[count:]
+                return True
+            self.pending.popleft()
+        return False
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+class _LogClient(_ConsoleClient):
+    """Client streaming a window of the console log
+
+    Followers become live clients once they have caught up with the
+    end of the log.
+
+    """
+    live = False
+
+    def __init__(self, sock):
+        super(_LogClient, self).__init__(sock, True)
+        self.request = None
+        self.request_data = ''
+        self.reader = None
+        self.position = None
+        self.end = None
+
+    def close(self):
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+        super(_LogClient, self).close()
+
+def parse_log_request(data):
+    """Validates a log request sent by a client"""
+    try:
+        request = json.loads(data)
+    except ValueError:
+        raise ValueError('invalid request')
+
+    if not isinstance(request, dict):
+        raise ValueError('invalid request')
+
+    for key, value in request.iteritems():
+        # Booleans are integers for isinstance
+        number = not isinstance(value, bool)
+        if key == 'follow':
+            valid = isinstance(value, bool)
+        elif key in ('since', 'until'):
+            valid = value is None or (
+                number and isinstance(value, (int, long, float)))
+        elif key in ('offset', 'lines', 'bytes'):
+            valid = value is None or (
+                number and isinstance(value, (int, long)) and value >= 0)
+        else:
+            raise ValueError('unknown request field ' + key)
+
+        if not valid:
+            raise ValueError('invalid value for ' + key)
+
+    return request
+
+class ConsoleProxy(object):
+    """Proxies a VM console with epoll
+
+    The output of the console is sent to all connected clients and to
+    the log. Input is only accepted from the client connected to the
+    interactive listener, which accepts a new client once the current
+    one disconnects. Clients connected to the watch listener are
+    read-only.
+
+    Clients connected to the log listener send a request on a single
+    line and receive a header line with the 'start' and 'end' offsets
+    of the selected window, followed by the output in the window. The
+    connection is closed at the end of the window unless the client
+    asked to follow the output.
+
+    """
+    def __init__(self, console_sock, listener, watch_listener, log_listener,
+                 log):
+        self._console = console_sock
+        self._listener = listener
+        self._watch_listener = watch_listener
+        self._log = log
+        self._clients = {}
+        self._handlers = {}
+        self._interactive = None
+        self._running = False
+
+        self._epoll = select.epoll()
+        self.add_handler(console_sock.fileno(), self._read_console)
+        self.add_handler(listener.fileno(),
+                         lambda _: self._accept(listener, False))
+        self.add_handler(watch_listener.fileno(),
+                         lambda _: self._accept(watch_listener, True))
+        self.add_handler(log_listener.fileno(),
+                         lambda _: self._accept_log(log_listener))
+
+    def add_handler(self, fd, handler, events=select.EPOLLIN):
+        """Calls handler with the epoll events when fd is ready
+
+        The proxy stops if handler returns True.
+
+        """
+        self._handlers[fd] = handler
+        self._epoll.register(fd, events)
+
+    def _remove_handler(self, fd):
+        del self._handlers[fd]
+        self._epoll.unregister(fd)
+
+    def _accept(self, listener, read_only):
+        try:
+            sock, _ = listener.accept()
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR, errno.ECONNABORTED):
+                return
+            raise
+
+        client = _ConsoleClient(sock, read_only)
+        if read_only:
+            logging.debug('New watcher connexion to console')
+        else:
+            logging.debug('New client connexion to console')
+            # Only serve one interactive client at a time, others
+            # wait in the listen backlog
+            self._interactive = client
+            self._remove_handler(listener.fileno())
+
+        self._clients[client.fileno()] = client
+        self.add_handler(client.fileno(),
+                         lambda events: self._handle_client(client, events))
+
+    def _accept_log(self, listener):
+        try:
+            sock, _ = listener.accept()
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR, errno.ECONNABORTED):
+                return
+            raise
+
+        client = _LogClient(sock)
+        self._clients[client.fileno()] = client
+        self.add_handler(client.fileno(),
+                         lambda events: self._handle_log_client(client,
+                                                                events))
+
+    def _handle_log_client(self, client, events):
+        if client.live:
+            self._handle_client(client, events)
+            return
+
+        if events & select.EPOLLIN:
+            try:
+                data = client.sock.recv(CONSOLE_LOG_MAX_REQUEST)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                data = None
+
+            if not data:
+                self._disconnect(client)
+                return
+
+            if client.request is None:
+                client.request_data += data
+                if '\n' in client.request_data:
+                    self._start_log(client)
+                    return
+                elif len(client.request_data) > CONSOLE_LOG_MAX_REQUEST:
+                    self._disconnect(client)
+                    return
+
+        elif events & (select.EPOLLHUP | select.EPOLLERR):
+            self._disconnect(client)
+            return
+
+        if events & select.EPOLLOUT:
+            self._stream_log(client)
+
+    def _start_log(self, client):
+        try:
+            client.request = parse_log_request(
+                client.request_data.split('\n', 1)[0])
+            client.reader = self._log.reader()
+            client.position, client.end = self._log.window(client.reader,
+                                                           client.request)
+        except (ValueError, OSError) as err:
+            client.request = {}
+            client.position = client.end = 0
+            client.send(json.dumps({'error': str(err)}) + '\n')
+        else:
+            client.send(json.dumps({'start': client.position,
+                                      'end': client.end}) + '\n')
+
+        self._stream_log(client)
+
+    def _stream_log(self, client):
+        """Sends the log window, then live output to followers"""
+        while True:
+            try:
+                pending = client.send_pending()
+            except socket.error:
+                self._disconnect(client)
+                return
+
+            if pending:
+                self._epoll.modify(client.fileno(),
+                                   select.EPOLLIN | select.EPOLLOUT)
+                return
+
+            if client.position < client.end:
+                data = client.reader.read(client.position,
+                                          min(client.end - client.position,
+                                              IO_BUFFER_SIZE))
+                if not data:
+                    client.end = client.position
+                    continue
+                client.position += len(data)
+                client.pending.append(data)
+                client.pending_size += len(data)
+                continue
+
+            follow = (client.request.get('follow') and
+                      client.request.get('until') is None)
+            if not follow:
+                self._disconnect(client)
+                return
+
+            if self._log.end > client.end:
+                # Output was received since the window was read
+                client.reader.close()
+                client.reader = self._log.reader()
+                client.position = max(client.position, client.reader.start)
+                client.end = client.reader.end
+                continue
+
+            client.reader.close()
+            client.reader = None
+            client.live = True
+            self._epoll.modify(client.fileno(), select.EPOLLIN)
+            return
+
+    def _disconnect(self, client):
+        logging.debug('Client disconnected from console')
+        self._remove_handler(client.fileno())
+        del self._clients[client.fileno()]
+        client.close()
+        if client is self._interactive:
+            self._interactive = None
+            self.add_handler(self._listener.fileno(),
+                             lambda _: self._accept(self._listener, False))
+
+    def _handle_client(self, client, events):
+        if events & select.EPOLLIN:
+            try:
+                data = client.sock.recv(IO_BUFFER_SIZE)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                data = None
+
+            if not data:
+                self._disconnect(client)
+                return
+
+            # Input from watchers is discarded
+            if not client.read_only:
+                try:
+                    self._console.sendall(data)
+                except socket.error:
+                    pass
+
+        elif events & (select.EPOLLHUP | select.EPOLLERR):
+            self._disconnect(client)
+            return
+
+        if events & select.EPOLLOUT:
+            self._send_to(client, None)
+
+    def _send_to(self, client, data):
+        try:
+            if data is None:
+                pending = client.send_pending()
+            else:
+                pending = client.send(data)
+        except socket.error:
+            self._disconnect(client)
+            return
+
+        if client.pending_size > CONSOLE_CLIENT_MAX_PENDING:
+            logging.warning('Disconnecting console client which is '
+                            'not keeping up with the console output')
+            self._disconnect(client)
+        elif pending:
+            self._epoll.modify(client.fileno(),
+                               select.EPOLLIN | select.EPOLLOUT)
+        elif data is None:
+            self._epoll.modify(client.fileno(), select.EPOLLIN)
+
+    def _read_console(self, _):
+        try:
+            data = self._console.recv(IO_BUFFER_SIZE)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return False
+            raise
+
+        if not data:
+            # 0 bytes read means qemu disconnected
+            return True
+
+        self._log.write(data)
+        for client in self._clients.values():
+            if not client.live:
+                continue
+
+            # Clients with pending data get it once writable
+            if client.pending:
+                client.pending.append(data)
+                client.pending_size += len(data)
+                if client.pending_size > CONSOLE_CLIENT_MAX_PENDING:
+                    self._send_to(client, None)
+            else:
+                self._send_to(client, data)
+
+        return False
+
+    def run(self):
+        """Proxies the console until it is closed or a handler stops"""
+        self._running = True
+        while self._running:
+            timeout = self._log.timeout()
+            try:
+                events = self._epoll.poll(-1 if timeout is None else timeout)
+            except IOError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+
+            for fd, mask in events:
+                # Handlers may be removed by previous events
+                handler = self._handlers.get(fd)
+                if handler and handler(mask):
+                    self._running = False
+                    break
+
+            self._log.flush_if_due()
+
+        self.close()
+
+    def close(self):
+        for client in self._clients.values():
+            client.close()
+        self._clients = {}
+
+        try:
+            self._console.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._console.close()
+        self._epoll.close()
+        self._log.close()
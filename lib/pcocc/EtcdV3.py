@@ -0,0 +1,476 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Client for the etcd v3 API exposing the python-etcd v2 interface
+
+The EtcdManager is written against the v2 API where keys are organized
+in directories. With the v3 API, directories do not exist: a directory
+is emulated by the set of keys sharing its path as a prefix. Results
+are returned as python-etcd EtcdResult objects and errors are mapped to
+python-etcd exceptions so that both clients can be used
+interchangeably.
+
+"""
+
+import re
+import time
+import Queue
+import logging
+import threading
+
+import etcd
+import grpc
+import etcd3
+import etcd3.exceptions
+import etcd3.events
+from etcd3 import etcdrpc
+from etcd3.etcdrpc import auth_pb2
+
+
+def _norm(key):
+    """Cleans a key path the same way the v2 API does"""
+    key = re.sub('/+', '/', '/' + key)
+    if len(key) > 1:
+        key = key.rstrip('/')
+    return key
+
+def _subtree_range(key):
+    """Returns the key range holding a key and all keys below it
+
+    As '0' immediately follows '/', the range may include sibling keys
+    such as key!x which have to be filtered out with _in_subtree.
+
+    """
+    return key, key + '0'
+
+def _in_subtree(key, path):
+    return path == key or path.startswith(key + '/')
+
+def _prefix_end(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class EtcdV3Client(object):
+    """Subset of the python-etcd Client interface over the v3 API"""
+    def __init__(self, hosts, ca_cert=None, protocol='http',
+                 read_timeout=10, username=None, password=None):
+        if protocol == 'https' and not ca_cert:
+            raise etcd.EtcdException('A CA certificate is required to '
+                                     'use the etcd v3 API over https')
+
+        self._hosts = list(hosts)
+        self._ca_cert = ca_cert
+        self._timeout = read_timeout
+        self._username = username
+        self._password = password
+        self._client = None
+        self._lock = threading.Lock()
+        # Leases granted for keys written with a ttl
+        self._leases = {}
+
+    @property
+    def password(self):
+        return self._password
+
+    @password.setter
+    def password(self, password):
+        # A new authentication token is requested with the new
+        # credential
+        self._password = password
+        self._client = None
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self._connect()
+            return self._client
+
+    def _connect(self):
+        error = None
+        for host, port in self._hosts:
+            try:
+                return etcd3.client(host=host, port=port,
+                                    ca_cert=self._ca_cert,
+                                    timeout=self._timeout,
+                                    user=self._username,
+                                    password=self._password)
+            except (etcd3.exceptions.ConnectionFailedError,
+                    etcd3.exceptions.ConnectionTimeoutError) as e:
+                error = e
+            except grpc.RpcError as e:
+                raise self._translate_error(e)
+            logging.debug('Unable to connect to etcd server %s', host)
+
+        raise etcd.EtcdConnectionFailed('Unable to connect to any etcd server',
+                                        cause=error)
+
+    def _call(self, func, *args, **kwargs):
+        """Calls a client method, trying other servers on failure"""
+        for _ in range(len(self._hosts)):
+            client = self.client
+            try:
+                return getattr(client, func)(*args, **kwargs)
+            except (etcd3.exceptions.ConnectionFailedError,
+                    etcd3.exceptions.ConnectionTimeoutError) as e:
+                logging.debug('Lost connection to etcd server: %s', e)
+                with self._lock:
+                    if self._client is client:
+                        self._hosts.append(self._hosts.pop(0))
+                        self._client = None
+            except etcd3.exceptions.RevisionCompactedError:
+                raise
+            except etcd3.exceptions.Etcd3Exception as e:
+                raise etcd.EtcdException(str(e))
+            except grpc.RpcError as e:
+                raise self._translate_error(e)
+
+        raise etcd.EtcdConnectionFailed('Unable to reach any etcd server')
+
+    def _translate_error(self, e):
+        code = e.code()
+        if (code == grpc.StatusCode.UNAUTHENTICATED or
+            (code == grpc.StatusCode.INVALID_ARGUMENT and
+             'token' in e.details())):
+            # Handled as an expired credential by the EtcdManager
+            return etcd.EtcdException(e.details(), payload={'status': 401})
+        elif code == grpc.StatusCode.PERMISSION_DENIED:
+            return etcd.EtcdInsufficientPermissions(e.details())
+        else:
+            return etcd.EtcdException(e.details())
+
+    def _result(self, action, node, revision):
+        res = etcd.EtcdResult(action, node)
+        res.etcd_index = revision
+        return res
+
+    def _node(self, value, meta):
+        return {'key': meta.key,
+                'value': value,
+                'modifiedIndex': meta.mod_revision,
+                'createdIndex': meta.create_revision}
+
+    def _not_found(self, key, revision):
+        return etcd.EtcdKeyNotFound('Key not found : ' + key,
+                                    payload={'index': revision})
+
+    def _revision(self, key):
+        """Returns the current revision
+
+        Only key is read as users may only read their own prefixes.
+
+        """
+        return self._call('get_response', key).header.revision
+
+    def read(self, key, recursive=False, recurse=False, **kwargdict):
+        """Reads a key or all the keys below a path"""
+        key = _norm(key)
+        if not (recursive or recurse):
+            resp = self._call('get_response', key)
+            if not resp.kvs:
+                raise self._not_found(key, resp.header.revision)
+            kv = resp.kvs[0]
+            return self._result('get', self._node(kv.value, kv),
+                                resp.header.revision)
+
+        start, end = _subtree_range(key)
+        resp = self._call('get_range_response', start, end)
+        kvs = [kv for kv in resp.kvs if _in_subtree(key, kv.key)]
+        if not kvs:
+            raise self._not_found(key, resp.header.revision)
+
+        if len(kvs) == 1 and kvs[0].key == key:
+            return self._result('get', self._node(kvs[0].value, kvs[0]),
+                                resp.header.revision)
+
+        # Children are returned as a flat list of leaves, which is
+        # enough to iterate on EtcdResult.children
+        nodes = [self._node(kv.value, kv) for kv in kvs if kv.key != key]
+        return self._result('get', {'key': key,
+                                    'dir': True,
+                                    'nodes': nodes,
+                                    'modifiedIndex': max(kv.mod_revision
+                                                         for kv in kvs),
+                                    'createdIndex': min(kv.create_revision
+                                                        for kv in kvs)},
+                            resp.header.revision)
+
+    get = read
+
+    # Arguments mirror the python-etcd client, including dir
+    def write(self, key, value, ttl=None,
+              dir=False, # pylint: disable=W0622
+              append=False, prevIndex=None, prevExist=None, **kwdargs):
+        """Writes a key
+
+        Directories only exist as key prefixes: creating one is a no-op
+        and setting a ttl on one attaches all its keys to a lease.
+
+        """
+        key = _norm(key)
+        if dir:
+            if ttl is not None:
+                self._expire_prefix(key, ttl)
+            return self._result('set', {'key': key, 'dir': True},
+                                self._revision(key))
+
+        value = '' if value is None else str(value)
+        lease = None
+        if ttl is not None:
+            lease = self._get_lease(key, ttl)
+            if lease is None:
+                try:
+                    return self.delete(key)
+                except etcd.EtcdKeyNotFound as e:
+                    return self._result('delete', {'key': key},
+                                        e.payload['index'])
+
+        tx = self.client.transactions
+        if prevIndex is not None:
+            compare = [tx.mod(key) == prevIndex]
+            error = etcd.EtcdCompareFailed('Compare failed : [{0}]'.format(
+                prevIndex))
+        elif prevExist is False:
+            compare = [tx.version(key) == 0]
+            error = etcd.EtcdAlreadyExist('Key already exists : ' + key)
+        elif prevExist is True:
+            compare = [tx.version(key) > 0]
+            error = None
+        else:
+            return self._put(key, value, lease)
+
+        succeeded, _ = self._call('transaction', compare=compare,
+                                  success=[tx.put(key, value, lease=lease)],
+                                  failure=[])
+        if not succeeded:
+            if error is None:
+                error = self._not_found(key, self._revision(key))
+            raise error
+
+        return self.read(key)
+
+    set = write
+
+    def _put(self, key, value, lease):
+        resp = self._call('put', key, value, lease=lease)
+        return self._result('set', {'key': key,
+                                    'value': value,
+                                    'modifiedIndex': resp.header.revision},
+                            resp.header.revision)
+
+    def write_many(self, items):
+        """Writes a list of (key, value) tuples in a single transaction"""
+        tx = self.client.transactions
+        ops = [tx.put(_norm(key), '' if value is None else str(value))
+               for key, value in items]
+        if ops:
+            self._call('transaction', compare=[], success=ops, failure=[])
+
+    def _get_lease(self, key, ttl):
+        """Returns a live lease with the requested ttl for a key
+
+        The lease previously attached to the key is kept alive instead
+        of granting a new one each time the key is refreshed. Returns
+        None if the key should expire immediately.
+
+        """
+        previous = self._leases.pop(key, None)
+        if ttl <= 0:
+            if previous is not None:
+                self._call('revoke_lease', previous[0])
+            return None
+
+        if previous is not None and previous[1] == ttl:
+            # refresh_lease is a generator
+            resp = list(self._call('refresh_lease', previous[0]))
+            if resp and resp[-1].TTL > 0:
+                self._leases[key] = previous
+                return previous[0]
+
+        lease = self._call('lease', ttl)
+        self._leases[key] = (lease.id, ttl)
+        return lease.id
+
+    def _expire_prefix(self, key, ttl):
+        """Attaches all keys below a path to a lease with a ttl"""
+        lease = self._call('lease', ttl)
+        start, end = _subtree_range(key)
+        tx = self.client.transactions
+        while True:
+            resp = self._call('get_range_response', start, end)
+            kvs = [kv for kv in resp.kvs if _in_subtree(key, kv.key)]
+            if not kvs:
+                raise self._not_found(key, resp.header.revision)
+
+            succeeded, _ = self._call(
+                'transaction',
+                compare=[tx.mod(kv.key) == kv.mod_revision for kv in kvs],
+                success=[tx.put(kv.key, kv.value, lease=lease.id)
+                         for kv in kvs],
+                failure=[])
+            if succeeded:
+                return
+
+    def delete(self, key, recursive=None,
+               dir=None, # pylint: disable=W0622
+               **kwdargs):
+        """Deletes a key or all the keys below a path"""
+        key = _norm(key)
+        self._leases.pop(key, None)
+        if recursive:
+            start, end = _subtree_range(key)
+            tx = self.client.transactions
+            resp = self._call('get_range_response', start, end,
+                              keys_only=True)
+            keys = [kv.key for kv in resp.kvs if _in_subtree(key, kv.key)]
+            if not keys:
+                raise self._not_found(key, resp.header.revision)
+            self._call('transaction', compare=[],
+                       success=[tx.delete(k) for k in keys], failure=[])
+        else:
+            resp = self._call('delete', key, return_response=True)
+            if not resp.deleted:
+                raise self._not_found(key, resp.header.revision)
+
+        return self._result('delete', {'key': key}, resp.header.revision)
+
+    def _start_watch(self, key, index, recursive, queue):
+        if recursive:
+            start, end = _subtree_range(key)
+        else:
+            start, end = key, None
+
+        try:
+            return self._call('add_watch_callback', start, queue.put,
+                              range_end=end, start_revision=index)
+        except etcd3.exceptions.RevisionCompactedError as e:
+            raise etcd.EtcdEventIndexCleared(
+                'The event in requested index is outdated and cleared',
+                payload={'index': e.compacted_revision})
+
+    def _next_events(self, key, queue, deadline):
+        """Waits for the next watch response and returns its results"""
+        while True:
+            if deadline is None:
+                wait = 1
+            else:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise etcd.EtcdWatchTimedOut('Watch timed out',
+                                                 payload={})
+                wait = min(wait, 1)
+
+            # Poll so that the caller can still be interrupted
+            try:
+                resp = queue.get(timeout=wait)
+                break
+            except Queue.Empty:
+                pass
+
+        if isinstance(resp, etcd3.exceptions.RevisionCompactedError):
+            raise etcd.EtcdEventIndexCleared(
+                'The event in requested index is outdated and cleared',
+                payload={'index': resp.compacted_revision})
+        elif isinstance(resp, grpc.RpcError):
+            raise self._translate_error(resp)
+        elif isinstance(resp, Exception):
+            raise etcd.EtcdException(str(resp))
+
+        results = []
+        for event in resp.events:
+            if not _in_subtree(key, event.key):
+                continue
+            if isinstance(event, etcd3.events.DeleteEvent):
+                action = 'delete'
+            else:
+                action = 'set'
+            results.append(self._result(action,
+                                        self._node(event.value, event),
+                                        resp.header.revision))
+        return results
+
+    def watch(self, key, index=None, timeout=None, recursive=None):
+        """Blocks until a key is modified from the specified index"""
+        key = _norm(key)
+        if timeout:
+            deadline = time.time() + timeout
+        else:
+            deadline = None
+
+        queue = Queue.Queue()
+        watch_id = self._start_watch(key, index, recursive, queue)
+        try:
+            while True:
+                results = self._next_events(key, queue, deadline)
+                if results:
+                    return results[0]
+        finally:
+            self._call('cancel_watch', watch_id)
+
+    def eternal_watch(self, key, index=None, recursive=None):
+        """Yields all modifications of a key from a single watch stream"""
+        key = _norm(key)
+        queue = Queue.Queue()
+        watch_id = self._start_watch(key, index, recursive, queue)
+        try:
+            while True:
+                for result in self._next_events(key, queue, None):
+                    yield result
+        finally:
+            self._call('cancel_watch', watch_id)
+
+    def _auth_call(self, method, request):
+        client = self.client
+        stub = etcdrpc.AuthStub(client.channel)
+        try:
+            return getattr(stub, method)(request, self._timeout,
+                                         credentials=client.call_credentials,
+                                         metadata=client.metadata)
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.FAILED_PRECONDITION:
+                # Users and roles which already exist
+                return None
+            raise self._translate_error(e)
+
+    def grant_user_role(self, user, role, grants, password=None):
+        """Creates a role with permissions on key prefixes and grants it
+        to a user
+
+        grants is a list of (prefix, mode) tuples where mode is R or RW.
+
+        """
+        self._auth_call('RoleAdd', etcdrpc.AuthRoleAddRequest(name=role))
+        for prefix, mode in grants:
+            if mode == 'RW':
+                perm_type = auth_pb2.Permission.READWRITE
+            else:
+                perm_type = auth_pb2.Permission.READ
+            perm = auth_pb2.Permission(permType=perm_type, key=prefix,
+                                       range_end=_prefix_end(prefix))
+            self._auth_call('RoleGrantPermission',
+                            etcdrpc.AuthRoleGrantPermissionRequest(
+                                name=role, perm=perm))
+
+        self._auth_call('UserAdd', etcdrpc.AuthUserAddRequest(
+            name=user, password=password or ''))
+        if password:
+            self._auth_call('UserChangePassword',
+                            etcdrpc.AuthUserChangePasswordRequest(
+                                name=user, password=password))
+        self._auth_call('UserGrantRole', etcdrpc.AuthUserGrantRoleRequest(
+            user=user, role=role))
@@ -25,33 +25,71 @@ import json
 import select
 import re
 import subprocess
-import shlex
 import atexit
 import threading
-import errno
-import base64
-import tempfile
-import shutil
-import yaml
 import logging
 import signal
 import datetime
 import random
 import binascii
+import pipes
+import tarfile
+import tempfile
+import psutil
 
-
+from distutils.spawn import find_executable
 from ClusterShell.NodeSet  import RangeSet
 from .scripts import click
-from .Backports import subprocess_check_output, enum
+from .Backports import subprocess_check_output, enum, OrderedDict
 from .Error import PcoccError
 from .Config import Config
 from .Misc import fake_signalfd, wait_or_term_child
 from .Misc import stop_threads, systemd_notify
+from .Misc import FdWriter, IO_BUFFER_SIZE, TaskGraph
+from .Misc import encode_value, decode_value
+from .Relay import RelayClient, ssh_transport, local_connect
+from .QMP import QMPClient, QGAClient, QMPError, QMPConnectionError
+from .QMP import QMPTimeoutError
+from .Agent import AgentSession, AgentProxy, REATTACH_COMMAND
+from .Agent import GuestFileReader, GuestFileWriter, FileTransferError
+from .Agent import FILE_CHUNK_SIZE
+from .Vsock import vsock_target, create_token, VSOCK_DEVICE
+from .Vsock import VSOCK_AGENT_PORT, VSOCK_IO_PORT, VSOCK_TOKEN_FW_CFG
+from .CloudSeed import seed_image, smbios_serial
+from .Stats import transition
+from .Console import ConsoleLog, ConsoleProxy
+from .Checkpoint import MemoryCompression, read_manifest, direct_io_supported
+from .Checkpoint import CKPT_BITMAP
 
 lock = threading.Lock()
 
 QEMU_GUEST_AGENT_PORT='org.qemu.guest_agent.0'
 
+# Agents with a persistent session served by the VM process
+AGENT_PORTS = ['taskcontrolport', QEMU_GUEST_AGENT_PORT]
+
+AGENT_RETRY_MIN_INTERVAL = 0.05
+AGENT_RETRY_MAX_INTERVAL = 5
+
+MONITOR_RETRY_MIN_INTERVAL = 0.001
+MONITOR_RETRY_MAX_INTERVAL = 0.1
+
+def agent_socket_name(port):
+    return 'agent_{0}_socket'.format(port)
+
+def check_tar_member(member):
+    """Rejects archive members which would be extracted outside the
+    destination directory"""
+    for name in [member.name] + ([member.linkname]
+                                 if member.issym() or member.islnk() else []):
+        if (os.path.isabs(name) or
+            '..' in os.path.normpath(name).split(os.sep)):
+            raise tarfile.TarError('unsafe path in archive: ' + name)
+    if not (member.isfile() or member.isdir() or member.issym() or
+            member.islnk()):
+        raise tarfile.TarError('unsupported file type in archive: ' +
+                               member.name)
+
 def try_kill(sproc):
     try:
         sproc.kill()
@@ -95,220 +133,426 @@ class AgentError(PcoccError):
         super(AgentError, self).__init__('Guest agent failure: '
                                               + error)
 
-QMP_READ_SIZE=32768
-
 class RemoteMonitor(object):
+    """Qemu monitor of a VM, which may run on another host"""
     def __init__(self, vm):
         self.s_mon = Config().hyp.socket_connect(vm, 'monitor_socket')
+        try:
+            self.qmp = QMPClient(self.s_mon)
+        except QMPError as err:
+            try_kill(self.s_mon)
+            raise HypervisorError('unable to connect to qemu monitor: '
+                                  + str(err))
 
-        self.flush_output()
-        self.send_raw('{ "execute": "qmp_capabilities" }')
-        self.flush_output()
+    def execute(self, command, arguments=None):
+        try:
+            return self.qmp.execute(command, arguments)
+        except QMPError as err:
+            raise PcoccError('Qemu monitor error: ' + str(err))
 
-    def send_raw(self, data):
-        return os.write(self.s_mon.stdin.fileno(), data)
+    def subscribe(self, events):
+        return self.qmp.subscribe(events)
 
-    def flush_output(self):
-        """Read everything from the monitor to start fresh
-        """
-        _ = os.read(self.s_mon.stdout.fileno(), 1)
-        while select.select([self.s_mon.stdout.fileno()],[],[],0.0)[0]:
-            _ = os.read(self.s_mon.stdout.fileno(), QMP_READ_SIZE)
+    def quit(self):
+        try:
+            self.qmp.execute('quit')
+        except QMPConnectionError:
+            # Qemu may exit before replying
+            pass
 
-    def read_filtered(self, event_list=None):
-        """Read from the monitor socket and discard all events not in the event_list array
-        """
-        if event_list is None:
-            event_list = []
+    def stop(self):
+        self.execute('stop')
 
-        while True:
-            data = self.s_mon.stdout.readline()
+    def query_status(self):
+        return self.execute('query-status')['status']
+
+    def cont(self):
+        self.execute('cont')
+
+    def drive_backup(self, device, dest, sync='top', bitmap=None,
+                     bitmap_action=None):
+        """Copies a drive to dest and waits for completion
+
+        With the incremental sync mode, only the clusters marked as
+        dirty in bitmap are copied to dest, which must already exist,
+        and the bitmap is cleared when the copy succeeds. Otherwise,
+        bitmap_action may be set to 'add' or 'clear' to create or
+        clear the bitmap atomically with the start of the backup, so
+        that it tracks the writes which are not part of dest.
+
+        """
+        arguments = {'device': device,
+                     'target': dest,
+                     'sync': sync}
+        if sync == 'incremental':
+            arguments.update({'bitmap': bitmap,
+                              'mode': 'existing',
+                              'format': 'qcow2'})
+
+        events = self.subscribe(['BLOCK_JOB_COMPLETED'])
+        try:
             try:
-                ret = json.loads(data)
-                if 'event' in ret and ret['event'] not in event_list:
+                if bitmap_action:
+                    self.qmp.execute('transaction', {'actions': [
+                                {'type': 'block-dirty-bitmap-' + bitmap_action,
+                                 'data': {'node': device, 'name': bitmap}},
+                                {'type': 'drive-backup',
+                                 'data': arguments}]})
+                else:
+                    self.qmp.execute('drive-backup', arguments)
+            except QMPError as err:
+                raise ImageSaveError(str(err))
+
+            while True:
+                event = events.get()
+                if event is None:
+                    raise ImageSaveError('lost connection to qemu monitor')
+                if event['data'].get('device') != device:
                     continue
-            except Exception:
-                pass
+                if 'error' in event['data']:
+                    raise ImageSaveError(event['data']['error'])
+                return
+        finally:
+            self.qmp.unsubscribe(events)
+
+    def query_block_image(self, device):
+        """Returns the image information of a drive"""
+        for block in self.execute('query-block'):
+            if block['device'] == device and 'inserted' in block:
+                return block['inserted']
+        raise HypervisorError('no such drive: ' + device)
+
+    def has_dirty_bitmap(self, device, name):
+        for block in self.execute('query-block'):
+            if block['device'] != device:
+                continue
+            # Bitmaps moved to the inserted media in Qemu 4.2
+            bitmaps = (block.get('dirty-bitmaps', []) +
+                       block.get('inserted', {}).get('dirty-bitmaps', []))
+            return any(bitmap.get('name') == name for bitmap in bitmaps)
+        return False
 
-            return data
+    def dump(self, dump_file):
+        events = self.subscribe(['DUMP_COMPLETED'])
+        arguments = {'paging': True,
+                     'protocol': 'file:' + dump_file,
+                     'detach': True}
+        try:
+            try:
+                self.qmp.execute('dump-guest-memory', arguments)
+            except QMPError as err:
+                if 'detach' not in str(err):
+                    raise ImageSaveError(str(err))
+                # Older Qemus only support synchronous dumps
+                del arguments['detach']
+                try:
+                    self.qmp.execute('dump-guest-memory', arguments)
+                except QMPError as err:
+                    raise ImageSaveError(str(err))
+                return
+
+            event = events.get()
+            if event is None:
+                raise ImageSaveError('lost connection to qemu monitor')
+            if 'error' in event['data']:
+                raise ImageSaveError(event['data']['error'])
+        finally:
+            self.qmp.unsubscribe(events)
 
+    def system_reset(self):
+        self.execute('system_reset')
 
-    def quit(self):
-        mon_quit_cmd = ('{"execute": "quit", "arguments":{'
-                        '} }\n\n')
-        self.send_raw(mon_quit_cmd)
-        self.read_filtered()
+    def system_powerdown(self):
+        self.execute('system_powerdown')
 
-    def stop(self):
-        mon_stop_cmd = ('{"execute": "stop", "arguments":{'
-                        '} }\n\n')
-        self.send_raw(mon_stop_cmd)
-        self.read_filtered()
+    def human_monitor_cmd(self, human_cmd):
+        return self.execute('human-monitor-command',
+                            {'command-line': human_cmd})
 
-    def query_status(self):
-        mon_query_cmd = ('{"execute": "query-status", "arguments":{'
-                        '} }\n\n')
-        self.send_raw(mon_query_cmd)
-        data = self.read_filtered()
+    def set_migration_capability(self, capability, state):
+        """Sets a migration capability, returns False if unsupported"""
         try:
-            ret = json.loads(data)
-        except:
-            raise PcoccError("Could not parse query-status return: " + data)
-
+            self.qmp.execute('migrate-set-capabilities',
+                             {'capabilities': [{'capability': capability,
+                                                'state': state}]})
+            return True
+        except QMPError:
+            return False
+
+    def enable_migration_events(self):
+        """Asks Qemu to send MIGRATION events, if supported"""
+        return self.set_migration_capability('events', True)
+
+    def start_migration(self, dest_uri):
+        self.execute('migrate_set_speed', {'value': 4294967296})
         try:
-            return ret["return"]["status"]
-        except:
-            raise PcoccError("Could not parse query-status return: " + data)
+            self.qmp.execute('migrate', {'uri': dest_uri})
+        except QMPError as err:
+            raise PcoccError('Failed to start memory transfer: ' + str(err))
 
+    def cancel_migration(self):
+        self.execute('migrate_cancel')
 
-    def cont(self):
-        mon_cont_cmd = ('{"execute": "cont", "arguments":{'
-                        '} }\n\n')
-        self.send_raw(mon_cont_cmd)
-        self.read_filtered()
-
-    def drive_backup(self, device, dest):
-        mon_backup_cmd = ('{"execute": "drive-backup",'
-                        '"arguments": { "device": "%s",'
-                        '"target": "%s", "sync": "top"'
-                        '} }\n\n' % (device, dest))
-        self.send_raw(mon_backup_cmd)
-        ret = self.read_filtered()
+    def continue_migration(self):
+        """Resumes a migration held before switchover"""
+        self.execute('migrate-continue', {'state': 'pre-switchover'})
 
-        try:
-            ret = json.loads(ret)
-        except:
-            raise PcoccError("Could not parse drive-backup return: " + ret)
+    def set_downtime_limit(self, seconds):
+        """Sets the maximum time the VM may be paused to complete a migration
 
-        if "error" in ret:
-            raise ImageSaveError(ret["error"]["desc"])
+        Qemu pauses the VM and completes the migration on its own once
+        the remaining memory can be written within this time.
 
-        ret = self.read_filtered(["BLOCK_JOB_COMPLETED"])
+        """
         try:
-            ret = json.loads(ret)
-            event = ret["event"]
-        except:
-            raise PcoccError("Could not parse drive-backup event: " + ret)
+            self.qmp.execute('migrate-set-parameters',
+                             {'downtime-limit': int(seconds * 1000)})
+        except QMPError:
+            # Qemu < 2.8
+            self.execute('migrate_set_downtime', {'value': seconds})
 
+    def snapshot_image(self, dest_image_file):
+        #TODO
+        pass
 
-        if event != "BLOCK_JOB_COMPLETED":
-            raise ImageSaveError("Qemu returned event {0}, "
-                                 "expected BLOCK_JOB_COMPLETED".format(event))
+    def query_migration(self):
+        return self.execute('query-migrate')
 
-        if "error" in ret["data"]:
-            raise ImageSaveError(ret["data"]["error"])
+    def close_monitor(self):
+        self.qmp.close()
 
-    def dump(self, dump_file):
-        mon_dump_cmd = ('{"execute": "dump-guest-memory", "arguments":{ '
-                        '"paging": true, '
-                        '"protocol": "file:%s"'
-                        '} }\n\n'  % dump_file)
-        self.send_raw(mon_dump_cmd)
+class LiveCheckpoint(object):
+    """Memory checkpoint of a VM which keeps running during pre-copy
 
-        while True:
-            data = self.read_filtered()
-            for line in data.splitlines():
-                ret = json.loads(line)
-                if "error" in ret:
-                    raise ImageSaveError(ret["error"]["desc"])
-                elif "event" in ret:
-                    continue
-                elif "return" in ret:
-                    return
-                else:
-                    raise ImageSaveError('unexpected output from qemu: ' + line)
-            time.sleep(2)
+    The downtime limit is set to zero so that Qemu keeps copying
+    dirtied pages instead of pausing the VM by itself. The VM is only
+    paused by pause() to write the last dirty pages. The migration is
+    then held before switchover, while disks are still active, so that
+    they can be saved at the same point in time as the memory before
+    complete() lets it finish.
 
-    def system_reset(self):
-        mon_reset_cmd = ('{"execute": "system_reset", "arguments":{'
-                        '} }\n\n')
-        self.send_raw(mon_reset_cmd)
-        self.read_filtered()
+    """
+    def __init__(self, vm, dest_uri):
+        self.vm = vm
+        self.dest_uri = dest_uri
+        self.retry_count = 0
+        self.mon = RemoteMonitor(vm)
+        self.events = self.mon.subscribe(['MIGRATION'])
+        self.mon.enable_migration_events()
+
+    def start(self):
+        if not self.mon.set_migration_capability('pause-before-switchover',
+                                                 True):
+            raise CheckpointError('live checkpoints require Qemu 2.11 '
+                                  'or later')
+        self.mon.set_downtime_limit(0)
+        self.mon.start_migration(self.dest_uri)
+
+    def progress(self):
+        """Returns the migration status, restarting failed migrations"""
+        ret = self.mon.query_migration()
+        if ret.get('status') in ['failed', 'cancelled']:
+            if self.retry_count >= Config().ckpt_retry_count:
+                raise CheckpointError('memory pre-copy failed for vm%d: %s' %
+                                      (self.vm.rank, json.dumps(ret)))
+            self.retry_count += 1
+            sys.stderr.write('Memory pre-copy failed for vm%d, '
+                             'retrying...\n' % self.vm.rank)
+            self.start()
+        return ret
 
-    def system_powerdown(self):
-        mon_reset_cmd = ('{"execute": "system_powerdown", "arguments":{'
-                        '} }\n\n')
-        self.send_raw(mon_reset_cmd)
-        self.read_filtered()
+    def pause(self, max_downtime):
+        """Pauses the VM so that the migration completes"""
+        self.mon.stop()
+        self.mon.set_downtime_limit(max_downtime)
 
-    def human_monitor_cmd(self, human_cmd):
-        mon_human_cmd = ('{"execute": "human-monitor-command", "arguments":{'
-                         '"command-line": "%s"} }\n\n' % human_cmd)
-        self.send_raw(mon_human_cmd)
-        raw_data = self.read_filtered()
+    def wait_switchover(self):
+        """Waits until the memory is saved up to the switchover"""
+        self._wait_status('pre-switchover')
+
+    def complete(self):
+        """Lets the migration finish once disks are saved"""
+        self.mon.continue_migration()
+        self._wait_status('completed')
+
+    def _wait_status(self, target):
+        while True:
+            ret = self.mon.query_migration()
+            status = ret.get('status')
+            if status == target:
+                return
+            elif status not in [None, 'setup', 'active', 'pre-switchover',
+                                'device']:
+                raise CheckpointError('memory save failed for vm%d: %s' %
+                                      (self.vm.rank, json.dumps(ret)))
+            self.events.get(timeout=1)
+
+    def abort(self):
+        """Cancels the migration and resumes the VM"""
         try:
-            data = json.loads(raw_data)
-        except:
-            raise PcoccError("Unable to parse output from qemu: " + raw_data)
+            self.mon.cancel_migration()
+            self.mon.cont()
+        except PcoccError:
+            pass
+
+    def close(self):
+        self.mon.close_monitor()
+
+class ThreadPinning(object):
+    """Binds the threads of a running Qemu process to host PUs
 
+    vcpu_pus lists the host PUs of each vCPU index. The main loop and
+    iothreads are bound to emulator_pus, or to all vCPU PUs if no PU is
+    reserved for the emulator.
+
+    """
+    def __init__(self, qemu_pid, vcpu_pus, emulator_pus=None):
+        self.qemu_pid = qemu_pid
+        self.vcpu_pus = vcpu_pus
+        if emulator_pus:
+            self.emulator_pus = sorted(emulator_pus)
+        else:
+            self.emulator_pus = sorted(set(pu for pus in vcpu_pus
+                                           for pu in pus))
+        self.layout = []
+
+    def query_vcpus(self, qmp):
+        """Returns a list of (vcpu index, thread id) tuples
+
+        query-cpus-fast doesn't interrupt vCPUs and is preferred when
+        available (Qemu >= 2.12).
+
+        """
         try:
-            return data["return"]
-        except KeyError:
+            return [(c['cpu-index'], c['thread-id'])
+                    for c in qmp.execute('query-cpus-fast')]
+        except QMPError:
             pass
 
         try:
-            raise PcoccError("Qemu monitor error: " + data["error"]["desc"])
-        except KeyError:
-            raise PcoccError("Unable to parse output from qemu: " + raw_data)
-
-    def start_migration(self, dest_mem_file):
-        mon_speed_cmd = ('{"execute": "migrate_set_speed", "arguments":{'
-                         '"value": 4294967296'
-                         '} }\n\n')
-        self.send_raw(mon_speed_cmd)
-        self.read_filtered()
-
-        mon_save_cmd = ('{"execute": "migrate", "arguments":{'
-                        '"uri": "exec:lzop > %s"'
-                        '} }\n\n'%(dest_mem_file))
-        self.send_raw(mon_save_cmd)
-        data = self.read_filtered()
+            return [(c['CPU'], c['thread_id'])
+                    for c in qmp.execute('query-cpus')]
+        except QMPError as err:
+            raise HypervisorError('unable to query vcpus: ' + str(err))
+
+    def query_iothreads(self, qmp):
+        """Returns a list of (iothread id, thread id) tuples"""
         try:
-            ret = json.loads(data)
-            if 'error' in ret:
-                raise PcoccError('Failed to start memory transfer: ' +
-                                 ret['error']['desc'])
-        except:
-            raise
-#            raise PcoccError("Unable to parse output from qemu: " + data)
+            return [(t['id'], t['thread-id'])
+                    for t in qmp.execute('query-iothreads')]
+        except QMPError:
+            return []
 
-    def snapshot_image(self, dest_image_file):
-        #TODO
-        pass
+    def _bind(self, kind, name, tid, pus):
+        try:
+            psutil.Process(tid).cpu_affinity(pus)
+        except psutil.Error as err:
+            raise HypervisorError('unable to bind {0} {1}: {2}'.format(
+                    kind, name, err))
+        self.layout.append((kind, name, tid, pus))
 
-    def query_migration(self):
-        mon_query_cmd = ('{"execute": "query-migrate" }\n\n')
-        self.send_raw(mon_query_cmd)
-        return self.read_filtered()
+    def apply(self, qmp):
+        """Binds all Qemu threads described by the monitor"""
+        self.layout = []
+        self._bind('main', '-', self.qemu_pid, self.emulator_pus)
 
-    def close_monitor(self):
-        self.s_mon.terminate()
-        self.s_mon.communicate()
+        for name, tid in self.query_iothreads(qmp):
+            self._bind('iothread', name, tid, self.emulator_pus)
+
+        for index, tid in self.query_vcpus(qmp):
+            try:
+                pus = self.vcpu_pus[index]
+            except IndexError:
+                raise HypervisorError('no host core for vcpu %d' % index)
+            self._bind('vcpu', index, tid, pus)
+
+    def save_layout(self, path):
+        """Writes the thread to PU binding in a human readable file"""
+        with open(path, 'w') as f:
+            f.write('# kind name thread_id host_cpus\n')
+            for kind, name, tid, pus in self.layout:
+                f.write('{0} {1} {2} {3}\n'.format(
+                        kind, name, tid,
+                        RangeSet.fromlist([str(pu) for pu in pus])))
+
+class ProbeCache(object):
+    """Results of host capability probes shared by the VMs of a node
+
+    Results are keyed by the probed file and its modification and
+    change times so that they are invalidated when a binary is
+    replaced or the permissions of a device are modified.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._results = None
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return decode_value(f.read()) or {}
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self):
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, 'w') as f:
+                f.write(encode_value(self._results))
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as err:
+            logging.debug('Unable to save probe cache: %s', err)
+
+    def get(self, probe, path, func):
+        """Returns the cached result of func for a probe of path"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return func()
+
+        key = '{0}:{1}:{2}:{3}'.format(probe, path, st.st_mtime, st.st_ctime)
+        with self._lock:
+            if self._results is None:
+                self._results = self._load()
+            if key in self._results:
+                return self._results[key]
+
+        result = func()
+        with self._lock:
+            # Merge results of other VMs saved in the meantime
+            self._results = self._load()
+            self._results[key] = result
+            self._save()
+        return result
 
 class Qemu(object):
     def __init__(self):
         self.qemu_bin = 'qemu-system-x86_64'
+        self._relays = {}
+        self._probes = None
+        self._vm_history = {}
 
     def _do_lock_image(self, drive, key):
         batch = Config().batch
 
         # Not yet allocated
         if key is None:
-            return yaml.dump(
+            return encode_value(
                 {'batchid': batch.batchid, 'count': 1}), True
 
-        key = yaml.safe_load(key)
+        key = decode_value(key)
         if key['batchid'] == batch.batchid:
             key['count'] += 1
             if drive['mmp'] == 'cluster':
-                return yaml.dump(key), True
+                return encode_value(key), True
             else:
                 raise HypervisorError('drive file is already used in this cluster')
 
-        joblist = batch.list_all_jobs()
-        if not key['batchid'] in joblist:
+        if (not key['batchid'] in batch.list_all_jobs() and
+            not key['batchid'] in batch.list_all_jobs(refresh=True)):
             # Expired job, allocate anyways
-            return yaml.dump(
+            return encode_value(
                 {'batchid': batch.batchid, 'count': 1}), True
         else:
             raise HypervisorError('drive file is already used in '
@@ -321,18 +565,18 @@ class Qemu(object):
             logging.warning('Lock file unexpectdly removed')
             return None, False
 
-        key = yaml.safe_load(key)
+        key = decode_value(key)
 
         if key['batchid'] != batch.batchid:
             logging.warning('Lock file unexpectedly acquired by'
                             'another cluster')
-            return yaml.dump(key), False
+            return encode_value(key), False
 
         key['count'] -= 1
         if key['count'] == 0:
-            return yaml.dump(key), True
+            return encode_value(key), True
         else:
-            return yaml.dump(key), False
+            return encode_value(key), False
 
     def _unlock_image(self, path):
         batch = Config().batch
@@ -359,7 +603,7 @@ class Qemu(object):
                                    sasldb_path, '-p',
                                    '-c',  '-u', 'pcocc',
                                    batch.batchuser],
-                                  stdin=subprocess.PIPE)
+                                  stdin=subprocess.PIPE, close_fds=True)
         s_exec.communicate(input=spice_password + '\n')
         if s_exec.returncode:
             raise PcoccError('Failed to setup SASL password')
@@ -420,6 +664,109 @@ username={3}@pcocc
                 '-device', 'virtserialport,chardev=spicechannel0,name=com.redhat.spice.0',
                 '-chardev', 'spicevmc,id=spicechannel0,name=vdagent']
 
+    @property
+    def probes(self):
+        with lock:
+            if self._probes is None:
+                self._probes = ProbeCache(
+                    Config().batch.get_node_state_path('probes'))
+            return self._probes
+
+    def _qemu_version(self, qemu_bin):
+        """Returns the version of a Qemu binary as a float"""
+        path = find_executable(qemu_bin) or qemu_bin
+
+        def probe():
+            try:
+                version_string = subprocess_check_output([path, '--version'])
+            except (OSError, subprocess.CalledProcessError) as err:
+                raise HypervisorError('unable to run {0}: {1}'.format(
+                        qemu_bin, err))
+            match = re.search(r'version (\d+\.\d+)', version_string)
+            if not match:
+                raise HypervisorError('unable to determine Qemu version')
+            return float(match.group(1))
+
+        return self.probes.get('version', path, probe)
+
+    def _device_usable(self, path, mode):
+        """Checks if a device can be opened with mode"""
+        def probe():
+            try:
+                with open(path, mode):
+                    return True
+            except IOError:
+                return False
+
+        return self.probes.get('open-' + mode, path, probe)
+
+    def _create_snapshot(self, vm, ckpt_dir):
+        # Emulate -snapshot with qemu-img so that we
+        # may save the image later if needed
+        snapshot_path = Config().batch.get_vm_state_path(vm.rank,
+                                                         'image_snapshot')
+        if ckpt_dir:
+            image_path = self.checkpoint_img_file(vm, ckpt_dir)
+        else:
+            image_path = vm.image_path
+
+        with open(os.devnull, 'w') as devnull:
+            try:
+                subprocess.check_call(['qemu-img', 'create',
+                                       '-f', 'qcow2',
+                                       '-b', image_path, snapshot_path],
+                                      stdout=devnull, close_fds=True)
+            except (OSError, subprocess.CalledProcessError):
+                raise InvalidImageError('failed to create temporary disk')
+
+        atexit.register(os.remove, snapshot_path)
+        return snapshot_path
+
+    def _vm_hostname(self, vm):
+        if hasattr(vm, 'domain_name'):
+            # Setting the fqdn as a hostname is not standard but
+            # its what cloud-init wants and its difficult to work
+            # around it.  Ideally we'd set the short hostname for
+            # and cloud-init would use it as a hostname without
+            # appending .localdomain. The fqdn should be
+            # determined by the resolver configuration (dns or
+            # host file).
+            return 'vm{0}.{1}'.format(vm.rank, vm.domain_name)
+        else:
+            # For networks without managed DHCP/DNS set a hostname by default
+            return 'vm%d' % (vm.rank)
+
+    def _create_cloud_seed(self, vm):
+        # The hostname is passed through SMBIOS so that the seed image
+        # only depends on the user-data and can be shared between VMs
+        try:
+            if vm.user_data:
+                with open(Config().resolve_path(vm.user_data, vm)) as f:
+                    user_data = f.read()
+            else:
+                user_data = ''
+
+            meta_data = 'instance-id: {0}\n'.format(vm.instance_id)
+
+            return seed_image(Config().batch.get_node_state_path('seeds'),
+                              user_data, meta_data)
+        except (OSError, IOError) as err:
+            raise HypervisorError('unable to generate cloud-init iso: '
+                                  + str(err))
+
+    def _create_vsock_token(self, vm, available=True):
+        if not available:
+            raise HypervisorError('vsock was requested but '
+                                  'vhost-vsock is not available')
+
+        token_path = Config().batch.get_vm_state_path(vm.rank, 'vsock_token')
+        try:
+            create_token(token_path)
+        except OSError as err:
+            raise HypervisorError('unable to create vsock token: '
+                                  + str(err))
+        return token_path
+
     def run(self, vm, ckpt_dir=None):
         batch = Config().batch
 
@@ -427,14 +774,16 @@ username={3}@pcocc
                            'gathering topological information',
                            None, vm.rank)
 
+        topology = Config().topology
+
         # VM may use all cores allocated for the job
         # Disable batch manager affinity
         if vm.full_node:
-            with open(os.devnull, 'w') as devnull:
-                subprocess.check_call(["taskset", "-p",
-                                       "0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF",
-                                       str(os.getpid())],
-                                      stdout=devnull, stderr=devnull)
+            try:
+                psutil.Process().cpu_affinity(topology.all_pus)
+            except psutil.Error as err:
+                raise HypervisorError('unable to reset CPU affinity: '
+                                      + str(err))
 
         num_cores = batch.num_cores
         mem_per_core = batch.mem_per_core
@@ -449,30 +798,6 @@ username={3}@pcocc
 
         cores_on_numa = {}
 
-        # Find out hwloc version
-        # Python hwloc bindings would be nice
-        try:
-            version_string = subprocess_check_output(['lstopo-no-graphics', '--version'])
-        except (OSError, subprocess.CalledProcessError) as err:
-            raise HypervisorError('hwloc (lstopo-no-graphics) is not available')
-
-        match = re.search(r'lstopo-no-graphics (\d+)\.(\d+)', version_string)
-        hwloc_version = (int(match.group(1)), int(match.group(2)))
-        if hwloc_version[0] == 1 and hwloc_version[1] < 9:
-            hwloc_force_flags = ''
-        else:
-            hwloc_force_flags = '-f '
-
-        if len(coreset) > 1:
-            (_, topology_cache_file) = tempfile.mkstemp()
-            subprocess.check_call(shlex.split(
-                    'lstopo-no-graphics --of xml --no-io ' +
-                    hwloc_force_flags +
-                    topology_cache_file))
-            topology_cache_args = ['--input', topology_cache_file]
-        else:
-            topology_cache_args = []
-
         if vm.emulator_cores >= num_cores:
             logging.warning('VM %s was only given %s cores, '
                             'but its template requires %s for the emulator. '
@@ -494,19 +819,8 @@ username={3}@pcocc
             autobind_cpumem = True
             for core_id in coreset:
                 try:
-                    with open(os.devnull, 'w') as devnull:
-                        numa_node = int(subprocess_check_output(['hwloc-calc',
-                                                                 'Core:%d' %
-                                                                 (int(core_id)),
-                                                                 '-I', 'NUMANode'] +
-                                                                topology_cache_args,
-                                        stderr=devnull))
-                except ValueError:
-                    # Use NUMA node 0 if the CPU doesnt intersect any NUMANode
-                    # Usually this means that we have a UMA machine
-                    numa_node = 0
-
-                except Exception as err:
+                    numa_node = topology.core_numa(core_id)
+                except PcoccError as err:
                     raise HypervisorError('unable to compute NUMA node: '
                                           + str(err))
 
@@ -522,57 +836,63 @@ username={3}@pcocc
         else:
             cmdline = [ self.qemu_bin ]
 
-        version_string = subprocess_check_output(cmdline + ['--version'])
-        match = re.search(r'version (\d+\.\d+)', version_string)
-        qemu_version = float(match.group(1))
+        if vm.remote_display and vm.remote_display != 'spice':
+            raise HypervisorError('Unsupported remote display type: '
+                                  + str(vm.remote_display))
+
+        # Probe host capabilities and create the files needed by Qemu
+        # concurrently
+        self._set_vm_state('temporary-disk',
+                           'preparing disk and launch files',
+                           None, vm.rank)
+
+        prep = TaskGraph()
+        prep.add('qemu-version', lambda: self._qemu_version(cmdline[0]))
+        prep.add('kvm', lambda: self._device_usable('/dev/kvm', 'w+'))
+        prep.add('vhost-net', lambda: self._device_usable('/dev/vhost-net',
+                                                          'r+'))
+        if not vm.image_dir is None:
+            prep.add('snapshot', lambda: self._create_snapshot(vm,
+                                                               ckpt_dir))
+        prep.add('cloud-seed', lambda: self._create_cloud_seed(vm))
+        if vm.remote_display == 'spice':
+            prep.add('spice', lambda: self._setup_spice(vm))
+        if vm.vsock:
+            prep.add('vhost-vsock', lambda: self._device_usable(VSOCK_DEVICE,
+                                                                'r+'))
+            prep.add('vsock', lambda: self._create_vsock_token(
+                    vm, prep.results['vhost-vsock']), deps=['vhost-vsock'])
+
+        prep_start = time.time()
+        prepared = prep.run()
+        timings = OrderedDict([('prepare', time.time() - prep_start)])
+        timings.update(prep.timings)
+
+        qemu_version = prepared['qemu-version']
 
         if ckpt_dir:
             dest_mem_file = self.checkpoint_mem_file(vm, ckpt_dir)
+            compression = MemoryCompression.from_manifest(
+                read_manifest(ckpt_dir))
 
             cmdline += ['-incoming',
-                        "exec: lzop -dc %s" % (dest_mem_file)]
+                        'exec:' + compression.restore_pipeline(
+                    dest_mem_file, direct_io_supported(dest_mem_file))]
 
         # Basic machine definition
-        try:
-            # Check if the kvm is usable
-            f =  open('/dev/kvm', 'w+')
+        if prepared['kvm']:
             cmdline += ['-machine', 'type=q35,accel=kvm']
             cmdline += ['-cpu', 'host']
-        except:
-            cmdline += ['-machine', 'type=q35']
         else:
-            f.close()
+            cmdline += ['-machine', 'type=q35']
 
         cmdline += ['-rtc', 'base=utc']
         cmdline += ['-device', 'qxl-vga,id=video0,ram_size=67108864,'
                     'vram_size=67108864,vgamem_mb=16']
 
-        self._set_vm_state('temporary-disk',
-                           'creating disk file',
-                           None, vm.rank)
-
         # Image
-        # Emulate -snapshot with qemu-img so that we
-        # may save the image later if needed
-        snapshot_path = batch.get_vm_state_path(vm.rank, 'image_snapshot')
-
         if not vm.image_dir is None:
-            if ckpt_dir:
-                image_path = self.checkpoint_img_file(vm, ckpt_dir)
-            else:
-                image_path = vm.image_path
-
-            with open(os.devnull, 'w') as devnull:
-                try:
-                    subprocess.check_call(['qemu-img', 'create',
-                                           '-f', 'qcow2',
-                                        '-b', image_path, snapshot_path],
-                                          stdout=devnull)
-                except (OSError, subprocess.CalledProcessError) as err:
-                    raise InvalidImageError('failed to create temporary disk')
-
-
-            atexit.register(os.remove, snapshot_path)
+            snapshot_path = prepared['snapshot']
 
             if vm.disk_model == 'virtio':
                 cmdline += ['-device', 'virtio-blk-pci,'
@@ -666,14 +986,10 @@ username={3}@pcocc
             cmdline += ['-m', str(total_mem)]
 
         # Ethernet interfaces
-        try:
-            # Check if the vhost device is usable
-            f =  open('/dev/vhost-net', 'r+')
-        except:
-            vhost_string = ''
-        else:
-            f.close()
+        if prepared['vhost-net']:
             vhost_string = ',vhost=on'
+        else:
+            vhost_string = ''
 
         for i, net in enumerate(sorted(vm.eth_ifs.iterkeys(),
                                       key=vm.networks.index)):
@@ -752,59 +1068,28 @@ username={3}@pcocc
                             'id=ioserial%d,name=%s' %
                             (serialid, serialid, serial)]
 
+        # Virtio vsock for the pcocc agent and exec I/O streams
+        if vm.vsock:
+            token_path = prepared['vsock']
+            cmdline += ['-device', 'vhost-vsock-pci,id=vsock0,'
+                        'guest-cid=%d' % (vm.vsock_cid)]
+            cmdline += ['-fw_cfg', 'name=%s,file=%s' % (VSOCK_TOKEN_FW_CFG,
+                                                        token_path)]
+
         # Virtio RNG
         cmdline += [ '-device', 'virtio-rng-pci']
 
         #Display
         if vm.remote_display == 'spice':
-            cmdline += self._setup_spice(vm)
-        elif not vm.remote_display:
-            cmdline += ['-display', 'none']
+            cmdline += prepared['spice']
         else:
-            raise HypervisorError('Unsupported remote display type: '
-                                  + str(vm.remote_display))
-
-        try:
-            user_data_file = batch.get_vm_state_path(vm.rank, 'user-data')
-            meta_data_file = batch.get_vm_state_path(vm.rank, 'meta-data')
-            iso_file = batch.get_vm_state_path(vm.rank, 'cloud_seed')
-
-            f = open(meta_data_file, 'w')
-            f.write('instance-id: {0}\n'.format(vm.instance_id))
-
-            if hasattr(vm, 'domain_name'):
-                # Setting the fqdn as a hostname is not standard but
-                # its what cloud-init wants and its difficult to work
-                # around it.  Ideally we'd set the short hostname for
-                # and cloud-init would use it as a hostname without
-                # appending .localdomain. The fqdn should be
-                # determined by the resolver configuration (dns or
-                # host file).
-                f.write('local-hostname: vm{0}.{1}\n'.format(vm.rank, vm.domain_name))
-            else:
-                # For networks without managed DHCP/DNS set a hostname by default
-                f.write('local-hostname: vm%d\n' % (vm.rank))
-
-            f.close()
-
-            if vm.user_data:
-                shutil.copyfile(Config().resolve_path(vm.user_data, vm),
-                                user_data_file)
-            else:
-                shutil.copyfile('/dev/null', user_data_file)
-
-            with open(os.devnull, 'w') as devnull:
-                subprocess.check_call(['genisoimage',
-                                       '-output', iso_file, '-volid', 'cidata', '-joliet',
-                                       '-rock', user_data_file,
-                                       meta_data_file], stdout=devnull, stderr=devnull)
-
-            cmdline += [ '-drive',
-                         'file={0},index=3,media=cdrom'.format(iso_file)]
+            cmdline += ['-display', 'none']
 
-        except (OSError, IOError, subprocess.CalledProcessError) as err:
-            raise HypervisorError('unable to generate cloud-init iso: '
-                                  + str(err))
+        cmdline += [ '-drive',
+                     'file={0},index=3,media=cdrom,readonly=on'.format(
+                         prepared['cloud-seed'])]
+        cmdline += [ '-smbios', 'type=1,serial={0}'.format(
+            smbios_serial(self._vm_hostname(vm)))]
 
         self._set_vm_state('qemu-start',
                            'starting qemu',
@@ -814,16 +1099,25 @@ username={3}@pcocc
             cmdline += vm.custom_args
 
 
-        if emulator_coreset and autobind_cpumem:
-            emulator_phys_coreset = [ subprocess_check_output(
-                ['hwloc-calc', '--po', '-I', 'PU', 'Core:%s' % core] +
-                topology_cache_args).strip()
-                                      for core in emulator_coreset ]
-            cmdline = ['taskset',
-                       '-c', ','.join(emulator_phys_coreset)] + cmdline
+        if autobind_cpumem:
+            emulator_phys_coreset = topology.core_pus(emulator_coreset)
+            vcpu_phys_coreset = [topology.core_pus(core)
+                                 for core in virt_to_phys_coreid]
+            vm_cpus = sorted(set(emulator_phys_coreset).union(
+                    *vcpu_phys_coreset))
+        else:
+            emulator_phys_coreset = None
+            vm_cpus = []
 
+        qemu_start = time.time()
         qemu_pid = os.fork()
         if qemu_pid == 0:
+            if emulator_phys_coreset:
+                try:
+                    psutil.Process().cpu_affinity(emulator_phys_coreset)
+                except psutil.Error as err:
+                    logging.warning('Unable to bind emulator threads: %s',
+                                    err)
             # Silence Qemu unless in verbose mode
             if not Config().verbose:
                 fd = os.open(os.devnull, os.O_WRONLY)
@@ -834,6 +1128,7 @@ username={3}@pcocc
             os.setpgid(0, 0)
             os.execvp(cmdline[0], cmdline)
 
+        interval = MONITOR_RETRY_MIN_INTERVAL
         while True:
             try:
                 # Init qemu monitor
@@ -842,40 +1137,53 @@ username={3}@pcocc
                 break
 
             except socket.error as err:
+                s_mon.close()
                 pid, status = os.waitpid(qemu_pid, os.WNOHANG)
                 if pid:
                     ret = status >> 8
                     raise HypervisorError("qemu exited during init with"
                                           " status %d" % (ret))
-                time.sleep(1)
+                time.sleep(interval)
+                interval = min(interval * 2, MONITOR_RETRY_MAX_INTERVAL)
 
+        timings['qemu-monitor'] = time.time() - qemu_start
 
-        data = s_mon.recv(QMP_READ_SIZE)
-        s_mon.sendall('{ "execute": "qmp_capabilities" }')
-        data = s_mon.recv(QMP_READ_SIZE)
+        try:
+            qmp = QMPClient(s_mon)
+        except QMPError as err:
+            raise HypervisorError('unable to connect to qemu monitor: '
+                                  + str(err))
 
-        self._set_vm_state('qemu-start',
+        self._set_vm_state('vcpu-pinning',
                            'binding vcpus',
                            None, vm.rank)
 
         if autobind_cpumem:
-            # Ask for vcpu thread info
-            s_mon.sendall('{ "execute": "query-cpus" }')
-            data = s_mon.recv(QMP_READ_SIZE)
-            ret = json.loads(data)
-
-            # Bind each vcpu thread on its physical cpu
-            for cpu_info in ret["return"]:
-                cpu_id = cpu_info["CPU"]
-                cpu_thread_id = cpu_info["thread_id"]
-                phys_coreid = subprocess_check_output(
-                    ['hwloc-calc' , '--po', '-I', 'PU',
-                     'core:%s'%(virt_to_phys_coreid[cpu_id])]  +
-                    topology_cache_args).strip()
-                subprocess_check_output(['taskset', '-p', '-c',
-                                         phys_coreid, str(cpu_thread_id)])
-
-        s_mon.close()
+            pinning_start = time.time()
+            pinning = ThreadPinning(qemu_pid, vcpu_phys_coreset,
+                                    emulator_phys_coreset)
+            pinning.apply(qmp)
+            timings['vcpu-pinning'] = time.time() - pinning_start
+            try:
+                pinning.save_layout(batch.get_vm_state_path(vm.rank,
+                                                            'cpu_layout'))
+            except IOError as err:
+                logging.warning('Unable to save vcpu layout: %s', err)
+
+        qmp.close()
+
+        agent_proxies = []
+        for port in AGENT_PORTS:
+            if vm.vsock and port == 'taskcontrolport':
+                session = AgentSession(self._vsock_target(vm,
+                                                          VSOCK_AGENT_PORT))
+            else:
+                session = AgentSession(batch.get_vm_state_path(
+                        vm.rank, 'serial_{0}_socket'.format(port)))
+            proxy = AgentProxy(session, batch.get_vm_state_path(
+                    vm.rank, agent_socket_name(port)))
+            proxy.start()
+            agent_proxies.append(proxy)
 
         qemu_socket_path = batch.get_vm_state_path(vm.rank,
                                                    'qemu_console_socket')
@@ -897,23 +1205,41 @@ username={3}@pcocc
         pcocc_console_sock.bind(pcocc_socket_path)
         pcocc_console_sock.listen(0)
 
+        watch_console_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        watch_console_sock.bind(batch.get_vm_state_path(
+                vm.rank, 'pcocc_console_watch_socket'))
+        watch_console_sock.listen(socket.SOMAXCONN)
+
+        log_console_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        log_console_sock.bind(batch.get_vm_state_path(
+                vm.rank, 'pcocc_console_log_socket'))
+        log_console_sock.listen(socket.SOMAXCONN)
+
 
         if ckpt_dir:
             # Signal VM restore
-            self._set_vm_state('qemu-start',
+            self._set_vm_state('restore',
                            'restoring',
                            None, vm.rank)
 
+            restore_start = time.time()
             mon = RemoteMonitor(vm)
+            events = mon.subscribe(['MIGRATION'])
+            mon.enable_migration_events()
             while mon.query_status() == 'inmigrate':
-                time.sleep(1)
+                # Wake up on migration status changes if Qemu supports
+                # the events, and poll otherwise
+                events.get(timeout=1)
             mon.cont()
             mon.close_monitor()
+            timings['restore'] = time.time() - restore_start
 
-        # Signal VM started
+        # Signal VM started with the time spent in each launch phase
+        # and the host cpus which checkpoint compressors may use
+        logging.debug('VM launch timings: %s', timings)
         self._set_vm_state('complete',
                            'started',
-                           None, vm.rank)
+                           {'timings': timings, 'cpus': vm_cpus}, vm.rank)
 
         # If we need to properly shutdown the guest, catch SIGTERMs
         # and SIGINTS
@@ -922,122 +1248,54 @@ username={3}@pcocc
         else:
             term_sigfd = None
 
-        # Proxy the VM console until Qemu closes it
-        client_sock = None
-
-        console_log_file = open(batch.get_vm_state_path(vm.rank,
-                                                   'qemu_console_log'), 'w+',
-                                1)
+        t = [None]
+        shutdown_attempts = [0]
 
-        t = None
-        shutdown_attempts = 0
-        if term_sigfd is None:
-            base_list = [qemu_console_sock]
-        else:
-            base_list = [term_sigfd, qemu_console_sock]
+        def handle_term_signal(_):
+            os.read(term_sigfd, 1024)
+            if shutdown_attempts[0] >= 5:
+                logging.info('Timed out waiting for VM to poweroff')
+                return True
 
+            mon = RemoteMonitor(vm)
+            mon.system_powerdown()
+            mon.close_monitor()
+            logging.debug('Waiting for VM to poweroff')
+            # Wait 10s for Qemu to exit and resend signal
+            if t[0]:
+                t[0].cancel()
+                t[0].join(0)
+            t[0] = threading.Timer(10, os.kill,
+                                   [os.getpid(), signal.SIGTERM])
+            t[0].start()
+            shutdown_attempts[0] += 1
+            return False
 
         if systemd_notify('VM is booting...', ready=True):
             watchdog = threading.Thread(None, self.watchdog, args=[vm])
             watchdog.start()
 
-        while qemu_console_sock:
-            # Only accept one client at a time
-            if client_sock:
-                listen_list = base_list + [client_sock]
-            else:
-                listen_list = base_list + [pcocc_console_sock]
-
-            try:
-                rdy, _ , _  = select.select(listen_list, [], [])
-            except select.error as e:
-                if e.args[0] == errno.EINTR:
-                    continue
-                else:
-                    raise
-
-            for s in rdy:
-                if s is pcocc_console_sock:
-                    client_sock, _ = pcocc_console_sock.accept()
-                    logging.debug('New client connexion to console')
-
-                elif s is qemu_console_sock:
-                    data = qemu_console_sock.recv(4096)
-                    if not data:
-                        # 0 bytes read means qemu disconnected
-                        # Disconnect client if needed and stop console proxy
-                        if client_sock:
-                            try:
-                                client_sock.shutdown(socket.SHUT_RDWR)
-                                client_sock.close()
-                            except:
-                                pass
-                        try:
-                            qemu_console_sock.shutdown(socket.SHUT_RDWR)
-                            qemu_console_sock.close()
-                        except:
-                            pass
-
-                        # Leave all loops
-                        qemu_console_sock = None
-                        break
-
-                    if client_sock:
-                        try:
-                            client_sock.sendall(data)
-                        except:
-                            pass
-
-                    console_log_file.write(data)
-
-                elif s is client_sock:
-                    try:
-                        data = client_sock.recv(4096)
-                    except:
-                        data = None
-
-                    if data:
-                        try:
-                            qemu_console_sock.sendall(data)
-                        except:
-                            pass
-                    else:
-                        # 0 byte read means client disconnected
-                        logging.debug('Client disconnected from console')
-                        try:
-                            client_sock.shutdown(socket.SHUT_RDWR)
-                            client_sock.close()
-                        except:
-                            pass
-                        client_sock = None
-                elif s is term_sigfd:
-                    os.read(term_sigfd, 1024)
-                    if shutdown_attempts >= 5:
-                        logging.info('Timed out waiting for VM to poweroff')
-                        # Exit loops
-                        qemu_console_sock = None
-                        break
-
-                    mon = RemoteMonitor(vm)
-                    mon.system_powerdown()
-                    mon.close_monitor()
-                    logging.debug('Waiting for VM to poweroff')
-                    # Wait 10s for Qemu to exit and resend signal
-                    if t:
-                        t.cancel()
-                        t.join(0)
-                    t = threading.Timer(10, os.kill,
-                                        [os.getpid(), signal.SIGTERM])
-                    t.start()
-                    shutdown_attempts+=1
+        # Proxy the VM console until Qemu closes it
+        if qemu_console_sock:
+            console_log = ConsoleLog(batch.get_vm_state_path(
+                    vm.rank, 'qemu_console_log'))
+            console_proxy = ConsoleProxy(qemu_console_sock,
+                                         pcocc_console_sock,
+                                         watch_console_sock,
+                                         log_console_sock, console_log)
+            if term_sigfd is not None:
+                console_proxy.add_handler(term_sigfd, handle_term_signal)
+            console_proxy.run()
 
         logging.debug('Cleaning up Qemu')
         # Qemu should have exited, send it a SIGTERM and a SIGKILL 5s later
-        if t:
-            t.cancel()
-            t.join(0)
+        if t[0]:
+            t[0].cancel()
+            t[0].join(0)
 
         stop_threads.set()
+        for proxy in agent_proxies:
+            proxy.stop()
         os.kill(os.getpid(), signal.SIGTERM)
         status, pid, _ = wait_or_term_child(qemu_pid, signal.SIGTERM,
                                             term_sigfd, 5)
@@ -1050,8 +1308,9 @@ username={3}@pcocc
     def watchdog(self, vm):
         while not stop_threads.wait(30):
             try:
-                s_ctl = self._get_agent_ctl_safe(vm, QEMU_GUEST_AGENT_PORT, 5,
+                agent = self._get_agent_ctl_safe(vm, QEMU_GUEST_AGENT_PORT, 5,
                                                  False)
+                agent.close()
                 systemd_notify('Watchdog successful at {0}'.format(
                     datetime.datetime.now()), watchdog=True)
 
@@ -1059,12 +1318,6 @@ username={3}@pcocc
                 systemd_notify('Watchdog could not query guest at {0}'.format(
                     datetime.datetime.now()))
 
-            try:
-                s_ctl.terminate()
-                s_ctl.communicate()
-            except Exception:
-                pass
-
         logging.info('Got thread termination event')
 
     def dump(self, vm, dumpfile):
@@ -1083,31 +1336,61 @@ username={3}@pcocc
         mon.close_monitor()
         return res
 
-    def checkpoint(self, vm, ckpt_dir):
+    def _checkpoint_uri(self, vm, ckpt_dir, compression, direct, live=False):
         dest_mem_file = self.checkpoint_mem_file(vm, ckpt_dir)
+        vm_state = self.read_vm_states([vm.rank])[vm.rank]
+        return 'exec:' + compression.save_pipeline(
+            dest_mem_file, (vm_state['value'] or {}).get('cpus'), direct,
+            live)
+
+    def live_checkpoint(self, vm, ckpt_dir, compression, direct=False):
+        """Starts copying the memory of a running VM
+
+        Returns a LiveCheckpoint to follow the pre-copy and pause the VM.
+
+        """
+        ckpt = LiveCheckpoint(vm, self._checkpoint_uri(vm, ckpt_dir,
+                                                       compression, direct,
+                                                       live=True))
+        try:
+            ckpt.start()
+        except PcoccError as err:
+            ckpt.close()
+            raise CheckpointError(str(err))
+        return ckpt
+
+    def checkpoint(self, vm, ckpt_dir, compression, direct=False):
+        dest_uri = self._checkpoint_uri(vm, ckpt_dir, compression, direct)
 
         mon = RemoteMonitor(vm)
         mon.stop()
+        events = mon.subscribe(['MIGRATION'])
+        mon.enable_migration_events()
+        # Left enabled by a previous live checkpoint of a VM kept running
+        mon.set_migration_capability('pause-before-switchover', False)
+        data = ''
 
         try:
-            mon.start_migration(dest_mem_file)
+            mon.start_migration(dest_uri)
             retry_count = 0
             status = 'failed'
 
             while True:
-                time.sleep(1)
-                data = mon.query_migration()
+                # Wake up on migration status changes or every second to
+                # report progress
+                events.get(timeout=1)
+                ret = mon.query_migration()
+                data = json.dumps(ret)
 
-                ret =  json.loads(data)
                 # If we are too fast, it seems qemu doesn't return the status
-                if not 'status' in ret["return"]:
+                if not 'status' in ret:
                     continue
 
-                status = ret["return"]["status"]
+                status = ret["status"]
                 if status == "active":
-                    remain_mb = (int(ret["return"]["ram"]["remaining"])
+                    remain_mb = (int(ret["ram"]["remaining"])
                                  // (1024 * 1024))
-                    tot_mb = (int(ret["return"]["ram"]["total"])
+                    tot_mb = (int(ret["ram"]["total"])
                               // (1024 * 1024))
                     remain_pct = 100. * remain_mb / tot_mb
 
@@ -1125,7 +1408,7 @@ username={3}@pcocc
                     if retry_count < Config().ckpt_retry_count:
                         retry_count += 1
                         sys.stderr.write('Retrying...\n')
-                        mon.start_migration(dest_mem_file)
+                        mon.start_migration(dest_uri)
                         continue
                     else:
                         break
@@ -1149,7 +1432,8 @@ username={3}@pcocc
 
 
         if status != 'completed':
-            raise CheckpointError('status is %s. Monitor sent: ' + data)
+            raise CheckpointError('status is %s. Monitor sent: %s' % (status,
+                                                                     data))
 
         mon.close_monitor()
 
@@ -1160,6 +1444,80 @@ username={3}@pcocc
         s_mon.quit()
         s_mon.close_monitor()
 
+    def resume(self, vm):
+        mon = RemoteMonitor(vm)
+        mon.cont()
+        mon.close_monitor()
+
+    def _ckpt_disk_key(self, vm_rank):
+        return 'checkpoint/disks/{0}'.format(vm_rank)
+
+    def checkpoint_disk(self, vm, ckpt_dir):
+        """Saves the disk of a VM in a checkpoint
+
+        The first checkpoint of a VM copies its temporary overlay,
+        which is on top of the image or checkpoint the VM was started
+        from. A dirty bitmap is created along with this copy so that
+        later checkpoints of the same running VM only copy the
+        clusters written since the previous one, on top of its disk.
+        Returns the backing file of the saved disk and whether it is
+        incremental.
+
+        """
+        dest_img_file = self.checkpoint_img_file(vm, ckpt_dir)
+        batch = Config().batch
+        key = self._ckpt_disk_key(vm.rank)
+        previous = decode_value(batch.read_key('cluster/user', key))
+
+        # The previous disk may have been deleted or overwritten by
+        # this checkpoint
+        if previous and (not os.path.exists(previous['path']) or
+                         os.path.exists(dest_img_file) and
+                         os.path.samefile(previous['path'], dest_img_file)):
+            previous = None
+
+        mon = RemoteMonitor(vm)
+        try:
+            has_bitmap = mon.has_dirty_bitmap('bootdisk', CKPT_BITMAP)
+            if previous and has_bitmap:
+                backing = previous['path']
+                try:
+                    subprocess_check_output(['ssh', vm.get_host(),
+                                             'qemu-img', 'create',
+                                             '-f', 'qcow2',
+                                             '-b', backing,
+                                             '-F', previous['format'],
+                                             dest_img_file])
+                except (OSError, subprocess.CalledProcessError):
+                    raise ImageSaveError('unable to create incremental '
+                                         'disk image')
+                mon.drive_backup('bootdisk', dest_img_file, 'incremental',
+                                 CKPT_BITMAP)
+                incremental = True
+            else:
+                image = mon.query_block_image('bootdisk')['image']
+                backing = image.get('full-backing-filename',
+                                    image.get('backing-filename'))
+                try:
+                    mon.drive_backup('bootdisk', dest_img_file, 'top',
+                                     CKPT_BITMAP,
+                                     'clear' if has_bitmap else 'add')
+                except ImageSaveError as err:
+                    # Qemu < 2.5 cannot manage bitmaps in transactions
+                    logging.warning('Unable to track dirty blocks of vm%d, '
+                                    'disk checkpoints will not be '
+                                    'incremental: %s', vm.rank, err)
+                    mon.drive_backup('bootdisk', dest_img_file)
+                incremental = False
+        finally:
+            mon.close_monitor()
+
+        batch.write_key('cluster/user', key,
+                        encode_value({'path': dest_img_file,
+                                      'format': 'qcow2'}))
+
+        return {'backing': backing, 'incremental': incremental}
+
     def save(self, vm, dest_img_file, full=False, freeze=VM_FREEZE_OPT.TRY):
         remote_host = vm.get_host()
         vm_image_path = vm.image_path
@@ -1233,307 +1591,356 @@ username={3}@pcocc
                 raise ImageSaveError('Unable to rebase disk')
 
     def _get_agent_ctl_safe(self, vm, port='taskcontrolport', timeout=0, kill_atexit=True):
-        # We need to make several tries because nc and qemu may drop or
-        # input silently if we race with them
-        # We assume that a broken pipe means nc/qemu was not ready and
-        # everything we sent was lost, unless we already received data from
-        # it which means something went wrong and we stop retrying
-        while 1:
-            s_ctl = self.socket_connect(vm, 'serial_{0}_socket'.format(port), kill_atexit)
-            syn_id = random.randint(100000000,999999999)
-            qga_cmd = '{"execute":"guest-sync", "arguments": { "id": %d }}\n\n' % syn_id
-            logging.debug("Sending agent sync %s", qga_cmd)
-
-            # TODO: Remove this wait. For now, without it, some of the data we
-            # send is lost
-            time.sleep(1)
-
-            retry_send = True
-            while 1:
-                if retry_send:
-                    rdy = select.select([s_ctl.stdout],
-                                        [s_ctl.stdin], [])
-                else:
-                    rdy = select.select([s_ctl.stdout], [], [], timeout)
-
-                if timeout and rdy == ([], [], []):
-                    self._cleanup_and_raise(s_ctl, AgentError("Timeout pinging agent"))
+        """Connects and synchronizes with a guest agent
 
-                if s_ctl.stdout in rdy[0]:
-                    data = os.read(s_ctl.stdout.fileno(), QMP_READ_SIZE)
-                    if not data:
-                        # Pipe closed, retry
-                        break
-
-                    if data.find(str(syn_id)) == -1:
-                        self._cleanup_and_raise(s_ctl, AgentError("unexpected answer when "
-                                                                  "pinging VM agent  "
-                                                                  "%s\n" % data))
-                    return s_ctl
-
-                if retry_send and s_ctl.stdin in rdy[1]:
-                    try:
-                        s_ctl.stdin.write(qga_cmd)
-                        retry_send = False
-                    except IOError as err:
-                        # Qemu wasn't ready, retry
-                        if err.errno == errno.EPIPE:
-                            break
-                        else:
-                            raise
+        The agent session is held by the VM process which may not be
+        ready yet, in which case we retry with an exponential backoff.
 
+        """
+        interval = AGENT_RETRY_MIN_INTERVAL
+        while 1:
+            start = time.time()
+            channel = self.socket_connect(vm, agent_socket_name(port),
+                                          kill_atexit)
+            agent = QGAClient(channel)
             try:
-                if s_ctl.poll() is None:
-                    s_ctl.terminate()
-            except Exception:
-                pass
-
-            s_ctl.communicate()
+                agent.sync(timeout)
+                return agent
+            except QMPTimeoutError:
+                agent.close()
+                raise AgentError("Timeout pinging agent")
+            except QMPConnectionError:
+                agent.close()
 
             if timeout:
-                # Shave 5 seconds off of the timeout as we are
-                # going to sleep for that much before retry our select
-                timeout -= 5
+                # Shave the time spent and the time we are going to
+                # sleep off of the timeout
+                timeout -= time.time() - start + interval
                 if timeout <= 0:
-                    self._cleanup_and_raise(s_ctl, AgentError("Timeout pinging agent"))
+                    raise AgentError("Timeout pinging agent")
 
             # wait before trying a reconnection
-            time.sleep(5)
-
-    def _cleanup_and_raise(self, sproc, error):
-        try:
-            if not sproc.poll():
-                sproc.terminate()
-        except Exception:
-            pass
-
-        try:
-            sproc.communicate()
-        except Exception:
-            pass
+            time.sleep(interval)
+            interval = min(interval * 2, AGENT_RETRY_MAX_INTERVAL)
 
-        raise error
+    def _reattach_agent(self, vm):
+        """Waits for the result of an exec whose client went away"""
+        while 1:
+            agent = QGAClient(self.socket_connect(
+                    vm, agent_socket_name('taskcontrolport')))
+            try:
+                return agent, agent.execute_async(REATTACH_COMMAND)
+            except QMPConnectionError:
+                agent.close()
+                time.sleep(AGENT_RETRY_MAX_INTERVAL)
 
+    def put_file(self, vm, source_file, dest_file, progress=None):
+        """Copies a file or a directory to a VM
 
-    def put_file(self, vm, source_file, dest_file):
-        s_ctl = self._get_agent_ctl_safe(vm)
+        Directories are streamed as a tar archive which is extracted
+        in dest_file. progress is called with the number of bytes
+        sent and the total size if known.
 
+        """
+        agent = self._get_agent_ctl_safe(vm)
         try:
-            with open(source_file) as f:
-                encoded_source = base64.b64encode(f.read())
-        except IOError as err:
+            if os.path.isdir(source_file):
+                self._put_dir(vm, agent, source_file, dest_file, progress)
+            else:
+                with open(source_file, 'rb') as f:
+                    writer = GuestFileWriter(agent, dest_file)
+                    try:
+                        if progress:
+                            size = os.fstat(f.fileno()).st_size
+                            writer.progress = lambda count: progress(count,
+                                                                     size)
+                        for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE),
+                                          ''):
+                            writer.write(chunk)
+                    except (IOError, OSError):
+                        writer.abort()
+                        raise
+                    writer.close()
+
+                logging.debug('Agent wrote %s to %s (%s bytes)',
+                              source_file, dest_file, writer.written)
+        except (IOError, OSError, tarfile.TarError) as err:
             raise AgentError("unable to read source file "
                              "for copy: %s" % str(err))
-
+        except FileTransferError as err:
+            raise AgentError(str(err))
+        finally:
+            agent.close()
+
+    def _put_dir(self, vm, agent, source_dir, dest_dir, progress):
+        archive = self._guest_tmp_archive()
+        writer = GuestFileWriter(agent, archive)
+        if progress:
+            writer.progress = lambda count: progress(count, None)
         try:
-            s_ctl.stdin.write('{"execute":"guest-file-open",'
-                              '"arguments":{"path":"%s",'
-                              '"mode":"w+"}}\n\n'%(dest_file))
-            data = os.read(s_ctl.stdout.fileno(), QMP_READ_SIZE)
-            handle = json.loads(data)["return"]
-
-
-            s_ctl.stdin.write('{"execute":"guest-file-write",'
-                              '"arguments":{"handle":%d,'
-                              '"buf-b64":"%s"}}' %
-                              (handle, encoded_source))
-            data = os.read(s_ctl.stdout.fileno(), QMP_READ_SIZE)
-            count = json.loads(data)["return"]["count"]
-            eof = json.loads(data)["return"]["eof"]
-
-            fsize = os.stat(source_file).st_size
-            if count < fsize:
-                raise AgentError("Wrote only {0} out of {1} bytes of {2}".format(
-                    count, fsize, source_file))
-
-            if eof:
-                raise AgentError("Unexepected EOF writing {0}".format(source_file))
+            tar = tarfile.open(fileobj=writer, mode='w|')
+            tar.add(source_dir, arcname=os.path.basename(
+                    os.path.normpath(source_dir)))
+            tar.close()
+        except (IOError, OSError, tarfile.TarError):
+            writer.abort()
+            raise
+        writer.close()
 
-            s_ctl.stdin.write('{"execute":"guest-file-close",'
-                              '"arguments":{"handle":%d}}' %
-                              handle)
+        self._guest_shell(vm, 'mkdir -p {1} && '
+                          'tar --no-same-owner -xf {0} -C {1}; '
+                          'ret=$?; rm -f {0}; exit $ret'.format(
+                              pipes.quote(archive), pipes.quote(dest_dir)))
 
-            data = os.read(s_ctl.stdout.fileno(), QMP_READ_SIZE)
-            ret = json.loads(data)["return"]
-            if ret:
-                raise ValueError
+    def get_file(self, vm, source_file, dest_file, recursive=False,
+                 progress=None):
+        """Copies a file or, if recursive is set, a directory from a VM
 
-            logging.debug('Agent wrote %s to %s (%s bytes)',
-                          source_file, dest_file, count)
+        Directories are extracted in dest_file. progress is called with
+        the number of bytes received and the total size if known.
 
-        except IOError as err:
-            raise AgentError("failed to communicate:  %s" % err)
-        except (KeyError, ValueError)  as err:
-            raise AgentError("unexpected answer when "
-                             "receiving exec output "
-                             "%s\n" % data)
+        """
+        agent = self._get_agent_ctl_safe(vm)
+        try:
+            if recursive:
+                self._get_dir(vm, agent, source_file, dest_file, progress)
+                return
 
-        s_ctl.terminate()
+            reader = GuestFileReader(agent, source_file)
+            try:
+                if progress:
+                    size = reader.size()
+                    reader.progress = lambda count: progress(count, size)
+
+                with open(dest_file, 'wb') as f:
+                    for chunk in iter(lambda: reader.read(FILE_CHUNK_SIZE),
+                                      ''):
+                        f.write(chunk)
+            except (IOError, OSError, FileTransferError):
+                reader.abort()
+                raise
+            reader.close()
+        except (IOError, OSError) as err:
+            raise AgentError("unable to write destination file "
+                             "for copy: %s" % str(err))
+        except tarfile.TarError as err:
+            raise AgentError("invalid archive received: %s" % str(err))
+        except FileTransferError as err:
+            raise AgentError(str(err))
+        finally:
+            agent.close()
+
+    def _get_dir(self, vm, agent, source_dir, dest_dir, progress):
+        archive = self._guest_tmp_archive()
+        source_dir = os.path.normpath(source_dir)
+        self._guest_shell(vm, 'tar -cf {0} -C {1} {2}'.format(
+                pipes.quote(archive),
+                pipes.quote(os.path.dirname(source_dir) or '.'),
+                pipes.quote(os.path.basename(source_dir))))
 
+        try:
+            reader = GuestFileReader(agent, archive)
+            try:
+                if progress:
+                    size = reader.size()
+                    reader.progress = lambda count: progress(count, size)
+
+                if not os.path.isdir(dest_dir):
+                    os.makedirs(dest_dir)
+
+                tar = tarfile.open(fileobj=reader, mode='r|')
+                for member in tar:
+                    check_tar_member(member)
+                    tar.extract(member, dest_dir)
+                tar.close()
+            except (IOError, OSError, tarfile.TarError, FileTransferError):
+                reader.abort()
+                raise
+            reader.close()
+        finally:
+            self._guest_shell(vm, 'rm -f {0}'.format(pipes.quote(archive)))
+
+    def _guest_tmp_archive(self):
+        return '/tmp/pcocc-cp-{0}.tar'.format(binascii.b2a_hex(
+                os.urandom(8)))
+
+    def _guest_shell(self, vm, script):
+        """Runs a shell script as root in a VM, raises AgentError on failure"""
+        output = []
+        ret = self.exec_cmd(vm, ['sh', '-c', script], 'root', output.append)
+        if ret != 0:
+            raise AgentError("command failed with status {0}: {1}".format(
+                    ret, ''.join(output).strip()))
 
     def fsfreeze(self, vm, port=QEMU_GUEST_AGENT_PORT, timeout=0):
-        s_ctl = self._get_agent_ctl_safe(vm, port, timeout)
-        s_ctl.stdin.write('{"execute":"guest-fsfreeze-freeze"}')
-        data = os.read(s_ctl.stdout.fileno(), QMP_READ_SIZE)
+        agent = self._get_agent_ctl_safe(vm, port, timeout)
         try:
-            ret = json.loads(data)
-        except:
-            raise AgentError("Failed to parse agent output")
-
-        if "error" in ret:
-            raise AgentError("Error while freezing VM: " + ret["error"]["desc"])
+            ret = agent.execute('guest-fsfreeze-freeze')
+        except QMPError as err:
+            raise AgentError("Error while freezing VM: " + str(err))
+        finally:
+            agent.close()
 
-        ret = json.loads(data)["return"]
         if  ret <= 0:
             raise AgentError("No filesystem frozen")
 
         print 'vm{0} frozen'.format(vm.rank)
-        s_ctl.terminate()
 
     def fsthaw(self, vm, port=QEMU_GUEST_AGENT_PORT, timeout=0):
-        s_ctl = self._get_agent_ctl_safe(vm, port, timeout)
-        s_ctl.stdin.write('{"execute":"guest-fsfreeze-thaw"}')
-        data = os.read(s_ctl.stdout.fileno(), QMP_READ_SIZE)
+        agent = self._get_agent_ctl_safe(vm, port, timeout)
         try:
-            ret = json.loads(data)
-        except:
-            raise AgentError("Failed to parse agent output")
-
-        if "error" in ret:
-            raise AgentError("Error while thawing VM: " + ret["error"]["desc"])
-
-        ret = json.loads(data)["return"]
+            ret = agent.execute('guest-fsfreeze-thaw')
+        except QMPError as err:
+            raise AgentError("Error while thawing VM: " + str(err))
+        finally:
+            agent.close()
 
         if ret > 0:
             print 'vm{0} thawed'.format(vm.rank)
 
-        s_ctl.terminate()
+    def _reply_notifier(self, reply):
+        """Returns a pipe which becomes readable when reply is received"""
+        notify_r, notify_w = os.pipe()
+
+        def notify(_):
+            os.write(notify_w, 'x')
+            os.close(notify_w)
+
+        reply.add_callback(notify)
+        return notify_r
+
+    def exec_cmd(self, vm, cmd, user, output=None):
+        """Executes a command in a VM and returns its exit code
+
+        The command output is passed to the output function, by
+        default it is written directly to the stdout file descriptor.
+        If output has a splice_from method, it is given the I/O stream
+        descriptor to move data without reading it.
+
+        """
+        if output is None:
+            sys.stdout.flush()
+            output = FdWriter(sys.stdout.fileno())
 
-    def exec_cmd(self, vm, cmd, user):
         if cmd:
-            s_ctl = self._get_agent_ctl_safe(vm)
-        else:
-            # FIXME: When resuming the agent might already be busy
-            # so we cannot go through the safe connection which pings...
-            s_ctl = self.socket_connect(vm,
-                                         'serial_taskcontrolport_socket')
+            agent = self._get_agent_ctl_safe(vm)
 
-        # Create a ssh tunnel to the io pipe
-        # TODO: integrate this to the agent
-        s_io = self.socket_connect(vm,
-                                    'serial_taskioport_socket')
+        s_io = self._io_connect(vm)
 
         # Send a command if we need to
         if cmd:
-            arglist = "".join("{\"argument\": \"%s\"},"%arg for arg in cmd[1:])
-            arglist = arglist[:-1]
-
-            envlist = "".join("{\"nameval\": %s},"
-                              %(json.dumps(name+'='+val)) for (name, val) in
-                              os.environ.iteritems()
-                              if not re.search(r'SLURM', name))
-            envlist = envlist[:-1]
-
-            qga_cmd = ('{"execute": "guest-cmd-exec", "arguments":{'
-                       '"username": "%s",'
-                       '"path": "%s",'
-                       '"cmd": "%s",'
-                       '"arguments": [ %s ],'
-                       '"env": [ %s ]'
-                       '} }\n\n'%(user,
-                                  os.getcwd(),
-                                  cmd[0],
-                                  arglist,
-                                  envlist))
-            try:
-                s_ctl.stdin.write(qga_cmd)
+            env = [{'nameval': name + '=' + val}
+                   for (name, val) in os.environ.iteritems()
+                   if not re.search(r'SLURM', name)]
 
-            except IOError as err:
+            try:
+                reply = agent.execute_async('guest-cmd-exec',
+                                            {'username': user,
+                                             'path': os.getcwd(),
+                                             'cmd': cmd[0],
+                                             'arguments': [{'argument': arg}
+                                                           for arg in cmd[1:]],
+                                             'env': env})
+            except QMPError as err:
+                agent.close()
                 raise AgentError("failed to send cmd to guest agent: %s "
                                  % err)
+        else:
+            # When resuming, wait for the result of the command which
+            # was running before the checkpoint
+            agent, reply = self._reattach_agent(vm)
+
+        done_fd = self._reply_notifier(reply)
 
         # Poll the I/O stream as long as the command is runnning
         # Return the command return value when it exits
+        io_open = True
         while 1:
-            rdy = select.select([s_ctl.stdout, s_io.stdout],
-                                [], [])
+            if io_open:
+                rdy = select.select([done_fd, s_io.stdout], [], [])
+            else:
+                rdy = select.select([done_fd], [], [])
 
             if s_io.stdout in rdy[0]:
-                data = os.read(s_io.stdout.fileno(), 4096)
-
-                if data:
-                    print data,
-
-            if s_ctl.stdout in rdy[0]:
-                data = os.read(s_ctl.stdout.fileno(), 4096)
+                io_open = self._forward_io(s_io, output) > 0
 
+            if done_fd in rdy[0]:
+                os.close(done_fd)
                 try:
-                    retval = json.loads(data)["return"]
-                    if retval != 0:
-                        sys.stderr.write("vm%d: exit %d\n"%(vm.rank,
-                                                            retval))
+                    retval = reply.result()
 
                     # Make sure we read everything from the I/O pipe
                     # before exiting
-                    self._flush_outstanding_io(s_io)
+                    self._flush_outstanding_io(s_io, output)
 
-                    s_ctl.terminate()
-                    s_ctl.communicate()
+                    agent.close()
                     s_io.terminate()
                     s_io.communicate()
 
                     return retval
 
-                except (ValueError, KeyError) as err:
-                    if not data:
-                        # Flush IO to prevent losing data
-                        self._flush_outstanding_io(s_io)
-
-                        s_ctl.poll()
-                        if s_ctl.returncode == 0:
-                            # If the connexion was closed properly
-                            # it means qemu existed. We should do the same
-                            # sys.stderr.write("Agent closed\n")
-                            s_io.terminate()
-                            s_io.communicate()
-                            return 0
-
-                        elif s_ctl.returncode and not cmd:
-                            # FIXME: This can happen when
-                            # resuming since we can not go through the
-                            # safe connect method because the agent may
-                            # already be busy.
-                            # We assume that qemu was not ready yet
-                            # and just retry
-                            # sys.stderr.write("Retrying connection\n")
-                            s_io.terminate()
-                            s_io.communicate()
-                            s_ctl = self.socket_connect(vm,
-                                           'serial_taskcontrolport_socket')
-                            s_io = self.socket_connect(vm,
-                                           'serial_taskioport_socket')
-                            time.sleep(5)
-                            continue
-                        else:
-                            # Should not happen
-                            sys.stderr.write('Connection did not exit\n')
+                except QMPConnectionError:
+                    # Flush IO to prevent losing data
+                    self._flush_outstanding_io(s_io, output)
+
+                    returncode = agent.channel.poll()
+                    agent.close()
+                    if returncode == 0:
+                        # If the connexion was closed properly
+                        # it means qemu existed. We should do the same
+                        s_io.terminate()
+                        s_io.communicate()
+                        return 0
+
+                    elif returncode and not cmd:
+                        # This can happen when resuming if the VM
+                        # process is not ready yet: just retry
+                        s_io.terminate()
+                        s_io.communicate()
+                        time.sleep(5)
+                        agent, reply = self._reattach_agent(vm)
+                        s_io = self._io_connect(vm)
+                        io_open = True
+                        done_fd = self._reply_notifier(reply)
+                        continue
+                    else:
+                        # Should not happen
+                        sys.stderr.write('Connection did not exit\n')
+                        raise AgentError("connection to VM agent lost "
+                                         "while waiting for exec output")
 
+                except QMPError as err:
+                    agent.close()
                     raise AgentError("unexpected answer when "
                                      "receiving exec output from VM agent: "
-                                     "%s -\n" % data)
+                                     "%s -\n" % err)
+
+    def _forward_io(self, subproc, output):
+        """Forwards data available on an I/O stream to output
 
-    def _flush_outstanding_io(self, subproc):
+        Returns the number of bytes forwarded, 0 at the end of the
+        stream.
+
+        """
+        fd = subproc.stdout.fileno()
+        splice_from = getattr(output, 'splice_from', None)
+        if splice_from:
+            count = splice_from(fd, IO_BUFFER_SIZE)
+            if count is not None:
+                return count
+
+        data = os.read(fd, IO_BUFFER_SIZE)
+        if data:
+            output(data)
+        return len(data)
+
+    def _flush_outstanding_io(self, subproc, output):
         # Make sure we read everything from the I/O pipe
         # before exiting
         while True:
             rdy = select.select([subproc.stdout], [], [], 0)
-            if subproc.stdout in rdy[0]:
-                data = os.read(subproc.stdout.fileno(), 4096)
-                if data:
-                    print data,
-                else:
-                    break
-            else:
+            if (subproc.stdout not in rdy[0] or
+                not self._forward_io(subproc, output)):
                 break
 
     def checkpoint_mem_file(self, vm, ckpt_dir):
@@ -1543,40 +1950,123 @@ username={3}@pcocc
         return os.path.join(ckpt_dir,'disk-vm%d' % (vm.rank))
 
     def socket_connect(self,vm, name, kill_atexit=True):
+        """Connects to a VM socket
+
+        Sockets of VMs on the current host are directly connected,
+        others are opened through the relay of their host which is
+        shared by all sockets of this host.
+
+        """
         batch = Config().batch
-        remote_host = vm.get_host()
         io_file = batch.get_vm_state_path(vm.rank,
                                           name)
-        lock.acquire()
-        subproc = subprocess.Popen(shlex.split('ssh %s nc -U %s'%(
-                    remote_host, io_file)),
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             stdin=subprocess.PIPE)
+        return self._connect_target(vm, io_file, kill_atexit)
+
+    def read_console_log(self, vm, request, output):
+        """Streams a window of the console log of a VM to output
+
+        The request selects the window as described by
+        ConsoleLog.window and may ask to follow the console
+        output. Returns the absolute offset at which the output
+        stopped, which can be used to resume reading.
+
+        """
+        channel = self.socket_connect(vm, 'pcocc_console_log_socket')
+        try:
+            channel.stdin.write(json.dumps(request) + '\n')
+            header = channel.stdout.readline()
+            if not header:
+                raise HypervisorError('unable to connect to the console '
+                                      'log of vm{0}'.format(vm.rank))
+            header = json.loads(header)
+            if 'error' in header:
+                raise HypervisorError('unable to read console log: '
+                                      + header['error'])
+
+            position = header['start']
+            fd = channel.stdout.fileno()
+            while True:
+                data = os.read(fd, IO_BUFFER_SIZE)
+                if not data:
+                    break
+                position += len(data)
+                output(data)
+        finally:
+            channel.terminate()
+
+        return position
+
+    def vsock_connect(self, vm, port, kill_atexit=True):
+        """Connects to a vsock port of a VM, locally or through a relay"""
+        return self._connect_target(vm, self._vsock_target(vm, port),
+                                    kill_atexit)
+
+    def _vsock_target(self, vm, port):
+        return vsock_target(vm.vsock_cid, port,
+                            Config().batch.get_vm_state_path(vm.rank,
+                                                             'vsock_token'))
+
+    def _io_connect(self, vm):
+        """Connects to the exec I/O stream of a VM"""
+        if vm.vsock:
+            return self.vsock_connect(vm, VSOCK_IO_PORT)
+        else:
+            return self.socket_connect(vm, 'serial_taskioport_socket')
+
+    def _connect_target(self, vm, target, kill_atexit):
+        if vm.is_on_node():
+            channel = local_connect(target)
+        else:
+            channel = self._get_relay(vm.get_host()).connect(target)
+
         if kill_atexit:
-            atexit.register(try_kill, subproc)
+            atexit.register(try_kill, channel)
 
-        lock.release()
+        return channel
 
-        return subproc
+    def _get_relay(self, remote_host):
+        with lock:
+            relay = self._relays.get(remote_host)
+            if relay is None or not relay.alive:
+                logging.debug('Starting relay to %s', remote_host)
+                relay = RelayClient(lambda: ssh_transport(remote_host))
+                atexit.register(relay.close)
+                self._relays[remote_host] = relay
+
+            return relay
 
     def _set_vm_state(self, state, desc, value, vm_rank):
+        # The whole history is published to measure startup phases
+        history = self._vm_history.setdefault(vm_rank, [])
+        history.append(transition(state, desc))
         Config().batch.write_key('cluster/user',
                                        self._vm_state_key(vm_rank),
-                                       yaml.dump({'state': state,
-                                                  'desc': desc,
-                                                  'value': value}))
+                                       encode_value({'state': state,
+                                                     'desc': desc,
+                                                     'value': value,
+                                                     'history': history}))
 
     def _unpack_vm_state(self, value):
         if value:
-            return yaml.safe_load(value)
+            return decode_value(value)
         else:
             return {'state': 'not-started',
                     'desc': 'waiting for batch manager',
-                    'value': None}
+                    'value': None,
+                    'history': []}
+
+    def _vm_state_dir(self):
+        return "state/vms"
 
     def _vm_state_key(self, vm_rank):
-        return "state/vms/{0}".format(vm_rank)
+        return "{0}/{1}".format(self._vm_state_dir(), vm_rank)
+
+    def read_vm_states(self, vm_ranks):
+        """Returns the current state of VMs indexed by rank"""
+        states = Config().batch.read_dir_values('cluster/user',
+                                                self._vm_state_dir())
+        return dict((rank, self._unpack_vm_state(states.get(str(rank))))
+                    for rank in vm_ranks)
 
     def wait_vm_start(self, vm):
         """Wait for vm to start"""
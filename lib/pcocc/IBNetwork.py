@@ -12,7 +12,7 @@ import signal
 from .Config import Config
 from .NetUtils import VFIOInfinibandVF
 from .HostIBNetwork import VHostIBNetwork
-from .Misc import IDAllocator
+from .Misc import IDAllocator, encode_value, decode_value, validate_schema
 from .Error import PcoccError
 from .NetUtils import NetworkSetupError, ibdev_get_guid
 
@@ -141,8 +141,8 @@ required:
                                                   self._get_net_key_path('guids'),
                                                   len(net_hosts))
             sm_config = {}
-            sm_config['host_guids'] = [ str(child.value) for child
-                                       in global_guids.children ]
+            sm_config['host_guids'] = [ str(value) for value
+                                       in global_guids.itervalues() ]
             sm_config['vf_guids'] = [ vm_get_port_guid(vm, my_pkey) for vm
                                       in cluster.vms
                                       if self.name in vm.networks ]
@@ -150,7 +150,7 @@ required:
             logging.info("Requesting OpenSM update for %s",
                          self.name)
             batch.write_key('global', 'opensm/pkeys/' + str(hex(my_pkey)),
-                            sm_config)
+                            encode_value(sm_config))
 
         net_res['master'] = master
         net_res['pkey'] = my_pkey
@@ -236,11 +236,11 @@ required:
 
                 # Load configuration and validate against schema
                 try:
-                    config = yaml.safe_load(child.value)
-                    jsonschema.validate(config,
-                                        yaml.safe_load(self._pkey_entry_schema))
+                    config = decode_value(child.value)
+                    validate_schema(config, self._pkey_entry_schema,
+                                    child.value)
                     pkeys[pkey] = config
-                except yaml.YAMLError as e:
+                except (yaml.YAMLError, ValueError) as e:
                     logging.warning("Misconfigured PKey %s: %s",
                                     pkey, e)
                     continue
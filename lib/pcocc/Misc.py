@@ -19,6 +19,10 @@
 import signal
 import threading
 import os
+import sys
+import time
+import stat
+import ctypes
 import fcntl
 import select
 import logging
@@ -26,9 +30,10 @@ import errno
 import socket
 import datetime
 import jsonschema
+import json
 import yaml
 
-from pcocc.Backports import  enum
+from pcocc.Backports import  enum, OrderedDict
 from pcocc.Config import Config
 from pcocc.Error import PcoccError
 
@@ -138,12 +143,229 @@ def systemd_notify(status, ready=False, watchdog=False):
 
     return True
 
+class TaskGraph(object):
+    """Runs interdependent tasks concurrently
+
+    Each task runs in its own thread once the tasks it depends on have
+    completed. The duration of each task is recorded in timings.
+
+    """
+    def __init__(self):
+        self._tasks = OrderedDict()
+        self.results = {}
+        self.timings = OrderedDict()
+
+    def add(self, name, func, deps=()):
+        """Adds a task calling func with no arguments after deps"""
+        for dep in deps:
+            if dep not in self._tasks:
+                raise ValueError('unknown task dependency: ' + dep)
+        self._tasks[name] = (func, deps)
+
+    def run(self):
+        """Runs all tasks and returns their results by name
+
+        Tasks depending on a failed task are not run. Once all other
+        tasks have completed, the exception of the first failed task
+        is raised again.
+
+        """
+        done = dict((name, threading.Event()) for name in self._tasks)
+        failures = []
+        lock = threading.Lock()
+
+        def run_task(name, func, deps):
+            try:
+                for dep in deps:
+                    done[dep].wait()
+                with lock:
+                    if any(dep not in self.results for dep in deps):
+                        return
+                start = time.time()
+                result = func()
+                with lock:
+                    self.timings[name] = time.time() - start
+                    self.results[name] = result
+            except Exception:
+                # The traceback is lost when the exception is raised
+                # again from the calling thread
+                logging.debug('Task %s failed', name, exc_info=True)
+                with lock:
+                    failures.append(sys.exc_info())
+            finally:
+                done[name].set()
+
+        threads = []
+        for name, (func, deps) in self._tasks.iteritems():
+            thread = threading.Thread(None, run_task,
+                                      args=(name, func, deps))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        if failures:
+            raise failures[0][1]
+
+        return self.results
+
+# Size of reads when forwarding bulk data such as command outputs
+IO_BUFFER_SIZE = 1024 * 1024
+
+SPLICE_F_MOVE = 1
+
+def _libc_splice():
+    try:
+        splice = ctypes.CDLL(None, use_errno=True).splice
+    except AttributeError:
+        return None
+    splice.restype = ctypes.c_ssize_t
+    splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                       ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    return splice
+
+class FdWriter(object):
+    """Writes data directly to a file descriptor
+
+    This bypasses Python file objects and their buffering. When the
+    descriptor is a pipe, data can also be moved to it from another
+    descriptor with splice, without being copied to user space.
+
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        if stat.S_ISFIFO(os.fstat(fd).st_mode):
+            self._splice = _libc_splice()
+        else:
+            self._splice = None
+
+    def __call__(self, data):
+        offset = 0
+        while offset < len(data):
+            try:
+                offset += os.write(self.fd, buffer(data, offset))
+            except OSError as err:
+                if err.errno != errno.EINTR:
+                    raise
+
+    def splice_from(self, fd, size=IO_BUFFER_SIZE):
+        """Moves up to size bytes from fd
+
+        Returns the number of bytes moved, 0 at the end of fd, or None
+        if data cannot be spliced and has to be read and written.
+
+        """
+        while self._splice:
+            count = self._splice(fd, None, self.fd, None, size,
+                                 SPLICE_F_MOVE)
+            if count >= 0:
+                return count
+
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in (errno.EINVAL, errno.ENOSYS):
+                # Not supported for this kind of source
+                self._splice = None
+                break
+            raise OSError(err, os.strerror(err))
+
+        return None
+
 epoch = datetime.datetime.utcfromtimestamp(0)
 def datetime_to_epoch(dt):
     return int((dt - epoch).total_seconds())
 
-#Schema to validate the global key state in the key/value store
+# Values stored in the key/value store are prefixed by a codec tag.
+# The tag is a YAML comment and JSON is valid YAML so that values can
+# still be read by older versions while jobs are running.
+VALUE_CODEC_PREFIX = '#pcocc:json:1\n'
 
+def _native_strings(obj):
+    """Converts unicode strings returned by the JSON decoder to str
+    when they are plain ASCII, as done by the YAML loader"""
+    if isinstance(obj, unicode):
+        try:
+            return obj.encode('ascii')
+        except UnicodeEncodeError:
+            return obj
+    elif isinstance(obj, list):
+        return [_native_strings(o) for o in obj]
+    elif isinstance(obj, dict):
+        return dict((_native_strings(k), _native_strings(v))
+                    for k, v in obj.iteritems())
+    else:
+        return obj
+
+def encode_value(value):
+    """Serializes a value to be stored in the key/value store"""
+    return VALUE_CODEC_PREFIX + json.dumps(value, separators=(',', ':'))
+
+def decode_value(data):
+    """Deserializes a value read from the key/value store
+
+    Values without a codec tag were written as YAML by older versions.
+
+    """
+    if data is None:
+        return None
+
+    if data.startswith(VALUE_CODEC_PREFIX):
+        return _native_strings(json.loads(data[len(VALUE_CODEC_PREFIX):]))
+
+    return yaml.safe_load(data)
+
+# Compiled validators indexed by schema text
+_schema_validators = {}
+
+# Serialized values which were already validated or written by us,
+# indexed by schema text
+_validated_values = OrderedDict()
+_validated_lock = threading.Lock()
+VALIDATED_VALUES_MAX = 64
+
+def schema_validator(schema):
+    """Returns a validator for a YAML schema which is only parsed once"""
+    try:
+        return _schema_validators[schema]
+    except KeyError:
+        validator = jsonschema.Draft4Validator(yaml.safe_load(schema))
+        _schema_validators[schema] = validator
+        return validator
+
+def validate_schema(instance, schema, raw=None):
+    """Validates an instance against a YAML schema
+
+    raw is the serialized instance as found in the key/value store. If
+    the same serialized value was already validated or was produced by
+    us, the instance is trusted and not validated again.
+
+    """
+    if raw is not None:
+        with _validated_lock:
+            if (schema, raw) in _validated_values:
+                return
+
+    errors = list(schema_validator(schema).iter_errors(instance))
+    if errors:
+        raise jsonschema.ValidationError.create_from(
+            jsonschema.exceptions.best_match(errors))
+
+    if raw is not None:
+        mark_validated(raw, schema)
+
+def mark_validated(raw, schema):
+    """Records a serialized value as valid for a schema"""
+    key = (schema, raw)
+    with _validated_lock:
+        _validated_values.pop(key, None)
+        while len(_validated_values) >= VALIDATED_VALUES_MAX:
+            _validated_values.popitem(last=False)
+        _validated_values[key] = True
+
+#Schema to validate the global key state in the key/value store
 id_allocation_schema = """
 type: array
 items:
@@ -196,14 +418,14 @@ class IDAllocator(object):
 
             Config().batch.write_key('cluster',
                                      coll_path,
-                                     yaml.dump(ids))
+                                     encode_value(ids))
         else:
             ids = Config().batch.read_key('cluster',
                                           coll_path,
                                           blocking=True,
                                           timeout=30)
 
-            ids = yaml.safe_load(ids)
+            ids = decode_value(ids)
 
         return ids
 
@@ -214,35 +436,39 @@ class IDAllocator(object):
             self._do_free_ids,
             ids)
 
-    def _do_free_ids(self, id_indexes, id_alloc_state):
+    def _do_free_ids(self, id_indexes, raw_state):
         """Helper to free unique ids using the key/value store"""
-        id_alloc_state = yaml.safe_load(id_alloc_state)
-        jsonschema.validate(id_alloc_state,
-                            yaml.safe_load(id_allocation_schema))
+        id_alloc_state = decode_value(raw_state)
+        validate_schema(id_alloc_state, id_allocation_schema, raw_state)
 
         batchid = Config().batch.batchid
         id_alloc_state[:] = [ allocated_id for allocated_id in id_alloc_state if
                               allocated_id['batchid'] != batchid or
                               allocated_id['pkey_index'] not in id_indexes ]
 
-        return yaml.dump(id_alloc_state), None
+        raw_state = encode_value(id_alloc_state)
+        mark_validated(raw_state, id_allocation_schema)
+        return raw_state, None
 
-    def _do_alloc_ids(self, count, id_alloc_state):
+    def _do_alloc_ids(self, count, raw_state):
         """Helper to allocate unique ids using the key/value store"""
         batch = Config().batch
 
-        if not id_alloc_state:
+        if not raw_state:
             id_alloc_state = []
         else:
-            id_alloc_state = yaml.safe_load(id_alloc_state)
+            id_alloc_state = decode_value(raw_state)
 
-        jsonschema.validate(id_alloc_state,
-                            yaml.safe_load(id_allocation_schema))
+        validate_schema(id_alloc_state, id_allocation_schema, raw_state)
 
         num_ids_preclean = len(id_alloc_state)
         # Cleanup completed jobs
         try:
-            joblist = batch.list_all_jobs()
+            joblist = set(batch.list_all_jobs())
+            if any(int(pk['batchid']) not in joblist
+                   for pk in id_alloc_state):
+                # Make sure recent jobs are not mistaken for stale ones
+                joblist = set(batch.list_all_jobs(refresh=True))
             id_alloc_state = [ pk for pk in id_alloc_state
                                  if int(pk['batchid']) in joblist ]
         except PcoccError:
@@ -280,4 +506,6 @@ class IDAllocator(object):
             id_alloc_state.append({'pkey_index': i,
                                    'batchid': batch.batchid})
 
-        return yaml.dump(id_alloc_state), id_indexes
+        raw_state = encode_value(id_alloc_state)
+        mark_validated(raw_state, id_allocation_schema)
+        return raw_state, id_indexes
@@ -23,6 +23,7 @@ from abc import ABCMeta, abstractmethod
 from .Error import  InvalidConfigurationError
 from .Config import Config
 from .NetUtils import NetworkSetupError
+from .Misc import encode_value, decode_value
 
 network_config_schema = """
 type: object
@@ -141,14 +142,15 @@ class VNetwork(object):
         """Store config data describing the allocated resources
         in the key/value store
 
-        Called when setting up a node for a virtual cluster
+        Called when setting up a node for a virtual cluster. The
+        resources are written along with the next host state update.
 
         """
         batch = Config().batch
-        batch.write_key(
+        batch.defer_write_key(
             'cluster',
             '{0}/{1}'.format(self.name, batch.node_rank),
-            yaml.dump(res))
+            encode_value(res))
 
     def load_resources(self):
         """Read config data describing the allocated resources
@@ -162,7 +164,7 @@ class VNetwork(object):
             raise NetworkSetupError('unable to load resources for network '
                                     + self.name)
 
-        return yaml.safe_load(data)
+        return decode_value(data)
 
     @abstractmethod
     def init_node(self):
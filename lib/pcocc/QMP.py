@@ -0,0 +1,527 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Clients for the Qemu monitor (QMP) and guest agent (QGA) protocols
+
+All connections of a process are served by a single reactor thread
+which reads and decodes incoming messages. Commands can be issued
+concurrently from any thread: each request gets an id and its reply is
+delivered through a Reply object. Asynchronous events are dispatched to
+the queues of their subscribers.
+
+"""
+
+import os
+import json
+import errno
+import select
+import random
+import socket
+import logging
+import threading
+import time
+
+from Queue import Queue, Empty
+
+from .Backports import OrderedDict
+from .Error import PcoccError
+
+READ_SIZE = 65536
+
+# Initial and maximum intervals between guest agent sync attempts
+SYNC_MIN_INTERVAL = 0.01
+SYNC_MAX_INTERVAL = 1
+
+class QMPError(PcoccError):
+    """Exception raised when a command returns an error"""
+    def __init__(self, error, error_class=None):
+        super(QMPError, self).__init__(error)
+        self.error_class = error_class
+
+class QMPConnectionError(QMPError):
+    """Exception raised when the connection is closed"""
+    def __init__(self, error='connection closed'):
+        super(QMPConnectionError, self).__init__(error)
+
+class QMPTimeoutError(QMPError):
+    """Exception raised when a reply is not received in time"""
+    def __init__(self, error='timeout waiting for reply'):
+        super(QMPTimeoutError, self).__init__(error)
+
+class Reply(object):
+    """Pending reply to a command"""
+    def __init__(self, command):
+        self.command = command
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._reply = []
+        self._callbacks = []
+
+    def _set(self, result, error):
+        with self._lock:
+            self._reply[:] = [result, error]
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for callback in callbacks:
+            callback(self)
+
+    def add_callback(self, callback):
+        """Calls callback with the reply once it is received"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Returns the command result or raises its error"""
+        if timeout is None:
+            # Waiting without a timeout is not interruptible in Python 2
+            while not self._event.wait(3600):
+                pass
+        elif not self._event.wait(timeout):
+            raise QMPTimeoutError('timeout waiting for {0}'.format(
+                    self.command))
+        result, error = self._reply
+        if error is not None:
+            raise error
+        return result
+
+class EventQueue(object):
+    """Queue of events with the subscribed names
+
+    None is queued when the connection is closed.
+
+    """
+    def __init__(self, names):
+        self.names = set(names)
+        self._queue = Queue()
+
+    def _put(self, event):
+        self._queue.put(event)
+
+    def get(self, timeout=None):
+        """Returns the next event or None if the timeout expired"""
+        while True:
+            try:
+                return self._queue.get(timeout=timeout or 3600)
+            except Empty:
+                if timeout is not None:
+                    return None
+
+class Reactor(object):
+    """Poll loop reading from all registered connections
+
+    Connections are polled with epoll as processes handling large
+    clusters may use file descriptors above the select() limit. If the
+    loop fails, all connections are closed so that pending replies
+    are not waited for forever.
+
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conns = {}
+        self._epoll = select.epoll()
+        self._thread = None
+        self.stopped = False
+
+    @classmethod
+    def shared(cls):
+        """Returns the reactor shared by all connections of the process"""
+        with cls._shared_lock:
+            if cls._shared is None or cls._shared.stopped:
+                cls._shared = cls()
+            return cls._shared
+
+    def register(self, conn):
+        with self._lock:
+            if self.stopped:
+                raise QMPConnectionError('connection reactor stopped')
+            try:
+                self._epoll.register(conn.fileno(), select.EPOLLIN)
+            except IOError as e:
+                # The descriptor of a connection which was not
+                # unregistered has been reused
+                if e.errno != errno.EEXIST:
+                    raise
+            self._conns[conn.fileno()] = conn
+            if self._thread is None:
+                self._thread = threading.Thread(None, self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def unregister(self, conn):
+        with self._lock:
+            if self._conns.get(conn.fileno()) is not conn:
+                return
+            del self._conns[conn.fileno()]
+            try:
+                self._epoll.unregister(conn.fileno())
+            except (IOError, ValueError):
+                # Closed descriptors are removed by the kernel
+                pass
+
+    def _run(self):
+        try:
+            self._loop()
+        except Exception:
+            logging.exception('Connection reactor failed')
+        finally:
+            with self._lock:
+                self.stopped = True
+                conns = self._conns.values()
+                self._conns.clear()
+            for conn in conns:
+                conn._handle_close()
+
+    def _loop(self):
+        while True:
+            try:
+                events = self._epoll.poll(-1)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            for fd, _ in events:
+                with self._lock:
+                    conn = self._conns.get(fd)
+                if conn is None:
+                    continue
+
+                try:
+                    data = os.read(fd, READ_SIZE)
+                except OSError as e:
+                    if e.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    data = ''
+
+                if not data:
+                    self.unregister(conn)
+                    conn._handle_close()
+                else:
+                    try:
+                        conn._feed(data)
+                    except Exception:
+                        logging.exception('Error handling monitor data')
+
+class Connection(object):
+    """Connection to a JSON command protocol (QMP or guest agent)
+
+    channel may be a socket or a relayed socket and must provide
+    fileno(). Replies are matched to requests with their id or in
+    order for implementations which don't return ids, or for replies
+    to requests sent before connecting (see expect_reply).
+
+    """
+    # Byte which is never part of a message and resets the decoder
+    reset_byte = None
+
+    def __init__(self, channel, reactor=None):
+        self.channel = channel
+        self._fd = channel.fileno()
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._next_id = 1
+        self._subscribers = []
+        self._reactor = reactor or Reactor.shared()
+        self.closed = False
+        self._reactor.register(self)
+
+    def fileno(self):
+        return self._fd
+
+    def _send(self, msg, prefix=''):
+        data = prefix + json.dumps(msg) + '\n'
+        while data:
+            try:
+                count = os.write(self._fd, data)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise QMPConnectionError(str(e))
+            data = data[count:]
+
+    def execute_async(self, command, arguments=None):
+        """Sends a command and returns its pending Reply"""
+        msg = {'execute': command}
+        if arguments is not None:
+            msg['arguments'] = arguments
+
+        reply = Reply(command)
+        with self._lock:
+            if self.closed:
+                raise QMPConnectionError()
+            msg['id'] = self._next_id
+            self._next_id += 1
+            self._pending[msg['id']] = reply
+            try:
+                self._send(msg)
+            except QMPConnectionError:
+                del self._pending[msg['id']]
+                raise
+
+        return reply
+
+    def expect_reply(self, command):
+        """Returns a Reply for a command sent by a previous connection"""
+        reply = Reply(command)
+        with self._lock:
+            if self.closed:
+                raise QMPConnectionError()
+            self._pending[object()] = reply
+        return reply
+
+    def execute(self, command, arguments=None, timeout=None):
+        """Runs a command and returns its result"""
+        return self.execute_async(command, arguments).result(timeout)
+
+    def subscribe(self, names):
+        """Returns an EventQueue receiving the events with these names"""
+        queue = EventQueue(names)
+        with self._lock:
+            if self.closed:
+                queue._put(None)
+            self._subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            if queue in self._subscribers:
+                self._subscribers.remove(queue)
+
+    def _feed(self, data):
+        if self.reset_byte:
+            # Anything incomplete before a reset byte is garbage
+            for i, chunk in enumerate(data.split(self.reset_byte)):
+                if i:
+                    self._buf = ''
+                self._decode(chunk)
+        else:
+            self._decode(data)
+
+    def _decode(self, data):
+        self._buf += data
+        while True:
+            buf = self._buf.lstrip()
+            if not buf:
+                self._buf = ''
+                return
+
+            try:
+                msg, end = self._decoder.raw_decode(buf)
+            except ValueError:
+                # Messages are on a single line, so a complete line which
+                # cannot be decoded is garbage
+                newline = buf.find('\n')
+                if newline == -1:
+                    self._buf = buf
+                    return
+                logging.debug('Discarding invalid data: %s', buf[:newline])
+                self._buf = buf[newline + 1:]
+                continue
+
+            self._buf = buf[end:]
+            if isinstance(msg, dict):
+                self._dispatch(msg)
+
+    def _handle_message(self, msg):
+        """Hook for protocol specific messages, returns True if handled"""
+        return False
+
+    def _dispatch(self, msg):
+        if self._handle_message(msg):
+            return
+
+        if 'event' in msg:
+            with self._lock:
+                queues = [q for q in self._subscribers
+                          if msg['event'] in q.names]
+            for queue in queues:
+                queue._put(msg)
+            return
+
+        if not ('return' in msg or 'error' in msg):
+            logging.debug('Ignoring unexpected message: %s', msg)
+            return
+
+        with self._lock:
+            reply = None
+            if msg.get('id') in self._pending:
+                reply = self._pending.pop(msg['id'])
+            elif self._pending:
+                reply = self._pending.popitem(last=False)[1]
+
+        if reply is None:
+            self._handle_orphan(msg)
+        elif 'error' in msg:
+            reply._set(None, QMPError(msg['error'].get('desc', str(msg)),
+                                      msg['error'].get('class')))
+        else:
+            reply._set(msg['return'], None)
+
+    def _handle_orphan(self, msg):
+        """Hook for replies which don't match any request"""
+        logging.debug('Ignoring reply to unknown request: %s', msg)
+
+    def _handle_close(self):
+        with self._lock:
+            self.closed = True
+            pending = self._pending.values()
+            self._pending.clear()
+            subscribers = list(self._subscribers)
+
+        for reply in pending:
+            reply._set(None, QMPConnectionError())
+        for queue in subscribers:
+            queue._put(None)
+
+    def close(self):
+        """Closes the connection and the underlying channel"""
+        self._reactor.unregister(self)
+        self._handle_close()
+        try:
+            if hasattr(self.channel, 'terminate'):
+                self.channel.terminate()
+                self.channel.communicate()
+            else:
+                self.channel.close()
+        except (OSError, socket.error):
+            pass
+
+class QMPClient(Connection):
+    """Client for the Qemu monitor protocol"""
+    def __init__(self, channel, timeout=None, reactor=None):
+        self.greeting = None
+        self._greeted = threading.Event()
+        super(QMPClient, self).__init__(channel, reactor)
+
+        if not self._greeted.wait(timeout) or self.greeting is None:
+            self.close()
+            raise QMPConnectionError('no greeting from qemu monitor')
+
+        self.execute('qmp_capabilities', timeout=timeout)
+
+    def _handle_message(self, msg):
+        if 'QMP' in msg:
+            self.greeting = msg
+            self._greeted.set()
+            return True
+        return False
+
+    def _handle_close(self):
+        super(QMPClient, self)._handle_close()
+        self._greeted.set()
+
+class QGAClient(Connection):
+    """Client for the Qemu guest agent protocol
+
+    The agent may have unread data or replies from a previous session
+    in its buffers. sync() must be called first to discard them. Stale
+    replies are passed to orphan_handler if set.
+
+    """
+    # Sent by the agent before the reply to guest-sync-delimited
+    reset_byte = '\xff'
+
+    def __init__(self, channel, reactor=None, orphan_handler=None):
+        self._sync_ids = set()
+        self._sync_command = 'guest-sync-delimited'
+        self._synced = threading.Event()
+        self._synced.set()
+        self._orphan_handler = orphan_handler
+        super(QGAClient, self).__init__(channel, reactor)
+
+    def _handle_message(self, msg):
+        # Sync replies are integers, other replies may be unhashable
+        ret = msg.get('return')
+        if isinstance(ret, (int, long)) and ret in self._sync_ids:
+            # Answer to our sync, or duplicate answer to a retry
+            self._synced.set()
+            return True
+
+        if self._synced.is_set():
+            return False
+
+        # Discard everything until we get the answer to our sync
+        error = msg.get('error', {})
+        if (error.get('class') == 'CommandNotFound' and
+            self._sync_command in error.get('desc', '')):
+            # Agents older than Qemu 1.1
+            self._sync_command = 'guest-sync'
+        elif 'return' in msg or 'error' in msg:
+            self._handle_orphan(msg)
+        return True
+
+    def _handle_orphan(self, msg):
+        if self._orphan_handler:
+            self._orphan_handler(msg)
+        else:
+            super(QGAClient, self)._handle_orphan(msg)
+
+    def _handle_close(self):
+        super(QGAClient, self)._handle_close()
+        self._synced.set()
+
+    def sync(self, timeout=None, retry_interval=SYNC_MIN_INTERVAL):
+        """Synchronizes with the agent
+
+        The sync request is sent again with an exponential backoff
+        starting at retry_interval seconds as it may be silently
+        dropped if the guest side isn't ready. A 0xff byte is sent
+        first to reset the agent parser.
+
+        """
+        sync_id = random.randint(100000000, 999999999)
+        self._sync_ids.add(sync_id)
+        self._synced.clear()
+        if timeout:
+            deadline = time.time() + timeout
+
+        interval = retry_interval
+        while True:
+            with self._lock:
+                if self.closed:
+                    raise QMPConnectionError()
+                self._send({'execute': self._sync_command,
+                            'arguments': {'id': sync_id}}, self.reset_byte)
+
+            wait = interval
+            if timeout:
+                wait = min(wait, deadline - time.time())
+
+            if self._synced.wait(max(wait, 0)):
+                if self.closed:
+                    raise QMPConnectionError()
+                return
+
+            if timeout and time.time() >= deadline:
+                raise QMPTimeoutError('timeout pinging agent')
+
+            interval = min(interval * 2, max(SYNC_MAX_INTERVAL,
+                                             retry_interval))
@@ -0,0 +1,403 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Multiplexing of VM UNIX sockets over a single stream
+
+A relay process runs on each host which is accessed (pcocc internal
+relay, usually started through ssh) and opens the VM sockets, or the
+vsock ports of its guests, on behalf of the client. All sockets of a
+host opened by a client process share the same connection.
+
+"""
+
+import os
+import errno
+import fcntl
+import select
+import socket
+import struct
+import logging
+import threading
+import subprocess
+
+from .Error import PcoccError
+from .Vsock import is_vsock_target, vsock_opener
+
+MSG_OPEN = 1
+MSG_DATA = 2
+MSG_CLOSE = 3
+
+# Channel id, message type and payload length
+FRAME_HEADER = struct.Struct('!IBI')
+MAX_FRAME_DATA = 65536
+
+# Stop reading from a side when this much data is queued for the other
+MAX_BACKLOG = 16 * 1024 * 1024
+
+# Channel status sent when closing: 0 if the socket was closed after
+# being connected, 1 if it could not be opened
+STATUS_OK = 0
+STATUS_OPEN_FAILED = 1
+
+class RelayError(PcoccError):
+    """Exception raised when the relay connection fails"""
+    def __init__(self, error):
+        super(RelayError, self).__init__('Relay failure: ' + error)
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class _ChannelState(object):
+    def __init__(self, chan_id, sock):
+        self.id = chan_id
+        self.sock = sock
+        self.outbuf = bytearray()
+        # Set when the peer closed the channel
+        self.status = None
+
+class Multiplexer(object):
+    """Multiplexes byte stream channels over a pair of file descriptors
+
+    Each channel is bound to a local socket. Data read from the socket
+    is forwarded to the peer channel and data received from the peer is
+    written to the socket. On the relay side, opener is called with the
+    target of each channel opened by the client and must return a
+    connected socket.
+
+    """
+    def __init__(self, rfd, wfd, opener=None):
+        self._rfd = rfd
+        self._wfd = wfd
+        self._opener = opener
+        self._lock = threading.Lock()
+        self._channels = {}
+        self._next_id = 1
+        self._inbuf = bytearray()
+        self._outbuf = bytearray()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self.closed = False
+
+        _set_nonblocking(self._wfd)
+        _set_nonblocking(self._wakeup_r)
+        _set_nonblocking(self._wakeup_w)
+
+    def open(self, target):
+        """Opens a channel to target on the relay side
+
+        Returns the channel state and a socket connected to the
+        channel. The socket is closed by the multiplexer if the relay
+        fails to open the target.
+
+        """
+        ours, theirs = socket.socketpair()
+        ours.setblocking(0)
+
+        with self._lock:
+            if self.closed:
+                ours.close()
+                theirs.close()
+                raise RelayError('connection closed')
+            state = _ChannelState(self._next_id, ours)
+            self._next_id += 1
+            self._channels[state.id] = state
+            self._queue_frame(state.id, MSG_OPEN, target)
+
+        self._wakeup()
+        return state, theirs
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _queue_frame(self, chan_id, msg_type, payload=''):
+        self._outbuf += FRAME_HEADER.pack(chan_id, msg_type, len(payload))
+        self._outbuf += payload
+
+    def _close_channel(self, state, status=None):
+        """Closes the local socket of a channel
+
+        If status is not None, the channel was closed by the peer
+        with this status. Otherwise the peer is notified.
+
+        """
+        if self._channels.pop(state.id, None) is None:
+            return
+
+        if status is None:
+            self._queue_frame(state.id, MSG_CLOSE, str(STATUS_OK))
+        else:
+            state.status = status
+
+        try:
+            state.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        state.sock.close()
+
+    def _handle_frame(self, chan_id, msg_type, payload):
+        state = self._channels.get(chan_id)
+
+        if msg_type == MSG_OPEN:
+            if self._opener is None:
+                return
+            try:
+                sock = self._opener(str(payload))
+                sock.setblocking(0)
+                self._channels[chan_id] = _ChannelState(chan_id, sock)
+            except Exception as e:
+                logging.debug('Relay failed to open %s: %s', payload, e)
+                self._queue_frame(chan_id, MSG_CLOSE,
+                                  str(STATUS_OPEN_FAILED))
+        elif state is None:
+            # Data in flight for a channel we just closed
+            return
+        elif msg_type == MSG_DATA:
+            state.outbuf += payload
+        elif msg_type == MSG_CLOSE:
+            state.status = int(payload or STATUS_OK)
+            if not state.outbuf:
+                self._close_channel(state, state.status)
+
+    def _parse_frames(self):
+        while len(self._inbuf) >= FRAME_HEADER.size:
+            chan_id, msg_type, length = FRAME_HEADER.unpack_from(
+                buffer(self._inbuf))
+            end = FRAME_HEADER.size + length
+            if len(self._inbuf) < end:
+                break
+            payload = str(self._inbuf[FRAME_HEADER.size:end])
+            del self._inbuf[:end]
+            self._handle_frame(chan_id, msg_type, payload)
+
+    def _shutdown(self):
+        with self._lock:
+            self.closed = True
+            for state in self._channels.values():
+                self._close_channel(state, STATUS_OPEN_FAILED)
+
+    def run(self):
+        """Forwards data until the connection is closed"""
+        try:
+            self._run()
+        finally:
+            self._shutdown()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                channels = self._channels.values()
+                backlog = sum(len(s.outbuf) for s in channels)
+
+                rlist = [self._wakeup_r]
+                if backlog < MAX_BACKLOG:
+                    rlist.append(self._rfd)
+                if len(self._outbuf) < MAX_BACKLOG:
+                    rlist += [s.sock for s in channels if s.status is None]
+
+                wlist = [s.sock for s in channels if s.outbuf]
+                if self._outbuf:
+                    wlist.append(self._wfd)
+
+            try:
+                rdy_r, rdy_w, _ = select.select(rlist, wlist, [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            with self._lock:
+                if self._wakeup_r in rdy_r:
+                    try:
+                        os.read(self._wakeup_r, 4096)
+                    except OSError:
+                        pass
+
+                if self._rfd in rdy_r:
+                    data = os.read(self._rfd, MAX_FRAME_DATA)
+                    if not data:
+                        return
+                    self._inbuf += data
+                    self._parse_frames()
+
+                for state in channels:
+                    if state.id not in self._channels:
+                        continue
+
+                    if state.sock in rdy_w:
+                        try:
+                            count = state.sock.send(state.outbuf)
+                            del state.outbuf[:count]
+                        except socket.error as e:
+                            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                                self._close_channel(state)
+                                continue
+                        if state.status is not None and not state.outbuf:
+                            self._close_channel(state, state.status)
+                            continue
+
+                    if state.sock in rdy_r:
+                        try:
+                            data = state.sock.recv(MAX_FRAME_DATA)
+                        except socket.error as e:
+                            if e.errno in (errno.EAGAIN, errno.EINTR):
+                                continue
+                            data = ''
+
+                        if data:
+                            self._queue_frame(state.id, MSG_DATA, data)
+                        else:
+                            self._close_channel(state)
+
+                if self._wfd in rdy_w:
+                    try:
+                        count = os.write(self._wfd, self._outbuf)
+                        del self._outbuf[:count]
+                    except OSError as e:
+                        if e.errno not in (errno.EAGAIN, errno.EINTR):
+                            return
+
+class RelayChannel(object):
+    """Client end of a relayed socket
+
+    This mimics the subset of the subprocess.Popen interface which was
+    used with the ssh/nc processes relaying sockets: stdin and stdout
+    are file objects which can be selected, poll() returns None while
+    the channel is open, 0 once the remote socket was closed and a
+    positive value if it could not be opened.
+
+    """
+    def __init__(self, state, sock):
+        self._state = state
+        self._sock = sock
+        self.stdin = sock.makefile('wb', 0)
+        self.stdout = sock.makefile('rb', 0)
+        self.returncode = None
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def poll(self):
+        if self.returncode is None:
+            self.returncode = self._state.status
+        return self.returncode
+
+    def wait(self):
+        return self.poll()
+
+    def terminate(self):
+        if self._sock is None:
+            return
+
+        if self.poll() is None:
+            self.returncode = -15
+
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.stdin.close()
+        self.stdout.close()
+        self._sock.close()
+        self._sock = None
+
+    kill = terminate
+
+    def communicate(self):
+        self.terminate()
+        return '', ''
+
+class _LocalState(object):
+    def __init__(self, status):
+        self.status = status
+
+def local_connect(target):
+    """Connects directly to a local socket or vsock target
+
+    Returns a RelayChannel so that local and relayed sockets can be
+    used interchangeably.
+
+    """
+    try:
+        return RelayChannel(_LocalState(None), target_opener(target))
+    except socket.error:
+        # Behave as a relayed socket which couldn't be opened
+        ours, theirs = socket.socketpair()
+        ours.close()
+        return RelayChannel(_LocalState(STATUS_OPEN_FAILED), theirs)
+
+def unix_opener(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+def target_opener(target):
+    """Opens a UNIX socket path or a vsock target"""
+    if is_vsock_target(target):
+        return vsock_opener(target)
+    return unix_opener(target)
+
+def serve(rfd=0, wfd=1):
+    """Runs the relay side of a multiplexed connection"""
+    Multiplexer(rfd, wfd, opener=target_opener).run()
+
+def ssh_transport(host):
+    """Starts a relay on a host through ssh"""
+    proc = subprocess.Popen(['ssh', host, 'pcocc', 'internal', 'relay'],
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    return proc, proc.stdout.fileno(), proc.stdin.fileno()
+
+class RelayClient(object):
+    """Client side of a connection to a relay
+
+    transport is a function returning a process handle, which is
+    killed when the client is closed, and the file descriptors to read
+    from and write to the relay.
+
+    """
+    def __init__(self, transport):
+        self._proc, rfd, wfd = transport()
+        self._mux = Multiplexer(rfd, wfd)
+        self._thread = threading.Thread(None, self._mux.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def alive(self):
+        return not self._mux.closed
+
+    def connect(self, path):
+        """Opens a channel to a socket on the relay host"""
+        state, sock = self._mux.open(path)
+        return RelayChannel(state, sock)
+
+    def close(self):
+        if self._proc is not None:
+            try:
+                self._proc.kill()
+                self._proc.wait()
+            except OSError:
+                pass
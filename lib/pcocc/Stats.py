@@ -0,0 +1,139 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Startup statistics of virtual clusters
+
+Each VM and host publishes the history of its setup states in the
+keystore. Every transition is timestamped with both the wall clock,
+to align events across nodes, and the monotonic clock, to compute
+durations which are not affected by clock adjustments. The time spent
+in a state is the time until the next transition of the same node.
+
+"""
+
+import math
+import time
+
+from .Backports import monotonic, OrderedDict
+
+TERMINAL_STATES = ['complete', 'failed']
+
+def transition(state, desc):
+    """Returns a timestamped record of a state transition"""
+    return {'state': state,
+            'desc': desc,
+            'wall': time.time(),
+            'monotonic': monotonic()}
+
+def phase_durations(history):
+    """Returns the time spent in each state of a history
+
+    A total is added once the last state is complete.
+
+    """
+    durations = OrderedDict()
+    for cur, nxt in zip(history, history[1:]):
+        durations[cur['state']] = (durations.get(cur['state'], 0) +
+                                   nxt['monotonic'] - cur['monotonic'])
+
+    if history and history[-1]['state'] == 'complete':
+        durations['total'] = (history[-1]['monotonic'] -
+                              history[0]['monotonic'])
+
+    return durations
+
+def percentile(values, pct):
+    """Returns the nearest-rank percentile of a list of values"""
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+class StartupStats(object):
+    """Aggregates the setup histories of the nodes of a cluster
+
+    Nodes are either 'hosts' or 'vms'.
+
+    """
+    kinds = ['hosts', 'vms']
+
+    def __init__(self, now=None):
+        self._nodes = dict((kind, OrderedDict()) for kind in self.kinds)
+        self._now = now
+
+    def add(self, kind, name, host, history):
+        """Adds the state history of a node"""
+        durations = phase_durations(history)
+        node = {'host': host,
+                'state': history[-1]['state'] if history else 'not-started',
+                'start': history[0]['wall'] if history else None,
+                'complete': 'total' in durations,
+                'phases': durations}
+
+        # Nodes which are still starting are accounted for the time
+        # elapsed so far so that they show up as slow
+        if 'total' in durations:
+            node['total'] = durations['total']
+        elif history and node['state'] not in TERMINAL_STATES:
+            now = self._now if self._now is not None else time.time()
+            node['total'] = now - history[0]['wall']
+        else:
+            node['total'] = None
+
+        self._nodes[kind][name] = node
+
+    def nodes(self, kind):
+        return self._nodes[kind]
+
+    def phases(self, kind):
+        """Returns statistics for each phase across nodes of a kind"""
+        samples = OrderedDict()
+        for node in self._nodes[kind].itervalues():
+            for phase, duration in node['phases'].iteritems():
+                samples.setdefault(phase, []).append(duration)
+
+        # Keep the total last
+        if 'total' in samples:
+            samples['total'] = samples.pop('total')
+
+        return OrderedDict(
+            (phase, {'count': len(values),
+                     'min': min(values),
+                     'median': percentile(values, 50),
+                     'p99': percentile(values, 99),
+                     'max': max(values)})
+            for phase, values in samples.iteritems())
+
+    def slowest(self, kind, count):
+        """Returns the names of the slowest nodes of a kind
+
+        Nodes which failed or never started come first.
+
+        """
+        def key(name):
+            node = self._nodes[kind][name]
+            if node['total'] is None:
+                return (1, 0)
+            return (0, node['total'])
+
+        names = sorted(self._nodes[kind], key=key, reverse=True)
+        return names[:count]
+
+    def to_dict(self):
+        return dict((kind, {'phases': self.phases(kind),
+                            'nodes': self._nodes[kind]})
+                    for kind in self.kinds)
@@ -43,6 +43,7 @@ template_settings = {'image': (False, None, True),
                      'disk-cache': (False, 'unsafe', True),
                      'disk-model': (False, 'virtio', True),
                      'remote-display': (False, None, True),
+                     'vsock': (False, False, True),
                      'description': (False, '', False),
                      'persistent-drives': (False, [], True),
                      'placeholder': (False, False, False)}
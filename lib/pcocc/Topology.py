@@ -0,0 +1,270 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+import os
+import re
+import stat
+import logging
+import tempfile
+import subprocess
+import psutil
+
+from xml.etree import cElementTree as ElementTree
+from ClusterShell.NodeSet import RangeSet
+
+from .Backports import subprocess_check_output
+from .Error import PcoccError
+from .Misc import encode_value, decode_value
+
+TOPOLOGY_FORMAT_VERSION = 1
+CACHE_TYPE_RE = re.compile(r'L(\d)[diu]?Cache$')
+
+class TopologyError(PcoccError):
+    """Exception raised when the node topology cannot be determined"""
+    def __init__(self, error):
+        super(TopologyError, self).__init__(
+            'Unable to determine node topology: ' + error)
+
+def parse_hwloc_cpuset(cpuset):
+    """Returns the set of PU OS indexes in an hwloc bitmap string
+
+    hwloc bitmaps are comma separated 32 bit hexadecimal words, the most
+    significant first, such as 0x0000000f,0xffffffff
+
+    """
+    mask = 0
+    for word in cpuset.split(','):
+        mask <<= 32
+        word = word.strip()
+        if word:
+            mask |= int(word, 16) & 0xffffffff
+
+    pus = set()
+    index = 0
+    while mask:
+        if mask & 1:
+            pus.add(index)
+        mask >>= 1
+        index += 1
+
+    return pus
+
+class Topology(object):
+    """In-memory model of the node topology
+
+    Cores and NUMA nodes are numbered with hwloc logical indexes, in the
+    order in which they appear in the topology tree, while PUs use their
+    OS indexes so that they can be directly used for CPU affinity.
+
+    """
+    def __init__(self, cores, numa_nodes=None, caches=None):
+        # List of PU OS indexes for each logical core
+        self._core_pus = [sorted(c['pus']) for c in cores]
+        # Logical NUMA node of each logical core
+        self._core_numa = [c.get('numa', 0) for c in cores]
+        # OS index of each logical NUMA node
+        self.numa_nodes = list(numa_nodes or [])
+        # Caches as dicts with their level, size and logical cores
+        self.caches = list(caches or [])
+
+        self._pu_core = {}
+        for core, pus in enumerate(self._core_pus):
+            for pu in pus:
+                self._pu_core[pu] = core
+
+    @classmethod
+    def from_xml(cls, data):
+        """Builds the topology from an lstopo XML export"""
+        try:
+            root = ElementTree.fromstring(data)
+        except SyntaxError as e:
+            raise TopologyError('invalid lstopo output: ' + str(e))
+
+        cores = []
+        numa_sets = []
+        cache_sets = []
+        orphan_pus = []
+
+        # Objects are listed in logical order by a depth first
+        # traversal of the tree
+        for obj in root.iter('object'):
+            obj_type = obj.get('type')
+            cpuset = parse_hwloc_cpuset(obj.get('cpuset', '0x0'))
+
+            if obj_type == 'Core':
+                pus = [int(pu.get('os_index'))
+                       for pu in obj.iter('object')
+                       if pu.get('type') == 'PU']
+                cores.append({'pus': pus or sorted(cpuset)})
+            elif obj_type == 'PU':
+                orphan_pus.append(int(obj.get('os_index')))
+            elif obj_type == 'NUMANode':
+                numa_sets.append((int(obj.get('os_index', len(numa_sets))),
+                                  cpuset))
+            elif obj_type == 'Cache' or CACHE_TYPE_RE.match(obj_type):
+                if obj_type == 'Cache':
+                    level = int(obj.get('depth', 0))
+                else:
+                    # hwloc 2 names caches L1Cache, L1iCache, L2Cache...
+                    level = int(CACHE_TYPE_RE.match(obj_type).group(1))
+                if obj.get('cache_type', '0') == '2':
+                    # Skip instruction caches
+                    continue
+                cache_sets.append((level, int(obj.get('cache_size', 0)),
+                                   cpuset))
+
+        # Without core objects, consider each PU as a core
+        if not cores:
+            cores = [{'pus': [pu]} for pu in orphan_pus]
+
+        if not cores:
+            raise TopologyError('no core found in lstopo output')
+
+        # hwloc 2 attaches NUMA nodes as memory children which may not
+        # appear in logical order
+        numa_sets.sort(key=lambda n: (min(n[1]) if n[1] else -1, n[0]))
+
+        for core in cores:
+            core['numa'] = 0
+            for i, (_, cpuset) in enumerate(numa_sets):
+                if core['pus'][0] in cpuset:
+                    core['numa'] = i
+                    break
+
+        topo = cls(cores, [os_index for os_index, _ in numa_sets])
+
+        for level, size, cpuset in cache_sets:
+            topo.caches.append({'level': level,
+                                'size': size,
+                                'cores': str(topo.cores_from_pus(cpuset))})
+
+        return topo
+
+    @classmethod
+    def detect(cls):
+        """Builds the topology of the current node using lstopo"""
+        try:
+            with open(os.devnull, 'w') as devnull:
+                data = subprocess_check_output(['lstopo-no-graphics',
+                                                '--of', 'xml', '--no-io', '-'],
+                                               stderr=devnull)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise TopologyError('hwloc (lstopo-no-graphics) is not '
+                                'available: ' + str(e))
+
+        return cls.from_xml(data)
+
+    @classmethod
+    def load(cls, path, owner=0):
+        """Loads a topology saved by a privileged setup process
+
+        Returns None if the file doesn't exist or cannot be trusted,
+        that is if it is not owned by the specified uid or writable by
+        other users.
+
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            return None
+
+        try:
+            st = os.fstat(fd)
+            if (st.st_uid != owner or
+                st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+                logging.warning('Ignoring topology file %s with unsafe '
+                                'permissions', path)
+                return None
+
+            with os.fdopen(os.dup(fd), 'r') as f:
+                data = decode_value(f.read())
+        except (OSError, IOError, ValueError) as e:
+            logging.warning('Unable to read topology file %s: %s', path, e)
+            return None
+        finally:
+            os.close(fd)
+
+        try:
+            if data['version'] != TOPOLOGY_FORMAT_VERSION:
+                return None
+            return cls(data['cores'], data['numa_nodes'], data['caches'])
+        except (KeyError, TypeError, IndexError) as e:
+            logging.warning('Invalid topology file %s: %s', path, e)
+            return None
+
+    def save(self, path):
+        """Atomically saves the topology to a world readable file"""
+        data = {'version': TOPOLOGY_FORMAT_VERSION,
+                'cores': [{'pus': pus, 'numa': numa}
+                          for pus, numa in zip(self._core_pus,
+                                               self._core_numa)],
+                'numa_nodes': self.numa_nodes,
+                'caches': self.caches}
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(encode_value(data))
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except (OSError, IOError):
+            os.unlink(tmp_path)
+            raise
+
+    @property
+    def num_cores(self):
+        return len(self._core_pus)
+
+    @property
+    def all_pus(self):
+        """Returns the OS indexes of all PUs"""
+        return sorted(self._pu_core)
+
+    def core_pus(self, cores):
+        """Returns the sorted OS indexes of PUs of the given cores"""
+        if isinstance(cores, (int, long, basestring)):
+            cores = [cores]
+
+        pus = []
+        for core in cores:
+            try:
+                pus += self._core_pus[int(core)]
+            except IndexError:
+                raise TopologyError('no such core: {0}'.format(core))
+        return sorted(pus)
+
+    def core_numa(self, core):
+        """Returns the logical NUMA node of a core"""
+        try:
+            return self._core_numa[int(core)]
+        except IndexError:
+            raise TopologyError('no such core: {0}'.format(core))
+
+    def cores_from_pus(self, pus):
+        """Returns the logical cores which intersect a set of PUs"""
+        return RangeSet.fromlist([str(self._pu_core[pu]) for pu in pus
+                                  if pu in self._pu_core])
+
+    def process_coreset(self, pid=None):
+        """Returns the logical cores a process is bound to"""
+        try:
+            affinity = psutil.Process(pid).cpu_affinity()
+        except psutil.Error as e:
+            raise TopologyError('unable to get CPU affinity: ' + str(e))
+
+        return self.cores_from_pus(affinity)
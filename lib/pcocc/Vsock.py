@@ -0,0 +1,147 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Host side of virtio-vsock connections to guests
+
+Any process of the host can connect to a guest vsock port, so each
+VM is given a random token which only the owner of the VM state
+directory can read. The token is passed to the guest through fw_cfg
+and sent as the first line of each connection so that the guest agent
+can reject other users.
+
+Vsock endpoints are described by targets of the form
+vsock:<cid>:<port>:<token file> which can be opened locally or through
+a relay like VM UNIX sockets.
+
+"""
+
+import os
+import errno
+import socket
+import ctypes
+import binascii
+
+VSOCK_DEVICE = '/dev/vhost-vsock'
+
+# Not defined by the socket module before Python 3.7
+AF_VSOCK = getattr(socket, 'AF_VSOCK', 40)
+
+# CIDs 0 to 2 are reserved for the hypervisor and the host
+VSOCK_CID_BASE = 3
+VSOCK_MAX_VMS = 1 << 16
+VSOCK_MAX_JOBS = (1 << 16) - 1
+
+# Guest ports of the pcocc agent and of the exec I/O streams. Each
+# connection is an independent stream.
+VSOCK_AGENT_PORT = 5000
+VSOCK_IO_PORT = 5001
+
+# Name of the token in the fw_cfg interface of the guest
+VSOCK_TOKEN_FW_CFG = 'opt/pcocc/vsock-token'
+VSOCK_TOKEN_BYTES = 32
+
+TARGET_PREFIX = 'vsock:'
+
+class _SockaddrVM(ctypes.Structure):
+    _fields_ = [('svm_family', ctypes.c_ushort),
+                ('svm_reserved1', ctypes.c_ushort),
+                ('svm_port', ctypes.c_uint),
+                ('svm_cid', ctypes.c_uint),
+                ('svm_zero', ctypes.c_ubyte * 4)]
+
+def guest_cid(batchid, rank):
+    """Returns the guest CID of a VM
+
+    CIDs are shared by all VMs of a host so they are derived from both
+    the rank of the VM and the id of its job.
+
+    """
+    return (VSOCK_CID_BASE + (batchid % VSOCK_MAX_JOBS) * VSOCK_MAX_VMS
+            + rank % VSOCK_MAX_VMS)
+
+def create_token(path):
+    """Generates a random token readable only by the current user"""
+    token = binascii.b2a_hex(os.urandom(VSOCK_TOKEN_BYTES))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+def vsock_target(cid, port, token_path):
+    return '{0}{1}:{2}:{3}'.format(TARGET_PREFIX, cid, port, token_path)
+
+def is_vsock_target(target):
+    return target.startswith(TARGET_PREFIX)
+
+def parse_target(target):
+    """Returns the cid, port and token path of a vsock target"""
+    cid, port, token_path = target[len(TARGET_PREFIX):].split(':', 2)
+    return int(cid), int(port), token_path
+
+def _libc_connect(cid, port):
+    # The socket module cannot handle vsock addresses before Python 3.7
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.socket(AF_VSOCK, socket.SOCK_STREAM, 0)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise socket.error(err, os.strerror(err))
+
+    try:
+        addr = _SockaddrVM(AF_VSOCK, 0, port, cid)
+        while libc.connect(fd, ctypes.byref(addr), ctypes.sizeof(addr)):
+            err = ctypes.get_errno()
+            if err != errno.EINTR:
+                raise socket.error(err, os.strerror(err))
+
+        return socket.fromfd(fd, AF_VSOCK, socket.SOCK_STREAM)
+    finally:
+        os.close(fd)
+
+def vsock_connect(cid, port):
+    """Returns a socket connected to a guest vsock port"""
+    if hasattr(socket, 'AF_VSOCK'):
+        sock = socket.socket(AF_VSOCK, socket.SOCK_STREAM)
+        try:
+            sock.connect((cid, port))
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    return _libc_connect(cid, port)
+
+def vsock_opener(target):
+    """Connects to a vsock target and authenticates with its token"""
+    try:
+        cid, port, token_path = parse_target(target)
+    except ValueError:
+        raise socket.error(errno.EINVAL, 'invalid vsock target ' + target)
+
+    try:
+        with open(token_path) as f:
+            token = f.read().strip()
+    except IOError as err:
+        raise socket.error(err.errno, err.strerror)
+
+    sock = vsock_connect(cid, port)
+    try:
+        sock.sendall(token + '\n')
+    except socket.error:
+        sock.close()
+        raise
+    return sock
@@ -33,14 +33,21 @@ import re
 import time
 import threading
 import pwd
+import json
 import logging
 import pcocc
 from pcocc.scripts import click
 from pcocc import PcoccError, Config, Cluster, Hypervisor
-from pcocc.Backports import subprocess_check_output
 from pcocc.Batch import ProcessType
 from pcocc.Misc import fake_signalfd, wait_or_term_child, stop_threads
+from pcocc.Relay import serve as relay_serve
 from pcocc.scripts.Shine.TextTable import TextTable
+from pcocc.Cluster import ExecOutput, DEFAULT_EXEC_FANOUT
+from pcocc.Checkpoint import MemoryCompression, CODECS, DEFAULT_CODEC
+from pcocc.Checkpoint import DEFAULT_MAX_DOWNTIME, checkpoint_disks
+from pcocc.Checkpoint import consolidate_disk, read_manifest, write_manifest
+from ClusterShell.NodeSet import NodeSet, RangeSet, NodeSetException
+from ClusterShell.NodeSet import RangeSetException
 
 helperdir = '/etc/pcocc/helpers'
 
@@ -132,6 +139,11 @@ def template():
     """ List and manage templates """
     pass
 
+@cli.group()
+def stats():
+    """ Display statistics about a virtual cluster """
+    pass
+
 DEFAULT_SSH_OPTS = [ '-o', 'UserKnownHostsFile=/dev/null', '-o',
                      'LogLevel=ERROR', '-o', 'StrictHostKeyChecking=no' ]
 
@@ -301,6 +313,106 @@ def pcocc_scp(jobid, jobname, user, scp_opts):
     except PcoccError as err:
         handle_error(err)
 
+def parse_cp_path(path):
+    """Splits a cp path into a list of vm indexes, or None for local
+    paths, and a path"""
+    match = re.match(r'(vm[^:/]*):(.*)$', path)
+    if not match:
+        return None, path
+    return vm_set_to_indexes(match.group(1)), match.group(2)
+
+def transfer_progress(name):
+    """Returns a progress callback for transfers displayed on a tty"""
+    if not sys.stderr.isatty():
+        return None
+
+    def progress(count, total):
+        if total:
+            sys.stderr.write('\r%s: %d / %d MB (%d %%)' % (
+                    name, count // 2**20, total // 2**20, 100 * count // total))
+        else:
+            sys.stderr.write('\r%s: %d MB' % (name, count // 2**20))
+        sys.stderr.flush()
+    return progress
+
+@cli.command(name='cp',
+             short_help='Copy files to or from VMs through the guest agent')
+@click.option('-j', '--jobid', type=int,
+              help='Jobid of the selected cluster')
+@click.option('-J', '--jobname',
+              help='Job name of the selected cluster')
+@click.option('-r', '--recursive', is_flag=True,
+              help='Copy directories')
+@click.option('-f', '--fanout', type=int,
+              default=DEFAULT_EXEC_FANOUT,
+              help='Maximum number of VMs copied to concurrently')
+@click.argument('source', nargs=1)
+@click.argument('dest', nargs=1)
+def pcocc_cp(jobid, jobname, recursive, fanout, source, dest):
+    """Copy files to or from VMs through the guest agent
+
+       Remote paths are prefixed by a VM name or a set of VMs to copy
+       a file to several VMs at once. This requires the pcocc agent
+       to be started in the guest but doesn't depend on network
+       access to the VMs.
+
+       \b
+       Example usage:
+              pcocc cp ./data vm[0-15]:/tmp/
+              pcocc cp -r vm0:/var/log ./vm0-logs
+    """
+    try:
+        load_config(jobid, jobname, default_batchname='pcocc')
+        cluster = load_batch_cluster()
+
+        src_vms, src_path = parse_cp_path(source)
+        dest_vms, dest_path = parse_cp_path(dest)
+
+        if (src_vms is None) == (dest_vms is None):
+            raise click.UsageError('exactly one of source and destination '
+                                   'must be a VM path')
+        if fanout < 1:
+            raise click.UsageError('fanout must be at least 1')
+
+        progress = None
+        if src_vms is not None:
+            if len(src_vms) != 1:
+                raise click.UsageError('files can only be copied from a '
+                                       'single VM')
+            check_vm_indexes(cluster, src_vms)
+            vm = cluster.vms[src_vms[0]]
+            if not recursive and os.path.isdir(dest_path):
+                dest_path = os.path.join(dest_path,
+                                         os.path.basename(src_path))
+            progress = transfer_progress(source)
+            vm.get_file(src_path, dest_path, recursive, progress)
+        else:
+            is_dir = os.path.isdir(src_path)
+            if is_dir and not recursive:
+                raise click.UsageError('%s is a directory' % src_path)
+
+            # The destination of a directory is the directory where it
+            # is extracted
+            if not is_dir and (not dest_path or dest_path.endswith('/')):
+                dest_path += os.path.basename(src_path)
+
+            check_vm_indexes(cluster, dest_vms)
+
+            if len(dest_vms) == 1:
+                progress = transfer_progress(source)
+
+            output = ExecOutput()
+            failed = cluster.put_file(dest_vms, src_path, dest_path or '.',
+                                      output, fanout, progress)
+            if failed:
+                sys.exit(output.status)
+
+        if progress:
+            sys.stderr.write('\n')
+
+    except PcoccError as err:
+        handle_error(err)
+
 @cli.command(name='nc',
              context_settings=dict(ignore_unknown_options=True),
              short_help='Connect to a VM via nc')
@@ -389,6 +501,22 @@ def vm_name_to_index(name):
 
     return int(match.group(1))
 
+def vm_set_to_indexes(vmset):
+    """Returns the indexes of a set of vms as vm[0-3] or 0-3"""
+    try:
+        if re.match(r'[\d,-]+$', vmset):
+            return [int(i) for i in RangeSet(vmset)]
+        return sorted(vm_name_to_index(name) for name in NodeSet(vmset))
+    except (NodeSetException, RangeSetException) as err:
+        raise click.UsageError("invalid vm set %s: %s" % (vmset, err))
+
+def check_vm_indexes(cluster, indexes):
+    """Checks that all indexes refer to VMs of the cluster"""
+    for index in indexes:
+        if not 0 <= index < len(cluster.vms):
+            raise PcoccError('vm%d does not exist in this cluster (vm0 to '
+                             'vm%d)' % (index, len(cluster.vms) - 1))
+
 @cli.command(name='save',
              short_help='Save the disk of a VM')
 @click.option('-j', '--jobid', type=int,
@@ -559,8 +687,28 @@ def pcocc_dump(jobid, jobname,  vm, dumpfile):
               help='Job name of the selected cluster')
 @click.option('-F', '--force', is_flag=True,
               help='Overwrite directory if exists')
+@click.option('-c', '--codec', type=click.Choice(sorted(CODECS)),
+              default=DEFAULT_CODEC,
+              help='Compression codec for memory images (default: %s)'
+              % DEFAULT_CODEC)
+@click.option('-l', '--level', type=int,
+              help='Compression level (default depends on the codec)')
+@click.option('-t', '--threads', type=int,
+              help='Compression threads per VM (default: one per host '
+              'core of the VM)')
+@click.option('-L', '--live', is_flag=True,
+              help='Copy memory while VMs are running and only pause '
+              'them at the end')
+@click.option('-d', '--max-downtime', type=float,
+              default=DEFAULT_MAX_DOWNTIME,
+              help='Maximum pause of VMs in live mode, in seconds '
+              '(default: %g)' % DEFAULT_MAX_DOWNTIME)
+@click.option('-k', '--keep-running', is_flag=True,
+              help='Resume VMs after the checkpoint instead of '
+              'terminating the cluster')
 @click.argument('ckpt-dir', nargs=1)
-def pcocc_ckpt(jobid, jobname, force, ckpt_dir):
+def pcocc_ckpt(jobid, jobname, force, codec, level, threads, live,
+               max_downtime, keep_running, ckpt_dir):
     """Checkpoint the current state of a cluster
 
     Both the disk image and memory of all VMs of the cluster are
@@ -572,6 +720,19 @@ def pcocc_ckpt(jobid, jobname, force, ckpt_dir):
     case, make sure you're not overwriting the checkpoint from which
     the cluster was restarted.
 
+    Memory images are compressed with zstd by default, using all host
+    cores of each VM.
+
+    In live mode, memory is copied while VMs keep running. VMs are
+    paused together once the memory which remains to be written
+    for each of them fits within the maximum downtime.
+
+    Disk images only contain the blocks written since the image or
+    checkpoint the VM was started from, or since the previous
+    checkpoint if the cluster was kept running. Checkpoints on which
+    others are based must be kept unless they are consolidated with
+    pcocc consolidate.
+
     \b
     Example usage:
            pcocc ckpt /path/to/checkpoints/mycheckpoint
@@ -580,10 +741,14 @@ def pcocc_ckpt(jobid, jobname, force, ckpt_dir):
     try:
         load_config(jobid, jobname, default_batchname='pcocc')
         cluster = load_batch_cluster()
+        compression = MemoryCompression(codec, level, threads)
+        if max_downtime <= 0:
+            raise click.UsageError('maximum downtime must be positive')
 
         dest_dir = validate_save_dir(ckpt_dir, force)
 
-        cluster.checkpoint(dest_dir)
+        cluster.checkpoint(dest_dir, compression, live, max_downtime,
+                           keep_running)
         click.secho('Cluster state succesfully checkpointed '
                     'to %s'%(dest_dir), fg='green')
 
@@ -591,6 +756,88 @@ def pcocc_ckpt(jobid, jobname, force, ckpt_dir):
         handle_error(err)
 
 
+@cli.command(name='consolidate',
+             short_help='Merge a checkpoint with the checkpoints it is based on')
+@click.argument('ckpt-dir', nargs=1)
+def pcocc_consolidate(ckpt_dir):
+    """Merge a checkpoint with the checkpoints it is based on
+
+    Disk images of a checkpoint only contain the blocks which were
+    modified since the checkpoint on which they are based. This
+    command copies the missing blocks from previous checkpoints so
+    that CKPT_DIR only depends on the original VM images and the
+    previous checkpoints can be deleted.
+
+    \b
+    Example usage:
+           pcocc consolidate /path/to/checkpoints/mycheckpoint
+
+    """
+    try:
+        ckpt_dir = os.path.abspath(ckpt_dir)
+        manifest = read_manifest(ckpt_dir)
+        try:
+            disks = checkpoint_disks(ckpt_dir)
+        except OSError as err:
+            raise click.UsageError('invalid checkpoint directory: ' +
+                                   err.strerror)
+
+        for disk in disks:
+            click.secho('Consolidating %s...' % disk)
+            backing = consolidate_disk(os.path.join(ckpt_dir, disk))
+            if backing is False:
+                continue
+            vm_name = disk[len('disk-'):]
+            manifest.setdefault('disks', {})[vm_name] = {
+                'backing': backing, 'incremental': False}
+            write_manifest(ckpt_dir, manifest)
+
+        click.secho('Checkpoint %s succesfully consolidated' % ckpt_dir,
+                    fg='green')
+
+    except PcoccError as err:
+        handle_error(err)
+
+
+LOG_TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+LOG_TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d',
+                    '%H:%M:%S', '%H:%M']
+
+def parse_log_time(value):
+    """Parses a time as a duration ago (10m) or a date (2017-07-09 22:58)
+
+    Times without a date are relative to the current day.
+
+    """
+    if value is None:
+        return None
+
+    match = re.match(r'(\d+)([smhd])$', value)
+    if match:
+        return time.time() - int(match.group(1)) * LOG_TIME_UNITS[
+            match.group(2)]
+
+    for fmt in LOG_TIME_FORMATS:
+        try:
+            t = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if '%Y' not in fmt:
+            t = datetime.datetime.combine(datetime.date.today(), t.time())
+        return time.mktime(t.timetuple())
+
+    raise click.BadParameter('invalid time: ' + value)
+
+def open_pager():
+    """Starts a pager if the output is a terminal"""
+    if not sys.stdout.isatty():
+        return None
+
+    env = dict(os.environ)
+    env.setdefault('LESS', '-R')
+    return subprocess.Popen(os.environ.get('PAGER', 'less'), shell=True,
+                            stdin=subprocess.PIPE, env=env)
+
 @cli.command(name='console',
              short_help='Connect to a VM console')
 @click.option('-j', '--jobid', type=int,
@@ -598,15 +845,36 @@ def pcocc_ckpt(jobid, jobname, force, ckpt_dir):
 @click.option('-J', '--jobname',
               help='Job name of the selected cluster')
 @click.option('-l', '--log', is_flag=True, help='Show console log')
+@click.option('-n', '--lines', type=int,
+              help='Show the last lines of the log')
+@click.option('-c', '--bytes', 'nbytes', type=int,
+              help='Show the last bytes of the log')
+@click.option('-o', '--offset', type=int,
+              help='Show the log from an absolute byte offset')
+@click.option('--since',
+              help='Show the log received since a date or duration ago')
+@click.option('--until',
+              help='Show the log received until a date or duration ago')
+@click.option('-f', '--follow', is_flag=True,
+              help='Keep showing the log as it is received')
+@click.option('-r', '--read-only', is_flag=True,
+              help='Watch the console without sending input')
 @click.argument('vm', nargs=1, default='vm0')
-def pcocc_console(jobid, jobname, log, vm):
+def pcocc_console(jobid, jobname, log, lines, nbytes, offset, since, until,
+                  follow, read_only, vm):
     """Connect to a VM console
 
-    Hit Ctrl-C 3 times to exit.
+    Hit Ctrl-C 3 times to exit. Only one client at a time may interact
+    with a console but any number of clients may watch it in read-only
+    mode.
+
+    Options selecting a part of the log imply --log. Logs of a set of
+    VMs are read concurrently.
 
     \b
     Example usage:
         pcocc console vm1
+        pcocc console -n 1000 vm[0-99]
 """
     try:
         signal.signal(signal.SIGINT, clean_exit)
@@ -615,32 +883,57 @@ def pcocc_console(jobid, jobname, log, vm):
         config = load_config(jobid, jobname, default_batchname='pcocc')
         cluster = load_batch_cluster()
 
-        index = vm_name_to_index(vm)
-        vm = cluster.vms[index]
-        vm.wait_start()
-        remote_host = vm.get_host()
+        for value in (lines, nbytes, offset):
+            if value is not None and value < 0:
+                raise click.UsageError('log offsets must be positive')
+
+        request = {'lines': lines, 'bytes': nbytes, 'offset': offset,
+                   'since': parse_log_time(since),
+                   'until': parse_log_time(until),
+                   'follow': follow}
+        if any(value is not None for value in request.itervalues()
+               if value is not False):
+            log = True
+
+        indexes = vm_set_to_indexes(vm)
+        check_vm_indexes(cluster, indexes)
+        for i in indexes:
+            cluster.vms[i].wait_start()
 
         if log:
+            pager = None
+            if not follow:
+                pager = open_pager()
+
+            if pager:
+                output = ExecOutput(prefix=len(indexes) > 1,
+                                    out=pager.stdin)
+            else:
+                output = ExecOutput(prefix=len(indexes) > 1)
+
+            # All followed logs are streamed at the same time
+            if follow:
+                fanout = len(indexes)
+            else:
+                fanout = DEFAULT_EXEC_FANOUT
+
             try:
-                # FIXME: reading the whole log at once will not
-                # work for large logs
-                log = subprocess_check_output(
-                    shlex.split(
-                        'ssh {0} cat {1}'.format(
-                            remote_host,
-                            config.batch.get_vm_state_path(
-                                vm.rank,
-                                'qemu_console_log'))))
-                click.echo_via_pager(log)
-            except Exception:
-                click.secho("Unable to read console log",
-                            fg='red', err=True)
-
-            sys.exit(0)
-
-
-        socket_path = config.batch.get_vm_state_path(vm.rank,
-                                                     'pcocc_console_socket')
+                cluster.console_log(indexes, request, output, fanout)
+            except (IOError, OSError) as err:
+                # The pager was exited early
+                if err.errno != errno.EPIPE:
+                    raise
+
+            if pager:
+                pager.stdin.close()
+                pager.wait()
+            sys.exit(output.status)
+
+        if len(indexes) > 1:
+            raise click.UsageError('only one vm console may be connected to')
+        vm = cluster.vms[indexes[0]]
+
+
         self_stdin = sys.stdin.fileno()
 
         # Raw terminal
@@ -650,9 +943,11 @@ def pcocc_console(jobid, jobname, log, vm):
         termios.tcsetattr(self_stdin, termios.TCSANOW,
                           new)
 
-        s_ctl = subprocess.Popen(
-            shlex.split('ssh %s nc -U %s ' % (remote_host, socket_path)),
-            stdin=subprocess.PIPE)
+        if read_only:
+            s_ctl = config.hyp.socket_connect(vm,
+                                              'pcocc_console_watch_socket')
+        else:
+            s_ctl = config.hyp.socket_connect(vm, 'pcocc_console_socket')
 
         # Restore terminal and cleanup children at exit
         atexit.register(cleanup, s_ctl, old)
@@ -660,11 +955,15 @@ def pcocc_console(jobid, jobname, log, vm):
         last_int = datetime.datetime.now()
         int_count = 0
         while 1:
-            rdy = select.select([sys.stdin, s_ctl.stdin], [], [s_ctl.stdin])
+            rdy = select.select([sys.stdin, s_ctl.stdout], [], [])
 
-            if s_ctl.stdin in rdy[2] or s_ctl.stdin in rdy[0]:
-                sys.stderr.write('Connection closed\n')
-                break
+            if s_ctl.stdout in rdy[0]:
+                buf = os.read(s_ctl.stdout.fileno(), 4096)
+                if not buf:
+                    sys.stderr.write('Connection closed\n')
+                    break
+                os.write(sys.stdout.fileno(), buf)
+                continue
 
             # Exit if Ctrl-C is pressed repeatedly
             if sys.stdin in rdy[0]:
@@ -680,7 +979,8 @@ def pcocc_console(jobid, jobname, log, vm):
                         print '\nDetaching ...'
                         break
 
-                s_ctl.stdin.write(buf)
+                if not read_only:
+                    s_ctl.stdin.write(buf)
 
         # Restore terminal now to let user interrupt the wait if needed
         termios.tcsetattr(sys.stdin.fileno(), termios.TCSANOW,
@@ -984,6 +1284,15 @@ def pcocc_pkeyd():
     except PcoccError as err:
         handle_error(err)
 
+@internal.command(name='relay',
+             short_help="For internal use")
+def pcocc_relay():
+    # Relay VM sockets of this host over stdin/stdout for a remote client
+    try:
+        relay_serve(sys.stdin.fileno(), sys.stdout.fileno())
+    except PcoccError as err:
+        handle_error(err)
+
 
 # We want to catch some signals and exit ourselves
 # so that all 'atexit' cleanup callbacks are executed
@@ -1017,8 +1326,18 @@ def pcocc_run(restart_ckpt):
              short_help="Execute commands through the guest agent",
              context_settings=dict(ignore_unknown_options=True,
                                    allow_interspersed_args=False))
-@click.option('-i', '--index', default=0, type=int,
+@click.option('-i', '--index', type=int,
               help='Index of the vm on which the command should be executed')
+@click.option('-w', '--rng',
+              help='Set of vms on which the command should be executed '
+              '(for example vm[0-3,7] or 0-3,7)')
+@click.option('-a', '--all', 'all_vms', is_flag=True,
+              help='Execute the command on all vms')
+@click.option('-f', '--fanout', type=int,
+              default=DEFAULT_EXEC_FANOUT,
+              help='Maximum number of commands executed concurrently')
+@click.option('-b', '--gather', is_flag=True,
+              help='Gather outputs and fold vms with identical outputs')
 @click.option('-j', '--jobid', type=int,
               help='Jobid of the selected cluster')
 @click.option('-J', '--jobname',
@@ -1028,30 +1347,51 @@ def pcocc_run(restart_ckpt):
 @click.option('-s', '--script', is_flag=True,
               help='Cmd is a shell script to be copied to /tmp and executed in place')
 @click.argument('cmd', nargs=-1, required=False, type=click.UNPROCESSED)
-def pcocc_exec(index, jobid, jobname, user, script, cmd):
+def pcocc_exec(index, rng, all_vms, fanout, gather, jobid, jobname, user,
+               script, cmd):
     """Execute commands through the guest agent
 
        For this to work, a pcocc agent must be started in the
        guest. This is mostly available for internal use where we do
        not want to rely on a network connexion / ssh server.
+
+       \b
+       Example usage:
+              pcocc exec -w vm[0-15] -b uname -r
     """
     try:
         load_config(jobid, jobname, default_batchname='pcocc')
         cluster = load_batch_cluster()
 
+        if len([opt for opt in (index is not None, rng, all_vms) if opt]) > 1:
+            raise click.UsageError('only one of --index, --rng and --all '
+                                   'may be specified')
+        if fanout < 1:
+            raise click.UsageError('fanout must be at least 1')
+
+        if all_vms:
+            indexes = range(len(cluster.vms))
+        elif rng:
+            indexes = vm_set_to_indexes(rng)
+        else:
+            indexes = [index or 0]
+
+        check_vm_indexes(cluster, indexes)
+
         if not user:
             user = pwd.getpwuid(os.getuid()).pw_name
 
         cmd = list(cmd)
 
+        script_file = None
         if script:
-            basename = os.path.basename(cmd[0])
-            cluster.vms[index].put_file(cmd[0],
-                                    '/tmp/%s' % basename)
-            cmd = ['bash', '/tmp/%s' % basename]
+            script_file = cmd[0]
+            cmd = ['bash', '/tmp/%s' % os.path.basename(script_file)]
 
-        ret = cluster.exec_cmd([index], cmd, user)
-        sys.exit(max(ret))
+        output = ExecOutput(prefix=len(indexes) > 1 and not gather,
+                            gather=gather)
+        cluster.exec_cmd(indexes, cmd, user, output, fanout, script_file)
+        sys.exit(output.status)
 
     except PcoccError as err:
         handle_error(err)
@@ -1081,13 +1421,14 @@ def pcocc_setup(action, jobid, nolock, force):
     if action == 'init':
         config.load(process_type=ProcessType.OTHER)
         config.batch.init_node()
+        config.save_topology()
         config.config_node()
     elif action == 'cleanup':
         config.load(process_type=ProcessType.OTHER)
         config.cleanup_node()
     elif action == 'create':
         config.load(process_type=ProcessType.SETUP)
-        config.tracker.reclaim(config.batch.list_all_jobs())
+        config.tracker.reclaim(config.batch.list_all_jobs(refresh=True))
         config.batch.create_resources()
         cluster = Cluster(config.batch.cluster_definition,
                           resource_only=True)
@@ -1099,6 +1440,7 @@ def pcocc_setup(action, jobid, nolock, force):
         cluster = Cluster(config.batch.cluster_definition,
                           resource_only=True)
         cluster.free_node_resources()
+        config.batch.clean_node_state_dir()
 
 
     if not nolock:
@@ -1144,3 +1486,58 @@ def pcocc_tpl_show(template):
         tpl.display()
     except PcoccError as err:
         handle_error(err)
+
+def format_duration(duration):
+    if duration is None:
+        return '-'
+    return '{0:.3f}s'.format(duration)
+
+@stats.command(name='startup',
+             short_help="Display the time spent starting VMs")
+@click.option('-j', '--jobid', type=int,
+              help='Jobid of the selected cluster')
+@click.option('-J', '--jobname',
+              help='Job name of the selected cluster')
+@click.option('-n', '--slowest', type=int, default=5,
+              help='Number of slowest hosts and VMs to show (default: 5)')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Export the statistics of all hosts and VMs as JSON')
+def pcocc_stats_startup(jobid, jobname, slowest, as_json):
+    """Display the time spent in each startup phase
+
+    The minimum, median and 99th percentile duration of each phase
+    are computed across the hosts and VMs of the cluster.
+    """
+    try:
+        load_config(jobid, jobname, default_batchname='pcocc')
+        cluster = load_batch_cluster()
+        startup = cluster.startup_stats()
+
+        if as_json:
+            print json.dumps(startup.to_dict(), indent=2)
+            return
+
+        tbl = TextTable("%kind %phase %count %min %median %p99 %max")
+        for kind in startup.kinds:
+            for phase, values in startup.phases(kind).iteritems():
+                row = dict((key, format_duration(value))
+                           for key, value in values.iteritems())
+                row.update({'kind': kind, 'phase': phase,
+                            'count': str(values['count'])})
+                tbl.append(row)
+        print tbl
+
+        print
+        tbl = TextTable("%kind %name %host %state %total")
+        for kind in startup.kinds:
+            nodes = startup.nodes(kind)
+            for name in startup.slowest(kind, slowest):
+                tbl.append({'kind': kind,
+                            'name': name,
+                            'host': nodes[name]['host'],
+                            'state': nodes[name]['state'],
+                            'total': format_duration(nodes[name]['total'])})
+        print tbl
+
+    except PcoccError as err:
+        handle_error(err)
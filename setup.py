@@ -86,6 +86,7 @@ setup(name= 'pcocc', version= '0.4.0', description= 'Spawn VMs on a HPC Cluster'
       ''',
       install_requires=['PyYAML', 'python-etcd >= 0.4.3', 'psutil',
                         'jsonschema', 'urllib3', 'dnspython', 'ClusterShell'],
+      extras_require={'etcd3': ['etcd3']},
       cmdclass={'bdist_rpm': pcocc_bdist_rpm,
                 'install': pcocc_install}
 )
@@ -0,0 +1,127 @@
+import json
+import socket
+import threading
+import pytest
+
+from pcocc.Agent import AgentSession, AgentProxy, REATTACH_COMMAND
+from pcocc.QMP import QGAClient, QMPConnectionError
+
+class FakeAgent(object):
+    """Guest agent socket answering guest-sync and echo commands
+
+    exec commands are answered when release() is called.
+
+    """
+    def __init__(self, path):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.syncs = 0
+        self.conn = None
+        self.held = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def send(self, data):
+        with self.lock:
+            self.conn.sendall(data)
+
+    def run(self):
+        while True:
+            self.conn, _ = self.server.accept()
+            f = self.conn.makefile('r')
+            for line in iter(f.readline, ''):
+                line = line.replace('\xff', '').strip()
+                if not line:
+                    continue
+                msg = json.loads(line)
+                ret = {'id': msg['id']} if 'id' in msg else {}
+                if msg['execute'] == 'guest-sync-delimited':
+                    self.syncs += 1
+                    ret['return'] = msg['arguments']['id']
+                    self.send('\xff' + json.dumps(ret) + '\n')
+                elif msg['execute'] == 'guest-cmd-exec':
+                    self.held.append(ret)
+                elif msg['execute'] == 'guest-info':
+                    ret['return'] = {'version': '2.11.0',
+                                     'supported_commands': []}
+                    self.send(json.dumps(ret) + '\n')
+                else:
+                    ret['return'] = msg['execute']
+                    self.send(json.dumps(ret) + '\n')
+
+    def release(self, retval):
+        ret = self.held.pop(0)
+        ret['return'] = retval
+        self.send(json.dumps(ret) + '\n')
+
+    def disconnect(self):
+        self.conn.shutdown(socket.SHUT_RDWR)
+
+@pytest.fixture
+def proxy(tmpdir):
+    agent = FakeAgent(str(tmpdir.join('serial')))
+    proxy = AgentProxy(AgentSession(str(tmpdir.join('serial'))),
+                       str(tmpdir.join('proxy')))
+    proxy.start()
+    proxy.agent = agent
+    yield proxy
+    proxy.stop()
+
+def connect(proxy):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(proxy.path)
+    return QGAClient(sock)
+
+def test_shared_session(proxy):
+    clients = [connect(proxy) for _ in range(5)]
+    for client in clients:
+        client.sync(timeout=5)
+        assert client.execute('guest-ping', timeout=5) == 'guest-ping'
+
+    # The session with the agent is only synchronized once, client
+    # syncs are answered by the proxy
+    assert proxy.agent.syncs == 1
+    assert proxy.session.synced
+    for client in clients:
+        client.close()
+
+def test_dict_reply(proxy):
+    client = connect(proxy)
+    client.sync(timeout=5)
+    assert client.execute('guest-info', timeout=5) == {
+        'version': '2.11.0', 'supported_commands': []}
+    client.close()
+
+def test_reattach(proxy):
+    client = connect(proxy)
+    client.sync(timeout=5)
+    client.execute_async('guest-cmd-exec', {'cmd': 'sleep'})
+    client.execute('guest-ping', timeout=5)
+    client.close()
+
+    # The result is kept for the next client which reattaches
+    proxy.agent.release(3)
+    client = connect(proxy)
+    assert client.execute(REATTACH_COMMAND, timeout=5) == 3
+
+def test_session_lost(proxy):
+    client = connect(proxy)
+    client.sync(timeout=5)
+    # Syncs are answered by the proxy, wait for the session
+    client.execute('guest-ping', timeout=5)
+    events = client.subscribe([])
+
+    proxy.agent.disconnect()
+    # None is also returned on timeout
+    assert events.get(timeout=5) is None
+    assert client.closed
+    with pytest.raises(QMPConnectionError):
+        client.execute('guest-ping', timeout=5)
+
+    # The session reconnects for new clients
+    client = connect(proxy)
+    client.sync(timeout=5)
+    assert client.execute('guest-ping', timeout=5) == 'guest-ping'
@@ -0,0 +1,121 @@
+import os
+import subprocess
+import pytest
+
+from pcocc.Error import PcoccError
+from pcocc.Checkpoint import MemoryCompression, write_manifest, read_manifest
+from pcocc.Checkpoint import direct_io_supported, estimate_downtime
+from pcocc.Checkpoint import precopy_ready, consolidation_base
+from pcocc.Checkpoint import checkpoint_disks
+
+def test_save_pipeline():
+    compression = MemoryCompression('zstd', 3)
+    assert compression.save_pipeline('/ckpt/memory-vm0', [2, 3], True) == (
+        'taskset -c 2,3 zstd -q -c -T2 -3 | '
+        'dd of=/ckpt/memory-vm0 bs=4194304 status=none iflag=fullblock '
+        'oflag=direct')
+
+    compression = MemoryCompression('lz4', threads=8)
+    assert compression.save_pipeline('/ckpt/memory vm0', [2, 3]) == (
+        "lz4 -q -c -1 | "
+        "dd 'of=/ckpt/memory vm0' bs=4194304 status=none iflag=fullblock")
+
+def test_live_save_pipeline():
+    # The cpus of a running VM are left to it
+    compression = MemoryCompression('zstd', 3)
+    assert compression.save_pipeline('/ckpt/memory-vm0', [2, 3],
+                                     live=True) == (
+        'zstd -q -c -T1 -3 | '
+        'dd of=/ckpt/memory-vm0 bs=4194304 status=none iflag=fullblock')
+
+    compression = MemoryCompression('zstd', 3, threads=4)
+    assert compression.save_pipeline('/ckpt/memory-vm0', [2, 3],
+                                     live=True).startswith('zstd -q -c -T4 -3')
+
+def test_restore_pipeline():
+    compression = MemoryCompression('none')
+    assert compression.restore_pipeline('/ckpt/memory-vm0', True) == (
+        'dd if=/ckpt/memory-vm0 bs=4194304 status=none iflag=direct')
+
+def test_invalid_compression():
+    for args in (('gzip',), ('zstd', 20), ('none', 1), ('lz4', None, -1)):
+        with pytest.raises(PcoccError):
+            MemoryCompression(*args)
+
+def test_manifest(tmpdir):
+    ckpt_dir = str(tmpdir)
+    assert read_manifest(ckpt_dir)['memory']['codec'] == 'lzop'
+
+    write_manifest(ckpt_dir, {'memory': MemoryCompression().to_manifest()})
+    compression = MemoryCompression.from_manifest(read_manifest(ckpt_dir))
+    assert (compression.codec.name, compression.level) == ('zstd', 1)
+
+    tmpdir.join('manifest').write('{"version": 100}')
+    with pytest.raises(PcoccError):
+        read_manifest(ckpt_dir)
+
+def test_pipeline_roundtrip(tmpdir):
+    data = os.urandom(1024 * 1024) + 'x' * (9 * 1024 * 1024 + 17)
+    path = str(tmpdir.join('memory-vm0'))
+    compression = MemoryCompression('none')
+    direct = direct_io_supported(str(tmpdir))
+
+    save = subprocess.Popen(compression.save_pipeline(path, direct=direct),
+                            shell=True, stdin=subprocess.PIPE)
+    save.communicate(data)
+    assert save.returncode == 0
+
+    restore = subprocess.Popen(compression.restore_pipeline(path, direct),
+                               shell=True, stdout=subprocess.PIPE)
+    assert restore.communicate()[0] == data
+
+def precopy_status(passes, remaining, mbps=800, status='active'):
+    return {'status': status,
+            'ram': {'dirty-sync-count': passes, 'remaining': remaining,
+                    'mbps': mbps}}
+
+def test_estimate_downtime():
+    assert estimate_downtime(precopy_status(2, 200 * 10 ** 6)) == 2
+    assert estimate_downtime(precopy_status(1, 0, mbps=0)) is None
+    assert estimate_downtime({'status': 'active',
+                              'expected-downtime': 300}) == 0.3
+    assert estimate_downtime({'status': 'completed'}) == 0
+    assert estimate_downtime({'status': 'pre-switchover',
+                              'ram': {'remaining': 0, 'mbps': 0}}) == 0
+    assert estimate_downtime(precopy_status(2, 10 ** 6, mbps=3)) == 8 / 3.
+
+def test_precopy_ready():
+    # The first pass is not complete
+    assert precopy_ready([precopy_status(1, 0)], 1) == (False, False)
+
+    statuses = [precopy_status(3, 50 * 10 ** 6),
+                precopy_status(2, 200 * 10 ** 6),
+                {'status': 'completed'}]
+    assert precopy_ready(statuses, 2) == (True, True)
+    assert precopy_ready(statuses, 1) == (False, False)
+    assert precopy_ready(statuses, 1, max_passes=2) == (True, False)
+
+def chain(*filenames):
+    return [{'filename': filename, 'format': 'qcow2'}
+            for filename in filenames]
+
+def test_consolidation_base():
+    # Already based on the VM image
+    assert consolidation_base(chain('/ckpt2/disk-vm0',
+                                    '/images/centos')) is False
+    assert consolidation_base(chain('/images/centos')) is False
+
+    assert consolidation_base(chain('/ckpt3/disk-vm0', '/ckpt2/disk-vm0',
+                                    '/ckpt1/disk-vm0', '/images/centos',
+                                    '/images/base')) == {
+        'filename': '/images/centos', 'format': 'qcow2'}
+
+    # Standalone checkpoints
+    assert consolidation_base(chain('/ckpt2/disk-vm0',
+                                    '/ckpt1/disk-vm0')) is None
+
+def test_checkpoint_disks(tmpdir):
+    for name in ('disk-vm10', 'disk-vm2', 'memory-vm2', 'manifest',
+                 'disk-vm2.tmp'):
+        tmpdir.join(name).write('')
+    assert checkpoint_disks(str(tmpdir)) == ['disk-vm2', 'disk-vm10']
@@ -0,0 +1,70 @@
+import os
+import stat
+import struct
+
+from pcocc.CloudSeed import make_iso, seed_image, smbios_serial, SECTOR_SIZE
+
+def read_dir(image, extent, joliet=False):
+    data = image[extent * SECTOR_SIZE:(extent + 1) * SECTOR_SIZE]
+    entries = {}
+    pos = 0
+    while pos < len(data) and ord(data[pos]):
+        length = ord(data[pos])
+        file_extent = struct.unpack('<I', data[pos + 2:pos + 6])[0]
+        size = struct.unpack('<I', data[pos + 10:pos + 14])[0]
+        name_len = ord(data[pos + 32])
+        name = data[pos + 33:pos + 33 + name_len]
+        if name not in ('\0', '\1'):
+            if joliet:
+                name = name.decode('utf-16-be')
+            entries[name] = image[file_extent * SECTOR_SIZE:
+                                  file_extent * SECTOR_SIZE + size]
+        pos += length
+    return entries
+
+def root_extent(image, sector):
+    desc = image[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE]
+    return struct.unpack('<I', desc[158:162])[0]
+
+def test_make_iso():
+    big = 'x' * (SECTOR_SIZE + 1)
+    image = make_iso('cidata', [('user-data', big),
+                                ('meta-data', 'instance-id: test\n')])
+
+    assert len(image) % SECTOR_SIZE == 0
+    pvd = image[16 * SECTOR_SIZE:17 * SECTOR_SIZE]
+    assert pvd[0:6] == '\x01CD001'
+    assert pvd[40:72].rstrip() == 'cidata'
+    assert struct.unpack('<I', pvd[80:84])[0] * SECTOR_SIZE == len(image)
+
+    svd = image[17 * SECTOR_SIZE:18 * SECTOR_SIZE]
+    assert svd[0:6] == '\x02CD001'
+    assert svd[88:91] == '%/E'
+    assert svd[40:52].decode('utf-16-be') == 'cidata'
+    assert image[18 * SECTOR_SIZE:18 * SECTOR_SIZE + 6] == '\xffCD001'
+
+    assert read_dir(image, root_extent(image, 16)) == {
+        'META_DAT.;1': 'instance-id: test\n',
+        'USER_DAT.;1': big}
+    assert read_dir(image, root_extent(image, 17), joliet=True) == {
+        u'meta-data': 'instance-id: test\n',
+        u'user-data': big}
+
+def test_make_iso_deterministic():
+    files = [('user-data', '#cloud-config\n'), ('meta-data', '')]
+    assert make_iso('cidata', files) == make_iso('cidata', files[::-1])
+
+def test_seed_image(tmpdir):
+    cache_dir = str(tmpdir.join('seeds'))
+    path = seed_image(cache_dir, '#cloud-config\n', 'instance-id: a\n')
+    assert os.path.dirname(path) == cache_dir
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o400
+
+    mtime = os.stat(path).st_mtime
+    assert seed_image(cache_dir, '#cloud-config\n', 'instance-id: a\n') == path
+    assert os.stat(path).st_mtime == mtime
+    assert seed_image(cache_dir, '#cloud-config\n', 'instance-id: b\n') != path
+    assert len(os.listdir(cache_dir)) == 2
+
+def test_smbios_serial():
+    assert smbios_serial('vm1.cluster') == 'ds=nocloud;h=vm1.cluster'
@@ -0,0 +1,18 @@
+import yaml
+
+from pcocc.Misc import encode_value, decode_value
+
+def test_codec_roundtrip():
+    value = {'state': 'complete', 'priority': 2, 'desc': 'done',
+             'value': None, 'ids': [1, 2, 3], 'name': u'caf\xe9'}
+    data = encode_value(value)
+    assert decode_value(data) == value
+    assert isinstance(decode_value(data)['state'], str)
+
+def test_codec_legacy():
+    value = [{'pkey_index': 0, 'batchid': 12}]
+    assert decode_value(yaml.dump(value)) == value
+    assert decode_value(None) is None
+
+    # Older versions parse encoded values as YAML
+    assert yaml.safe_load(encode_value(value)) == value
@@ -0,0 +1,260 @@
+import os
+import json
+import socket
+import threading
+import pytest
+
+from pcocc.Console import ConsoleLog, ConsoleProxy, parse_log_request
+
+def read_log(path):
+    data = ''
+    if os.path.exists(path + '.1'):
+        data += open(path + '.1').read()
+    return data + open(path).read()
+
+def recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+def test_log_batches_writes(tmpdir):
+    path = str(tmpdir.join('log'))
+    log = ConsoleLog(path, flush_size=10, flush_interval=3600)
+    log.write('abc')
+    assert open(path).read() == ''
+    assert log.timeout() > 0
+    log.write('defghijk')
+    assert open(path).read() == 'abcdefghijk'
+    assert log.timeout() is None
+    log.write('l')
+    log.close()
+    assert open(path).read() == 'abcdefghijkl'
+
+def test_log_flush_interval(tmpdir):
+    path = str(tmpdir.join('log'))
+    log = ConsoleLog(path, flush_interval=0)
+    log.write('abc')
+    assert log.timeout() == 0
+    log.flush_if_due()
+    assert open(path).read() == 'abc'
+    log.close()
+
+def test_log_rotation(tmpdir):
+    path = str(tmpdir.join('log'))
+    open(path + '.1', 'w').write('stale')
+    log = ConsoleLog(path, max_size=20, flush_size=1)
+    assert not os.path.exists(path + '.1')
+
+    data = ''.join(chr(ord('a') + i % 26) for i in range(57))
+    for i in range(0, len(data), 7):
+        log.write(data[i:i + 7])
+    log.close()
+
+    # The last complete segment and the current one are kept
+    assert os.path.getsize(path + '.1') == 10
+    assert read_log(path) == data[40:]
+    log = ConsoleLog(path, max_size=20, flush_size=1)
+    log.write(data[:25])
+    log.close()
+    assert read_log(path) == data[10:25]
+
+@pytest.fixture
+def proxy(tmpdir):
+    """Console proxy for a fake console running in a thread"""
+    console, guest = socket.socketpair()
+    listeners = []
+    for name in ('console_socket', 'watch_socket', 'log_socket'):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(str(tmpdir.join(name)))
+        listener.listen(128)
+        listeners.append(listener)
+
+    log_path = str(tmpdir.join('log'))
+    proxy = ConsoleProxy(console, listeners[0], listeners[1], listeners[2],
+                         ConsoleLog(log_path))
+    thread = threading.Thread(target=proxy.run)
+    thread.daemon = True
+    thread.start()
+
+    def connect(name):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(str(tmpdir.join(name)))
+        sock.settimeout(10)
+        return sock
+
+    yield guest, connect, log_path, thread
+
+    guest.close()
+    thread.join(10)
+
+def test_proxy_fan_out(proxy):
+    guest, connect, log_path, thread = proxy
+    client = connect('console_socket')
+    watchers = [connect('watch_socket') for _ in range(3)]
+
+    # Make sure all clients are registered before sending output
+    client.sendall('ping')
+    assert recv_exactly(guest, 4) == 'ping'
+    for watcher in watchers:
+        watcher.sendall('ignored')
+    watchers[-1].close()
+    watchers.pop()
+    client.sendall('sync')
+    assert recv_exactly(guest, 4) == 'sync'
+
+    data = os.urandom(3 * 1024 * 1024)
+    guest.sendall(data)
+    for sock in [client] + watchers:
+        assert recv_exactly(sock, len(data)) == data
+
+    guest.shutdown(socket.SHUT_WR)
+    thread.join(10)
+    assert not thread.is_alive()
+    assert read_log(log_path) == data
+    for sock in [client] + watchers:
+        assert sock.recv(1) == ''
+
+def test_proxy_single_interactive_client(proxy):
+    guest, connect, _, _ = proxy
+    first = connect('console_socket')
+    first.sendall('a')
+    assert recv_exactly(guest, 1) == 'a'
+
+    # The second client waits until the first one disconnects
+    second = connect('console_socket')
+    second.sendall('b')
+    first.sendall('c')
+    assert recv_exactly(guest, 1) == 'c'
+    first.close()
+    assert recv_exactly(guest, 1) == 'b'
+
+    guest.sendall('out')
+    assert recv_exactly(second, 3) == 'out'
+
+def test_proxy_drops_slow_watchers(proxy):
+    guest, connect, _, _ = proxy
+    client = connect('console_socket')
+    slow = connect('watch_socket')
+    slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    client.sendall('sync')
+    assert recv_exactly(guest, 4) == 'sync'
+
+    # Data is consumed by the interactive client but not by the watcher
+    data = 'x' * (8 * 1024 * 1024)
+    sender = threading.Thread(target=guest.sendall, args=[data])
+    sender.start()
+    assert recv_exactly(client, len(data)) == data
+    sender.join()
+
+    received = 0
+    while True:
+        chunk = slow.recv(65536)
+        if not chunk:
+            break
+        received += len(chunk)
+    assert received < len(data)
+
+def test_log_window(tmpdir):
+    log = ConsoleLog(str(tmpdir.join('log')), max_size=56, flush_size=1)
+    for i in range(10):
+        log.write('line %d\n' % i)
+
+    # 70 bytes were logged, 28 in the previous segment and 14 in the
+    # current one are kept
+    reader = log.reader()
+    assert (reader.start, reader.end) == (28, 70)
+    assert reader.read(28, 100) == ''.join('line %d\n' % i
+                                           for i in range(4, 10))
+    assert reader.read(54, 4) == '7\nli'
+
+    assert log.window(reader, {}) == (28, 70)
+    assert log.window(reader, {'lines': 2}) == (56, 70)
+    assert log.window(reader, {'lines': 100}) == (28, 70)
+    assert log.window(reader, {'bytes': 3}) == (67, 70)
+    assert log.window(reader, {'offset': 10}) == (28, 70)
+    assert log.window(reader, {'offset': 60, 'lines': 2}) == (60, 70)
+    assert log.window(reader, {'offset': 100}) == (70, 70)
+
+    log.write('partial')
+    reader.close()
+    reader = log.reader()
+    assert log.window(reader, {'lines': 1}) == (70, 77)
+    assert log.window(reader, {'lines': 2}) == (63, 77)
+    reader.close()
+    log.close()
+
+def test_log_time_window(tmpdir, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('pcocc.Console.time.time', lambda: now[0])
+    log = ConsoleLog(str(tmpdir.join('log')))
+    for data in ('a', 'b', 'c'):
+        log.write(data)
+        now[0] += 0.5
+    now[0] = 1010
+    log.write('d')
+
+    reader = log.reader()
+    assert log.window(reader, {'since': 1005}) == (3, 4)
+    assert log.window(reader, {'until': 1005}) == (0, 3)
+    assert log.window(reader, {'since': 999, 'until': 1000}) == (0, 2)
+    assert log.window(reader, {'since': 1011}) == (4, 4)
+    reader.close()
+    log.close()
+
+def test_parse_log_request():
+    assert parse_log_request('{"lines": 10, "follow": true}') == {
+        'lines': 10, 'follow': True}
+    for request in ('[]', '{"lines": -1}', '{"since": "now"}',
+                    '{"command": "rm"}', 'garbage'):
+        with pytest.raises(ValueError):
+            parse_log_request(request)
+
+def read_log_socket(connect, request):
+    sock = connect('log_socket')
+    sock.sendall(json.dumps(request) + '\n')
+    f = sock.makefile('rb', 0)
+    header = json.loads(f.readline())
+    return sock, header, f
+
+def test_proxy_log_requests(proxy):
+    guest, connect, _, _ = proxy
+    client = connect('console_socket')
+    client.sendall('sync')
+    assert recv_exactly(guest, 4) == 'sync'
+
+    guest.sendall('first\nsecond\nthird\n')
+    assert recv_exactly(client, 19) == 'first\nsecond\nthird\n'
+
+    sock, header, f = read_log_socket(connect, {'lines': 2})
+    assert header == {'start': 6, 'end': 19}
+    assert f.read() == 'second\nthird\n'
+
+    sock, header, f = read_log_socket(connect, {'offset': 100})
+    assert header == {'start': 19, 'end': 19}
+    assert f.read() == ''
+
+    sock, header, f = read_log_socket(connect, {'lines': -1})
+    assert 'error' in header
+    assert f.read() == ''
+
+def test_proxy_log_follow(proxy):
+    guest, connect, _, _ = proxy
+    client = connect('console_socket')
+    client.sendall('sync')
+    assert recv_exactly(guest, 4) == 'sync'
+
+    guest.sendall('old\n')
+    assert recv_exactly(client, 4) == 'old\n'
+
+    sock, header, f = read_log_socket(connect, {'bytes': 2, 'follow': True})
+    assert header == {'start': 2, 'end': 4}
+    assert recv_exactly(sock, 2) == 'd\n'
+
+    data = os.urandom(2 * 1024 * 1024)
+    guest.sendall(data)
+    assert recv_exactly(sock, len(data)) == data
+    guest.shutdown(socket.SHUT_WR)
+    assert sock.recv(1) == ''
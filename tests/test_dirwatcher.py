@@ -0,0 +1,139 @@
+import pytest
+import etcd
+
+from pcocc.Batch import LocalManager, ProcessType, DirWatcher
+from pcocc.Batch import KeyTimeoutError
+from pcocc.Cluster import HostStateSummary, ClusterSetupError
+
+settings = {'etcd-servers': ['localhost'],
+            'etcd-client-port': 2379,
+            'etcd-protocol': 'http',
+            'etcd-auth-type': 'none'}
+
+def result(action, key, value=None, index=1, etcd_index=None, **kwargs):
+    node = dict(key=key, value=value, modifiedIndex=index, **kwargs)
+    ret = etcd.EtcdResult(action, node)
+    ret.etcd_index = etcd_index or index
+    return ret
+
+class FakeClient(object):
+    def __init__(self, tree, events):
+        self.tree = tree
+        self.events = events
+        self.reads = 0
+
+    def read(self, key, recursive=False):
+        self.reads += 1
+        return self.tree
+
+    def watch(self, key, index=None, recursive=None, timeout=None):
+        if not self.events:
+            raise etcd.EtcdWatchTimedOut('timeout', {})
+        ret = self.events.pop(0)
+        if isinstance(ret, Exception):
+            raise ret
+        assert ret.modifiedIndex >= index
+        return ret
+
+@pytest.fixture
+def manager():
+    return LocalManager(None, None, None, settings,
+                        ProcessType.OTHER, 'user1')
+
+def dir_tree(children, index):
+    return result('get', '/d', dir=True, index=1, etcd_index=index,
+                  nodes=[dict(key='/d/' + k, value=v, modifiedIndex=1)
+                         for k, v in children.items()])
+
+def test_incremental(manager, mocker):
+    client = FakeClient(dir_tree({'a': '1'}, 10),
+                        [result('set', '/d/b', '2', 11),
+                         result('set', '/d/a', '3', 12),
+                         result('set', '/d/sub', None, 13, dir=True),
+                         result('set', '/d/sub/c', '4', 14),
+                         result('delete', '/d/sub', None, 15, dir=True),
+                         result('expire', '/d/a', None, 16)])
+    manager._keyval_client = client
+    mocker.patch.object(manager, 'get_key_path', return_value='/d')
+
+    watcher = manager.watch_dir('global', 'd')
+    assert watcher.children == {'a': '1'}
+    assert watcher.index == 10
+
+    assert watcher.wait() == [('b', None, '2')]
+    assert watcher.wait() == [('a', '1', '3')]
+    assert watcher.wait() == []
+    assert watcher.wait() == [('sub/c', None, '4')]
+    assert watcher.wait() == [('sub/c', '4', None)]
+    assert watcher.wait() == [('a', '3', None)]
+    assert watcher.children == {'b': '2'}
+    assert watcher.index == 16
+    assert client.reads == 1
+
+    with pytest.raises(KeyTimeoutError):
+        watcher.wait(timeout=1)
+
+def test_index_cleared(manager):
+    client = FakeClient(dir_tree({'a': '1', 'b': '2'}, 10),
+                        [etcd.EtcdEventIndexCleared('cleared',
+                                                    {'index': 100})])
+    manager._keyval_client = client
+    watcher = DirWatcher(manager, '/d/')
+    watcher.sync()
+
+    client.tree = dir_tree({'b': '3', 'c': '4'}, 120)
+    changes = watcher.wait()
+    assert sorted(changes) == [('a', '1', None), ('b', '2', '3'),
+                               ('c', None, '4')]
+    assert watcher.index == 120
+    assert client.reads == 2
+
+def test_missing_dir(manager):
+    class MissingClient(FakeClient):
+        def read(self, key, recursive=False):
+            raise etcd.EtcdKeyNotFound('not found', {'index': 42})
+
+    manager._keyval_client = MissingClient(None, [])
+    watcher = DirWatcher(manager, '/d')
+    assert watcher.sync() == []
+    assert watcher.children == {}
+    assert watcher.index == 42
+
+class FakeCluster(object):
+    def _unpack_host_state(self, value):
+        if value:
+            return value
+        return {'state': 'not-started', 'priority': 0, 'desc': '',
+                'value': None}
+
+    def _check_host_state(self, state):
+        if state['state'] == 'failed':
+            raise ClusterSetupError(state['desc'])
+        return state['state'] == 'complete'
+
+def state(name, priority):
+    return {'state': name, 'priority': priority, 'desc': name, 'value': None}
+
+def test_host_state_summary():
+    summary = HostStateSummary(FakeCluster(), 3)
+    summary.update([('0', None, state('net', 2)),
+                    ('1', None, state('vm', 5))])
+    assert summary.status() == (False, FakeCluster()._unpack_host_state(None))
+
+    summary.update([('2', None, state('complete', 10))])
+    assert summary.status() == (False, state('net', 2))
+
+    summary.update([('0', state('net', 2), state('vm', 5))])
+    assert summary.status() == (False, state('vm', 5))
+    assert summary.num_complete == 1
+
+    summary.update([('0', state('vm', 5), state('complete', 10)),
+                    ('1', state('vm', 5), state('complete', 10))])
+    assert summary.status() == (True, state('complete', 10))
+
+    summary.update([('2', state('complete', 10), None)])
+    assert summary.num_complete == 2
+    assert summary.status()[0] is False
+
+    with pytest.raises(ClusterSetupError):
+        summary.update([('2', None, state('failed', 0))])
@@ -0,0 +1,116 @@
+import os
+import time
+import socket
+import subprocess
+import pytest
+import etcd
+
+from distutils.spawn import find_executable
+
+etcd3 = pytest.importorskip('etcd3')
+
+from pcocc.EtcdV3 import EtcdV3Client
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+@pytest.fixture(scope='module')
+def client(tmpdir_factory):
+    etcd_bin = find_executable('etcd')
+    if not etcd_bin:
+        pytest.skip('etcd binary not found')
+
+    data_dir = str(tmpdir_factory.mktemp('etcd'))
+    client_port = _free_port()
+    peer_port = _free_port()
+    client_url = 'http://127.0.0.1:{0}'.format(client_port)
+    peer_url = 'http://127.0.0.1:{0}'.format(peer_port)
+    proc = subprocess.Popen([etcd_bin,
+                             '--data-dir', data_dir,
+                             '--listen-client-urls', client_url,
+                             '--advertise-client-urls', client_url,
+                             '--listen-peer-urls', peer_url,
+                             '--initial-advertise-peer-urls', peer_url,
+                             '--initial-cluster', 'default=' + peer_url],
+                            stdout=open(os.devnull, 'w'),
+                            stderr=subprocess.STDOUT)
+
+    c = EtcdV3Client([('127.0.0.1', client_port)], read_timeout=5)
+    for _ in range(50):
+        try:
+            c.read('/', recursive=True)
+        except etcd.EtcdKeyNotFound:
+            break
+        except etcd.EtcdException:
+            time.sleep(0.1)
+
+    yield c
+    proc.terminate()
+    proc.wait()
+
+def test_read_write(client):
+    with pytest.raises(etcd.EtcdKeyNotFound):
+        client.read('/test/rw/key')
+
+    client.write('/test/rw/key', 'value')
+    ret = client.read('/test/rw//key/')
+    assert ret.key == '/test/rw/key'
+    assert ret.value == 'value'
+
+    client.delete('/test/rw/key')
+    with pytest.raises(etcd.EtcdKeyNotFound):
+        client.read('/test/rw/key')
+
+def test_compare_and_swap(client):
+    client.write('/test/cas/key', 'a', prevExist=False)
+    with pytest.raises(etcd.EtcdAlreadyExist):
+        client.write('/test/cas/key', 'b', prevExist=False)
+
+    index = client.read('/test/cas/key').modifiedIndex
+    client.write('/test/cas/key', 'b', prevIndex=index)
+    with pytest.raises(etcd.EtcdCompareFailed):
+        client.write('/test/cas/key', 'c', prevIndex=index)
+    assert client.read('/test/cas/key').value == 'b'
+
+def test_directories(client):
+    client.write_many([('/test/dir/a', '1'),
+                       ('/test/dir/b', '2'),
+                       ('/test/dir!', 'sibling')])
+    ret = client.read('/test/dir', recursive=True)
+    assert sorted((c.key, c.value) for c in ret.children) == [
+        ('/test/dir/a', '1'), ('/test/dir/b', '2')]
+
+    client.delete('/test/dir', recursive=True, dir=True)
+    with pytest.raises(etcd.EtcdKeyNotFound):
+        client.read('/test/dir', recursive=True)
+    assert client.read('/test/dir!').value == 'sibling'
+
+def test_watch(client):
+    index = client.write('/test/watch/init', '').etcd_index
+
+    with pytest.raises(etcd.EtcdWatchTimedOut):
+        client.watch('/test/watch', index=index + 1, recursive=True,
+                     timeout=0.5)
+
+    client.write('/test/watch/key', 'value')
+    ret = client.watch('/test/watch', index=index + 1, recursive=True)
+    assert ret.key == '/test/watch/key'
+    assert ret.value == 'value'
+
+def test_ttl(client):
+    client.write('/test/ttl/key', '', ttl=1)
+    client.write('/test/ttl/key', '', ttl=1)
+    assert client.read('/test/ttl/key').value == ''
+    time.sleep(3)
+    with pytest.raises(etcd.EtcdKeyNotFound):
+        client.read('/test/ttl/key')
+
+    client.write('/test/ttl/dir/a', 'a')
+    client.write('/test/ttl/dir', None, dir=True, prevExist=True, ttl=1)
+    time.sleep(3)
+    with pytest.raises(etcd.EtcdKeyNotFound):
+        client.read('/test/ttl/dir', recursive=True)
@@ -0,0 +1,122 @@
+import os
+import socket
+import threading
+from StringIO import StringIO
+
+from pcocc.Cluster import Cluster, VMList, ExecOutput, fold_vm_names
+from pcocc.Hypervisor import AgentError, Qemu
+from pcocc.Misc import FdWriter
+
+def test_fold_vm_names():
+    assert fold_vm_names([3, 0, 1, 2, 7]) == 'vm[0-3,7]'
+    assert fold_vm_names([5]) == 'vm5'
+
+def test_streamed_output():
+    out, err = StringIO(), StringIO()
+    output = ExecOutput(out=out, err=err)
+    output.write(0, 'hel')
+    output.write(1, 'a\nb')
+    output.write(0, 'lo\n')
+    output.exit(0, 0)
+    output.exit(1, 2)
+    output.close()
+
+    assert out.getvalue() == 'vm1: a\nvm0: hello\nvm1: b\n'
+    assert err.getvalue() == 'vm1: exit 2\n'
+    assert output.status == 2
+
+def test_gathered_output():
+    out, err = StringIO(), StringIO()
+    output = ExecOutput(gather=True, out=out, err=err)
+    for i in range(4):
+        output.write(i, 'same\n' if i != 2 else 'other\n')
+        output.exit(i, 1 if i > 1 else 0)
+    output.write(4, '')
+    output.error(4, 'Guest agent failure')
+    output.close()
+
+    sep = '-' * 15 + '\n'
+    assert out.getvalue() == (sep + 'vm[0-1,3] (3)\n' + sep + 'same\n' +
+                              sep + 'vm2 (1)\n' + sep + 'other\n')
+    assert err.getvalue() == ('vm[2-3]: exit 1\n'
+                              'vm4: Guest agent failure\n')
+    assert output.status == 255
+
+def test_chunked_output():
+    out, err = StringIO(), StringIO()
+    output = ExecOutput(out=out, err=err)
+    for _ in range(1000):
+        output.write(0, 'x')
+    output.write(0, 'y\nz\n\nw')
+    output.close()
+
+    assert out.getvalue() == ('vm0: ' + 'x' * 1000 + 'y\n'
+                              'vm0: z\nvm0: \nvm0: w\n')
+    assert output._partial == {}
+
+class FakeVM(object):
+    def __init__(self, rank, barrier):
+        self.rank = rank
+        self.barrier = barrier
+
+    def exec_cmd(self, cmd, user, output):
+        if self.rank == 3:
+            raise AgentError('no agent')
+        with self.barrier['lock']:
+            self.barrier['running'] += 1
+            self.barrier['max'] = max(self.barrier['max'],
+                                      self.barrier['running'])
+        output('%s on vm%d\n' % (cmd[0], self.rank))
+        with self.barrier['lock']:
+            self.barrier['running'] -= 1
+        return self.rank % 2
+
+def test_parallel_exec():
+    barrier = {'lock': threading.Lock(), 'running': 0, 'max': 0}
+    cluster = Cluster.__new__(Cluster)
+    cluster.vms = VMList(FakeVM(i, barrier) for i in range(16))
+
+    out, err = StringIO(), StringIO()
+    output = ExecOutput(out=out, err=err)
+    ret = cluster.exec_cmd(range(16), ['hostname'], 'user', output,
+                           fanout=4)
+
+    assert barrier['max'] <= 4
+    assert ret == [i % 2 if i != 3 else None for i in range(16)]
+    assert sorted(out.getvalue().splitlines()) == sorted(
+        'vm%d: hostname on vm%d' % (i, i) for i in range(16) if i != 3)
+    assert 'vm3: Guest agent failure: no agent' in err.getvalue()
+    assert output.status == 255
+
+def test_direct_output(tmpdir):
+    out = open(str(tmpdir.join('out')), 'w+')
+    out.write('before\n')
+    output = ExecOutput(prefix=False, out=out, err=StringIO())
+    writer = output.writer(0)
+    assert isinstance(writer, FdWriter)
+    writer('x' * 100000)
+    output.close()
+    out.seek(0)
+    assert out.read() == 'before\n' + 'x' * 100000
+
+class FakeChannel(object):
+    def __init__(self, sock):
+        self.stdout = sock.makefile('rb', 0)
+
+def test_forward_io():
+    ours, theirs = socket.socketpair()
+    chan = FakeChannel(theirs)
+    pipe_r, pipe_w = os.pipe()
+    data = os.urandom(5000)
+
+    # Spliced to the pipe, or read and written if not supported
+    ours.sendall(data)
+    assert Qemu()._forward_io(chan, FdWriter(pipe_w)) == len(data)
+    assert os.read(pipe_r, 10000) == data
+
+    received = []
+    ours.sendall(data)
+    ours.close()
+    assert Qemu()._forward_io(chan, received.append) == len(data)
+    assert received == [data]
+    assert Qemu()._forward_io(chan, received.append) == 0
@@ -0,0 +1,156 @@
+import os
+import json
+import base64
+import socket
+import tarfile
+import threading
+import pytest
+
+from pcocc import Agent
+from pcocc.Agent import GuestFileWriter, GuestFileReader, FileTransferError
+from pcocc.Hypervisor import check_tar_member
+from pcocc.QMP import QGAClient
+
+class FakeFileAgent(object):
+    """Agent implementing the guest-file commands on in-memory files"""
+    def __init__(self, files=None, max_write=None):
+        self.client, self.server = socket.socketpair()
+        self.files = files or {}
+        self.max_write = max_write
+        self.handles = {}
+        self.commands = []
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        f = self.server.makefile('r')
+        for line in iter(f.readline, ''):
+            msg = json.loads(line)
+            self.commands.append(msg['execute'])
+            try:
+                ret = {'return': self.handle(msg['execute'],
+                                             msg.get('arguments', {}))}
+            except KeyError as err:
+                ret = {'error': {'class': 'GenericError', 'desc': str(err)}}
+            ret['id'] = msg['id']
+            self.server.sendall(json.dumps(ret) + '\n')
+
+    def handle(self, cmd, args):
+        if cmd == 'guest-file-open':
+            if args['mode'] == 'r':
+                data = self.files[args['path']]
+            else:
+                data = self.files[args['path']] = ''
+            handle = len(self.handles) + 1
+            self.handles[handle] = [args['path'], 0]
+            return handle
+        path, pos = self.handles[args['handle']]
+        if cmd == 'guest-file-write':
+            data = base64.b64decode(args['buf-b64'])[:self.max_write]
+            self.files[path] += data
+            return {'count': len(data), 'eof': False}
+        elif cmd == 'guest-file-read':
+            data = self.files[path][pos:pos + args['count']]
+            self.handles[args['handle']][1] += len(data)
+            return {'count': len(data), 'buf-b64': base64.b64encode(data),
+                    'eof': pos + len(data) >= len(self.files[path])}
+        elif cmd == 'guest-file-seek':
+            size = len(self.files[path])
+            pos = args['offset'] + (size if args['whence'] == 2 else 0)
+            self.handles[args['handle']][1] = pos
+            return {'position': pos, 'eof': pos >= size}
+        elif cmd == 'guest-file-close':
+            del self.handles[args['handle']]
+            return {}
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(Agent, 'FILE_CHUNK_SIZE', 1000)
+
+def test_write_chunks(small_chunks):
+    fake = FakeFileAgent()
+    progress = []
+    writer = GuestFileWriter(QGAClient(fake.client), '/tmp/f',
+                             progress=progress.append)
+    data = os.urandom(10500)
+    for i in range(0, len(data), 300):
+        writer.write(data[i:i + 300])
+    writer.close()
+
+    assert fake.files['/tmp/f'] == data
+    assert fake.commands.count('guest-file-write') == 11
+    assert progress[-1] == len(data)
+    assert fake.handles == {}
+
+def test_short_write(small_chunks):
+    fake = FakeFileAgent(max_write=10)
+    writer = GuestFileWriter(QGAClient(fake.client), '/tmp/f')
+    writer.write('x' * 100)
+    with pytest.raises(FileTransferError):
+        writer.close()
+    assert fake.commands[-1] == 'guest-file-close'
+    assert fake.handles == {}
+
+def test_read_chunks(small_chunks):
+    data = os.urandom(4321)
+    fake = FakeFileAgent({'/tmp/f': data})
+    reader = GuestFileReader(QGAClient(fake.client), '/tmp/f')
+    assert reader.size() == len(data)
+    assert reader.read(10) == data[:10]
+    assert reader.read(2500) == data[10:2510]
+    assert reader.read() == data[2510:]
+    assert reader.read() == ''
+    reader.close()
+    assert reader.received == len(data)
+    assert fake.handles == {}
+
+def test_failed_read(small_chunks):
+    fake = FakeFileAgent({'/tmp/f': 'x' * 4321})
+    reader = GuestFileReader(QGAClient(fake.client), '/tmp/f')
+    del fake.files['/tmp/f']
+    with pytest.raises(FileTransferError):
+        reader.read()
+    assert fake.commands[-1] == 'guest-file-close'
+    assert fake.handles == {}
+
+def test_missing_file():
+    fake = FakeFileAgent()
+    with pytest.raises(FileTransferError):
+        GuestFileReader(QGAClient(fake.client), '/missing')
+
+def test_tar_stream(small_chunks, tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('a').write('hello')
+    src.mkdir('sub').join('b').write(os.urandom(5000), 'wb')
+
+    fake = FakeFileAgent()
+    agent = QGAClient(fake.client)
+    writer = GuestFileWriter(agent, '/tmp/archive')
+    tar = tarfile.open(fileobj=writer, mode='w|')
+    tar.add(str(src), arcname='src')
+    tar.close()
+    writer.close()
+
+    dest = tmpdir.mkdir('dest')
+    reader = GuestFileReader(agent, '/tmp/archive')
+    tar = tarfile.open(fileobj=reader, mode='r|')
+    for member in tar:
+        check_tar_member(member)
+        tar.extract(member, str(dest))
+    reader.close()
+
+    assert dest.join('src', 'a').read() == 'hello'
+    assert (dest.join('src', 'sub', 'b').read('rb') ==
+            src.join('sub', 'b').read('rb'))
+
+@pytest.mark.parametrize('name, link', [('/etc/passwd', None),
+                                        ('a/../../b', None),
+                                        ('a', '../../etc')])
+def test_unsafe_tar_member(name, link):
+    member = tarfile.TarInfo(name)
+    if link:
+        member.type = tarfile.SYMTYPE
+        member.linkname = link
+    with pytest.raises(tarfile.TarError):
+        check_tar_member(member)
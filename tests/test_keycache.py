@@ -0,0 +1,113 @@
+import time
+import etcd
+
+from pcocc.Batch import KeyCache, LocalManager, ProcessType
+
+def test_cache_ttl(monkeypatch):
+    cache = KeyCache(10, {'/pcocc/cluster': 60,
+                          '/pcocc/cluster/1/nocache': 0,
+                          '/pcocc/global': 2})
+
+    cache.put('key', '/pcocc/cluster/1/a', 'a')
+    cache.put('key', '/pcocc/cluster/1/nocache/b', 'b')
+    cache.put('key', '/pcocc/global/c', 'c')
+    cache.put('key', '/other/d', 'd')
+
+    assert cache.get('key', '/pcocc/cluster/1/a') == 'a'
+    assert cache.get('key', '/pcocc/cluster/1/nocache/b') is None
+    assert cache.get('key', '/pcocc/global/c') == 'c'
+    assert cache.get('key', '/other/d') is None
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 10)
+    assert cache.get('key', '/pcocc/cluster/1/a') == 'a'
+    assert cache.get('key', '/pcocc/global/c') is None
+
+def test_cache_eviction():
+    cache = KeyCache(3, {'/': 60})
+
+    for i in xrange(3):
+        cache.put('key', '/k{0}'.format(i), i)
+
+    # Make k0 the most recently used
+    assert cache.get('key', '/k0') == 0
+
+    cache.put('key', '/k3', 3)
+    assert len(cache) == 3
+    assert cache.get('key', '/k1') is None
+    assert cache.get('key', '/k0') == 0
+    assert cache.get('key', '/k3') == 3
+
+def test_cache_invalidate():
+    cache = KeyCache(10, {'/': 60})
+
+    cache.put('dir', '/pcocc/cluster/1/', 'root')
+    cache.put('dir', '/pcocc/cluster/1/state/hosts', 'hosts')
+    cache.put('key', '/pcocc/cluster/1/state/hosts/0', 'host0')
+    cache.put('key', '/pcocc/cluster/1/state/hosts/1', 'host1')
+    cache.put('key', '/pcocc/cluster/1/state/hosts10', 'other')
+
+    # Parents and the key itself are dropped
+    cache.invalidate('/pcocc/cluster/1/state/hosts/0')
+    assert cache.get('dir', '/pcocc/cluster/1/') is None
+    assert cache.get('dir', '/pcocc/cluster/1/state/hosts') is None
+    assert cache.get('key', '/pcocc/cluster/1/state/hosts/0') is None
+    assert cache.get('key', '/pcocc/cluster/1/state/hosts/1') == 'host1'
+    assert cache.get('key', '/pcocc/cluster/1/state/hosts10') == 'other'
+
+    # Children are dropped with their directory
+    cache.invalidate('/pcocc/cluster/1/state/hosts/')
+    assert cache.get('key', '/pcocc/cluster/1/state/hosts/1') is None
+    assert cache.get('key', '/pcocc/cluster/1/state/hosts10') == 'other'
+
+def test_cache_invalidate_index():
+    cache = KeyCache(2, {'/': 60})
+
+    # Values read before the last change of their path or of a key
+    # below them are stale
+    cache.invalidate('/d/k', 7)
+    cache.put('key', '/d/k', 'old', 6)
+    cache.put('dir', '/d', 'old', 6)
+    cache.put('key', '/d/other', 'other', 6)
+    assert cache.get('key', '/d/k') is None
+    assert cache.get('dir', '/d') is None
+    assert cache.get('key', '/d/other') == 'other'
+
+    cache.put('key', '/d/k', 'new', 7)
+    assert cache.get('key', '/d/k') == 'new'
+
+    # Values older than forgotten invalidations are not cached
+    cache.invalidate('/a', 8)
+    cache.invalidate('/b', 9)
+    cache.invalidate('/c', 10)
+    cache.put('key', '/e', 'old', 7)
+    assert cache.get('key', '/e') is None
+    cache.put('key', '/e', 'new', 8)
+    assert cache.get('key', '/e') == 'new'
+
+class RacingClient(object):
+    """Client whose key is modified while it is being read"""
+    def __init__(self, manager):
+        self.manager = manager
+
+    def read(self, key, **kwargs):
+        ret = etcd.EtcdResult('get', {'key': key, 'value': 'old',
+                                      'modifiedIndex': 5})
+        ret.etcd_index = 6
+        # Notified by the watcher before the value is cached
+        self.manager._cache_invalidate(key, 7)
+        return ret
+
+def test_invalidate_during_read():
+    manager = LocalManager(None, None, None,
+                           {'etcd-servers': ['localhost'],
+                            'etcd-client-port': 2379,
+                            'etcd-protocol': 'http',
+                            'etcd-auth-type': 'none',
+                            'etcd-cache-size': 10},
+                           ProcessType.OTHER, 'user1')
+    manager._keyval_client = RacingClient(manager)
+
+    assert manager.read_key_index('global', 'k') == ('old', 6)
+    assert manager._cache.get('key',
+                              manager.get_key_path('global', 'k')) is None
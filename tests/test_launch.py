@@ -0,0 +1,71 @@
+import os
+import time
+import threading
+import pytest
+
+from pcocc.Misc import TaskGraph
+from pcocc.Hypervisor import ProbeCache
+
+def test_task_graph():
+    order = []
+    lock = threading.Lock()
+    def task(name, delay=0):
+        def run():
+            time.sleep(delay)
+            with lock:
+                order.append(name)
+            return name.upper()
+        return run
+
+    graph = TaskGraph()
+    graph.add('a', task('a', 0.1))
+    graph.add('b', task('b'))
+    graph.add('c', task('c'), deps=['a', 'b'])
+    results = graph.run()
+
+    assert results == {'a': 'A', 'b': 'B', 'c': 'C'}
+    assert order == ['b', 'a', 'c']
+    assert set(graph.timings) == set(['a', 'b', 'c'])
+    assert graph.timings['a'] >= 0.1
+
+def test_task_graph_failure():
+    ran = []
+    def fail():
+        raise KeyError('boom')
+
+    graph = TaskGraph()
+    graph.add('a', fail)
+    graph.add('b', lambda: ran.append('b'))
+    graph.add('c', lambda: ran.append('c'), deps=['a'])
+    with pytest.raises(KeyError):
+        graph.run()
+    assert ran == ['b']
+
+    with pytest.raises(ValueError):
+        graph.add('d', fail, deps=['unknown'])
+
+def test_probe_cache(tmpdir):
+    binary = tmpdir.join('qemu')
+    binary.write('')
+    calls = []
+    def probe():
+        calls.append(1)
+        return 2.5
+
+    path = str(tmpdir.join('probes'))
+    assert ProbeCache(path).get('version', str(binary), probe) == 2.5
+    # Shared through the cache file
+    assert ProbeCache(path).get('version', str(binary), probe) == 2.5
+    assert len(calls) == 1
+
+    # Invalidated when the binary changes
+    st = os.stat(str(binary))
+    os.utime(str(binary), (st.st_atime, st.st_mtime + 10))
+    assert ProbeCache(path).get('version', str(binary), probe) == 2.5
+    assert len(calls) == 2
+
+    # Missing files are not cached
+    cache = ProbeCache(path)
+    cache.get('version', str(tmpdir.join('missing')), probe)
+    cache.get('version', str(tmpdir.join('missing')), probe)
+    assert len(calls) == 4
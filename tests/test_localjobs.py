@@ -0,0 +1,141 @@
+import os
+import pwd
+import pytest
+import socket
+import uuid
+import etcd
+import yaml
+
+from collections import namedtuple
+from pcocc.Batch import LocalManager, ProcessType
+from pcocc.Batch import AllocationError, InvalidJobError
+
+Node = namedtuple('Node', ['key', 'value'])
+Dir = namedtuple('Dir', ['children'])
+
+settings = {'etcd-servers': ['localhost'],
+            'etcd-client-port': 2379,
+            'etcd-protocol': 'http',
+            'etcd-auth-type': 'none'}
+
+@pytest.fixture
+def manager(mocker):
+    kv = {}
+    batch = LocalManager(None, None, None, settings,
+                         ProcessType.OTHER, 'user1')
+
+    def read_key(key_type, key):
+        return kv.get(key)
+
+    def write_key(key_type, key, value):
+        kv[key] = value
+
+    def write_key_new(key_type, key, value):
+        if key in kv:
+            raise etcd.EtcdAlreadyExist()
+        kv[key] = value
+
+    def delete_key(key_type, key):
+        if key not in kv:
+            raise etcd.EtcdKeyNotFound()
+        del kv[key]
+
+    def read_dir(key_type, key):
+        children = [Node('/pcocc/global/' + k, v) for k, v in kv.items()
+                    if k.startswith(key + '/')]
+        return Dir(children) if children else None
+
+    def atom_update_key(key_type, key, func, *args):
+        value, ret = func(*(args + (kv.get(key),)))
+        kv[key] = value
+        return ret
+
+    for f in [read_key, write_key, write_key_new, delete_key, read_dir,
+              atom_update_key]:
+        mocker.patch.object(batch, f.__name__, side_effect=f)
+    mocker.patch.object(batch, '_list_alive_jobs', return_value=[])
+
+    batch.kv = kv
+    return batch
+
+def test_alloc_free(manager):
+    host = socket.gethostname().split('.')[0]
+    u1 = uuid.uuid4()
+    u2 = uuid.uuid4()
+
+    id1 = manager._alloc_job('user1', 'job', u1, 'def')
+    id2 = manager._alloc_job('user1', 'other', u2, 'def')
+    assert id2 == id1 + 1
+
+    assert manager.find_job_by_name('user1', 'job') == id1
+    assert manager.find_job_by_name('user1', 'job', host) == id1
+    assert manager._uuid_to_batchid('user1', u2) == id2
+    assert manager._get_job_record(id2)['batchname'] == 'other'
+    assert sorted(manager.list_all_jobs()) == [id1, id2]
+
+    with pytest.raises(AllocationError):
+        manager._alloc_job('user1', 'job', uuid.uuid4(), 'def')
+
+    manager._free_job(id1, manager._get_job_record(id1))
+    with pytest.raises(InvalidJobError):
+        manager.find_job_by_name('user1', 'job')
+    with pytest.raises(InvalidJobError):
+        manager._get_job_record(id1)
+    assert manager.list_all_jobs() == [id2]
+
+    # Names can be reused once freed
+    assert manager._alloc_job('user1', 'job', u1, 'def') > id2
+
+def test_cleanup_orphan_index_keys(manager):
+    u1 = uuid.uuid4()
+    id1 = manager._alloc_job('user1', 'job', u1, 'def')
+    id2 = manager._alloc_job('user1', 'other', uuid.uuid4(), 'def')
+
+    # Index keys left without their record by an interrupted allocation
+    del manager.kv[manager._job_key(id2)]
+    manager._cleanup_orphan_index_keys()
+
+    assert manager.find_job_by_name('user1', 'job') == id1
+    assert manager._uuid_to_batchid('user1', u1) == id1
+    assert sorted(k for k in manager.kv if '/by-' in k) == sorted(
+        [manager._job_uuid_key(u1),
+         manager._job_name_key('user1', socket.gethostname().split('.')[0],
+                               'job')])
+
+def test_migrate_legacy_state(manager):
+    u1 = str(uuid.uuid4())
+    manager.kv['public/batch-local/job_allocation_state'] = yaml.dump(
+        {'jobs': {'12': {'batchname': 'job', 'definition': 'def',
+                         'uuid': u1, 'host': 'node1', 'user': 'user1',
+                         'start': 0}},
+         'next_batchid': 13})
+
+    # Allocations continue from the legacy counter before migration
+    assert manager._alloc_job('user1', 'new', uuid.uuid4(), 'def') == 13
+
+    manager._migrate_job_allocation_state()
+    assert 'public/batch-local/job_allocation_state' not in manager.kv
+    assert manager.find_job_by_name('user1', 'job', 'node1') == 12
+    assert manager._uuid_to_batchid('user1', u1) == 12
+    assert manager._alloc_job('user1', 'new2', uuid.uuid4(), 'def') == 14
+
+def test_clean_node_state_dir(manager, tmpdir):
+    manager.batchid = 1
+    manager.batchuser = pwd.getpwuid(os.getuid()).pw_name
+
+    # Symlinks and directories which are not private are left alone
+    target = tmpdir.mkdir('target')
+    manager.node_state_dir = str(tmpdir.join('link'))
+    os.symlink(str(target), manager.node_state_dir)
+    manager.clean_node_state_dir()
+    assert target.check(dir=1)
+
+    manager.node_state_dir = str(target)
+    target.chmod(0o755)
+    manager.clean_node_state_dir()
+    assert target.check(dir=1)
+
+    target.chmod(0o700)
+    target.join('probes').write('')
+    manager.clean_node_state_dir()
+    assert not target.check()
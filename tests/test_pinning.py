@@ -0,0 +1,69 @@
+import pytest
+
+from pcocc.Hypervisor import ThreadPinning, HypervisorError
+from pcocc.QMP import QMPError
+
+class FakeMonitor(object):
+    def __init__(self, replies):
+        self.replies = replies
+        self.commands = []
+
+    def execute(self, command, arguments=None):
+        self.commands.append(command)
+        reply = self.replies[command]
+        if 'error' in reply:
+            raise QMPError(reply['error']['desc'], reply['error']['class'])
+        return reply['return']
+
+@pytest.fixture
+def bindings(mocker):
+    bound = {}
+    class FakeProcess(object):
+        def __init__(self, tid):
+            self.tid = tid
+        def cpu_affinity(self, pus):
+            bound[self.tid] = pus
+    mocker.patch('pcocc.Hypervisor.psutil.Process', FakeProcess)
+    return bound
+
+def test_pinning_fast(bindings, tmpdir):
+    mon = FakeMonitor({
+        'query-iothreads': {'return': [{'id': 'ioth-datadisk0',
+                                        'thread-id': 11}]},
+        'query-cpus-fast': {'return': [{'cpu-index': 0, 'thread-id': 20},
+                                       {'cpu-index': 1, 'thread-id': 21}]}})
+
+    pinning = ThreadPinning(10, [[2, 66], [3, 67]], [0, 64])
+    pinning.apply(mon)
+
+    assert 'query-cpus' not in mon.commands
+    assert bindings == {10: [0, 64], 11: [0, 64],
+                        20: [2, 66], 21: [3, 67]}
+
+    path = tmpdir.join('cpu_layout')
+    pinning.save_layout(str(path))
+    lines = path.read().splitlines()
+    assert lines[1:] == ['main - 10 0,64',
+                         'iothread ioth-datadisk0 11 0,64',
+                         'vcpu 0 20 2,66',
+                         'vcpu 1 21 3,67']
+
+def test_pinning_fallback(bindings):
+    mon = FakeMonitor({
+        'query-iothreads': {'error': {'class': 'CommandNotFound',
+                                      'desc': 'not found'}},
+        'query-cpus-fast': {'error': {'class': 'CommandNotFound',
+                                      'desc': 'not found'}},
+        'query-cpus': {'return': [{'CPU': 0, 'thread_id': 20},
+                                  {'CPU': 1, 'thread_id': 21}]}})
+
+    ThreadPinning(10, [[2], [3]]).apply(mon)
+    assert bindings == {10: [2, 3], 20: [2], 21: [3]}
+
+def test_pinning_missing_core(bindings):
+    mon = FakeMonitor({
+        'query-iothreads': {'return': []},
+        'query-cpus-fast': {'return': [{'cpu-index': 1, 'thread-id': 21}]}})
+
+    with pytest.raises(HypervisorError):
+        ThreadPinning(10, [[2]]).apply(mon)
@@ -0,0 +1,232 @@
+import os
+import json
+import select
+import socket
+import threading
+import pytest
+
+from pcocc.QMP import QMPClient, QGAClient, QMPError, QMPConnectionError
+from pcocc.QMP import QMPTimeoutError, Reactor
+
+class FakeQemu(object):
+    """Monitor server answering commands with a handler in a thread"""
+    def __init__(self, handler, greeting=True):
+        self.client, self.server = socket.socketpair()
+        self.handler = handler
+        self.commands = []
+        if greeting:
+            self.send({'QMP': {'version': {}, 'capabilities': []}})
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, msg, raw=False):
+        self.server.sendall(msg if raw else json.dumps(msg) + '\r\n')
+
+    def run(self):
+        f = self.server.makefile('r')
+        for line in iter(f.readline, ''):
+            line = line.replace('\xff', '')
+            if not line.strip():
+                continue
+            msg = json.loads(line)
+            self.commands.append(msg)
+            self.handler(self, msg)
+
+def reply(msg, ret, with_id=True):
+    ans = {'return': ret}
+    if with_id and 'id' in msg:
+        ans['id'] = msg['id']
+    return ans
+
+def test_commands_and_events():
+    def handler(qemu, msg):
+        cmd = msg['execute']
+        if cmd == 'qmp_capabilities':
+            qemu.send(reply(msg, {}))
+        elif cmd == 'migrate':
+            qemu.send(reply(msg, {}))
+            qemu.send({'event': 'RESUME'})
+            qemu.send({'event': 'MIGRATION',
+                       'data': {'status': 'completed'}})
+        elif cmd == 'fail':
+            qemu.send({'id': msg['id'],
+                       'error': {'class': 'GenericError', 'desc': 'oops'}})
+        elif cmd == 'split':
+            # A message may arrive in several reads
+            data = json.dumps(reply(msg, 'done')) + '\r\n'
+            qemu.send(data[:5], raw=True)
+            qemu.send(data[5:], raw=True)
+
+    qemu = FakeQemu(handler)
+    qmp = QMPClient(qemu.client, timeout=5)
+    assert qmp.greeting['QMP'] == {'version': {}, 'capabilities': []}
+
+    events = qmp.subscribe(['MIGRATION'])
+    assert qmp.execute('migrate', {'uri': 'exec:cat'}, timeout=5) == {}
+    assert events.get(timeout=5)['data']['status'] == 'completed'
+    assert events.get(timeout=0.1) is None
+
+    with pytest.raises(QMPError) as err:
+        qmp.execute('fail', timeout=5)
+    assert err.value.error_class == 'GenericError'
+
+    assert qmp.execute('split', timeout=5) == 'done'
+    assert qemu.commands[1]['arguments'] == {'uri': 'exec:cat'}
+
+    qmp.close()
+    with pytest.raises(QMPConnectionError):
+        qmp.execute('query-status')
+
+def test_concurrent_replies():
+    held = []
+    def handler(qemu, msg):
+        if msg['execute'] == 'qmp_capabilities':
+            qemu.send(reply(msg, {}))
+        elif msg['execute'] == 'slow':
+            held.append(msg)
+        else:
+            # Answer out of order
+            qemu.send(reply(msg, msg['execute']))
+            for m in held:
+                qemu.send(reply(m, 'slow'))
+
+    qemu = FakeQemu(handler)
+    qmp = QMPClient(qemu.client, timeout=5)
+    slow = qmp.execute_async('slow')
+    assert not slow.done()
+    assert qmp.execute('fast', timeout=5) == 'fast'
+    assert slow.result(timeout=5) == 'slow'
+
+def test_connection_closed():
+    def handler(qemu, msg):
+        if msg['execute'] == 'qmp_capabilities':
+            qemu.send(reply(msg, {}))
+        else:
+            qemu.server.shutdown(socket.SHUT_RDWR)
+
+    qemu = FakeQemu(handler)
+    qmp = QMPClient(qemu.client, timeout=5)
+    events = qmp.subscribe(['SHUTDOWN'])
+    with pytest.raises(QMPConnectionError):
+        qmp.execute('quit', timeout=5)
+    assert events.get(timeout=5) is None
+
+def test_agent_sync():
+    def handler(qemu, msg):
+        if msg['execute'] == 'guest-sync-delimited':
+            # Only answer the second sync, after stale data
+            if len(qemu.commands) == 2:
+                qemu.send('garbage\n{"return": 12', raw=True)
+                qemu.send('\xff', raw=True)
+                qemu.send({'return': 1234})
+                qemu.send('\xff' + json.dumps(reply(msg, msg['arguments']['id'],
+                                                    False)), raw=True)
+                qemu.send(reply(msg, msg['arguments']['id'], False))
+        else:
+            # Old agents don't return ids
+            qemu.send(reply(msg, 42, False))
+
+    orphans = []
+    qemu = FakeQemu(handler, greeting=False)
+    agent = QGAClient(qemu.client, orphan_handler=orphans.append)
+    agent.sync(timeout=5, retry_interval=0.1)
+    assert agent.execute('guest-fsfreeze-thaw', timeout=5) == 42
+    assert orphans == [{'return': 1234}]
+
+def test_agent_sync_fallback():
+    def handler(qemu, msg):
+        if msg['execute'] == 'guest-sync':
+            qemu.send(reply(msg, msg['arguments']['id']))
+        else:
+            qemu.send({'error': {'class': 'CommandNotFound',
+                                 'desc': 'The command %s has not been found' %
+                                 msg['execute']}})
+
+    qemu = FakeQemu(handler, greeting=False)
+    agent = QGAClient(qemu.client)
+    agent.sync(timeout=5, retry_interval=0.01)
+    assert qemu.commands[-1]['execute'] == 'guest-sync'
+
+def test_agent_sync_timeout():
+    qemu = FakeQemu(lambda qemu, msg: None, greeting=False)
+    agent = QGAClient(qemu.client)
+    with pytest.raises(QMPTimeoutError):
+        agent.sync(timeout=0.3, retry_interval=0.1)
+
+def test_expect_reply():
+    qemu = FakeQemu(lambda qemu, msg: None, greeting=False)
+    agent = QGAClient(qemu.client)
+    pending = agent.expect_reply('guest-cmd-exec')
+    qemu.send({'return': 0, 'id': 7})
+    assert pending.result(timeout=5) == 0
+
+def test_agent_dict_reply():
+    def handler(qemu, msg):
+        if msg['execute'] == 'guest-sync-delimited':
+            qemu.send(reply(msg, msg['arguments']['id'], False))
+        elif msg['execute'] == 'guest-file-read':
+            qemu.send(reply(msg, {'count': 3, 'buf-b64': 'YWJj',
+                                  'eof': True}, False))
+        else:
+            qemu.send(reply(msg, [{'name': 'lo'}], False))
+
+    qemu = FakeQemu(handler, greeting=False)
+    agent = QGAClient(qemu.client)
+    agent.sync(timeout=5, retry_interval=0.1)
+    assert agent.execute('guest-file-read', {'handle': 1},
+                         timeout=5)['buf-b64'] == 'YWJj'
+    assert agent.execute('guest-network-get-interfaces',
+                         timeout=5) == [{'name': 'lo'}]
+
+class HighFdChannel(object):
+    """Socket duplicated to a descriptor above the select() limit"""
+    def __init__(self, sock, fd=1500):
+        self.sock = sock
+        self.fd = os.dup2(sock.fileno(), fd) or fd
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+        self.sock.close()
+
+def test_high_fd():
+    def handler(qemu, msg):
+        qemu.send(reply(msg, {'count': 1}))
+
+    qemu = FakeQemu(handler, greeting=False)
+    agent = QGAClient(HighFdChannel(qemu.client))
+    assert agent.execute('guest-ping', timeout=5) == {'count': 1}
+    agent.close()
+
+class FailingEpoll(object):
+    """epoll object whose poll fails once released"""
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.release = threading.Event()
+
+    def register(self, fd, events):
+        self.epoll.register(fd, events)
+
+    def unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        self.release.wait(5)
+        raise ValueError('poll failed')
+
+def test_reactor_failure():
+    qemu = FakeQemu(lambda qemu, msg: None, greeting=False)
+    reactor = Reactor()
+    reactor._epoll = FailingEpoll()
+    agent = QGAClient(qemu.client, reactor=reactor)
+    pending = agent.execute_async('guest-ping')
+
+    # Pending replies fail instead of hanging when the loop dies
+    reactor._epoll.release.set()
+    with pytest.raises(QMPConnectionError):
+        pending.result(timeout=5)
+    assert reactor.stopped
+    assert Reactor.shared() is not reactor
@@ -0,0 +1,72 @@
+import pytest
+
+from pcocc.Batch import RankMap, BatchError
+from pcocc.Misc import encode_value
+
+def flat_map(tasks_per_node):
+    """Reference expansion of SLURM_TASKS_PER_NODE"""
+    ranks = []
+    node_index = 0
+    for node_def in tasks_per_node.split(','):
+        if '(x' in node_def:
+            ntasks, nnodes = node_def.rstrip(')').split('(x')
+        else:
+            ntasks, nnodes = node_def, 1
+        for _ in range(int(nnodes)):
+            ranks += [node_index] * int(ntasks)
+            node_index += 1
+    return ranks
+
+@pytest.mark.parametrize('tasks_per_node', ['1', '4(x3)', '2(x2),3,1(x4)',
+                                            '2,2,0,3(x2)', '5,2(x2),5'])
+def test_lookups(tasks_per_node):
+    ref = flat_map(tasks_per_node)
+    rank_map = RankMap.from_tasks_per_node(tasks_per_node)
+
+    assert len(rank_map) == len(ref)
+    assert rank_map.num_hosts == len(tasks_per_node.split(',')) + sum(
+        int(d.rstrip(')').split('(x')[1]) - 1
+        for d in tasks_per_node.split(',') if '(x' in d)
+
+    for rank, host in enumerate(ref):
+        rank_on_host = rank - ref.index(host)
+        assert rank_map.locate(rank) == (host, rank_on_host)
+        assert rank_map[rank] == host
+
+    for host in range(rank_map.num_hosts):
+        assert rank_map.ranks_on_host(host) == [r for r, h in enumerate(ref)
+                                                if h == host]
+
+    with pytest.raises(IndexError):
+        rank_map.locate(len(ref))
+    with pytest.raises(IndexError):
+        rank_map.ranks_on_host(rank_map.num_hosts)
+
+def test_compact_groups():
+    rank_map = RankMap.from_tasks_per_node('2(x2),2,2(x3),1')
+    assert rank_map.groups == [[2, 6], [1, 1]]
+
+def test_encoding():
+    rank_map = RankMap.from_tasks_per_node('4(x10000)')
+    data = rank_map.encode()
+    assert len(data) < 64
+
+    decoded = RankMap.decode(data)
+    assert decoded.groups == rank_map.groups
+    assert decoded.locate(39999) == (9999, 3)
+
+def test_legacy_list():
+    ref = flat_map('2(x2),3,1')
+    rank_map = RankMap.decode(encode_value(ref))
+    assert rank_map.groups == [[2, 2], [3, 1], [1, 1]]
+    assert [rank_map[r] for r in range(len(ref))] == ref
+
+    # Host 1 has no tasks
+    rank_map = RankMap.from_list([0, 0, 2])
+    assert rank_map.groups == [[2, 1], [0, 1], [1, 1]]
+    assert rank_map.num_hosts == 3
+    assert rank_map.locate(2) == (2, 0)
+    assert rank_map.ranks_on_host(1) == []
+
+    with pytest.raises(BatchError):
+        RankMap.from_list([0, 1, 0])
@@ -0,0 +1,122 @@
+import os
+import socket
+import select
+import threading
+import pytest
+
+from pcocc.Relay import RelayClient, Multiplexer, unix_opener, local_connect
+
+def local_transport():
+    """Runs the relay side in a thread, connected through pipes"""
+    c2r_r, c2r_w = os.pipe()
+    r2c_r, r2c_w = os.pipe()
+    mux = Multiplexer(c2r_r, r2c_w, opener=unix_opener)
+
+    def run():
+        # Close the pipes when done as an exiting relay process would
+        mux.run()
+        os.close(c2r_r)
+        os.close(r2c_w)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return None, r2c_r, c2r_w
+
+@pytest.fixture
+def echo_server(tmpdir):
+    """UNIX socket server echoing data until 'quit' is received"""
+    path = str(tmpdir.join('echo_socket'))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(128)
+
+    def handle(conn):
+        while True:
+            data = conn.recv(65536)
+            if not data or data == 'quit':
+                break
+            conn.sendall(data)
+        conn.close()
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            t = threading.Thread(target=handle, args=[conn])
+            t.daemon = True
+            t.start()
+
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+    return path
+
+def read_exactly(chan, size):
+    data = ''
+    while len(data) < size:
+        select.select([chan.stdout], [], [], 5)
+        chunk = os.read(chan.stdout.fileno(), size - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+def test_echo(echo_server):
+    client = RelayClient(local_transport)
+    chan = client.connect(echo_server)
+
+    chan.stdin.write('hello')
+    assert read_exactly(chan, 5) == 'hello'
+    assert chan.poll() is None
+
+    # Large transfers are split in several frames
+    payload = os.urandom(1024 * 1024)
+    writer = threading.Thread(target=chan.stdin.write, args=[payload])
+    writer.start()
+    assert read_exactly(chan, len(payload)) == payload
+    writer.join()
+
+    chan.terminate()
+    assert chan.poll() == -15
+
+def test_remote_close(echo_server):
+    client = RelayClient(local_transport)
+    chan = client.connect(echo_server)
+    chan.stdin.write('quit')
+    assert chan.stdout.readline() == ''
+    assert chan.poll() == 0
+
+def test_open_failure(tmpdir):
+    client = RelayClient(local_transport)
+    chan = client.connect(str(tmpdir.join('missing')))
+    assert chan.stdout.read() == ''
+    assert chan.poll() == 1
+
+    chan = local_connect(str(tmpdir.join('missing')))
+    assert chan.stdout.read() == ''
+    assert chan.poll() == 1
+
+def test_many_channels(echo_server):
+    client = RelayClient(local_transport)
+    channels = [client.connect(echo_server) for _ in range(50)]
+    for i, chan in enumerate(channels):
+        chan.stdin.write('chan%d\n' % i)
+    for i, chan in enumerate(channels):
+        assert chan.stdout.readline() == 'chan%d\n' % i
+    for chan in channels:
+        chan.terminate()
+
+def test_connection_lost(echo_server):
+    def transport():
+        proc, rfd, wfd = local_transport()
+        transport.wfd = wfd
+        return proc, rfd, wfd
+
+    client = RelayClient(transport)
+    chan = client.connect(echo_server)
+    chan.stdin.write('ping')
+    assert read_exactly(chan, 4) == 'ping'
+
+    # The relay sees EOF and closes all channels
+    os.close(transport.wfd)
+    assert chan.stdout.read() == ''
+    assert chan.poll() == 1
@@ -0,0 +1,23 @@
+import pytest
+import jsonschema
+
+from pcocc.Misc import schema_validator, validate_schema, mark_validated
+from pcocc.Misc import encode_value, id_allocation_schema
+
+def test_schema_validator_cached():
+    assert (schema_validator(id_allocation_schema) is
+            schema_validator(id_allocation_schema))
+
+def test_validate_schema():
+    valid = [{'pkey_index': 1, 'batchid': 2}]
+    invalid = [{'pkey_index': 'x', 'batchid': 2}]
+
+    validate_schema(valid, id_allocation_schema, encode_value(valid))
+    with pytest.raises(jsonschema.exceptions.ValidationError):
+        validate_schema(invalid, id_allocation_schema, encode_value(invalid))
+
+    # Values marked as validated are trusted
+    mark_validated(encode_value(invalid), id_allocation_schema)
+    validate_schema(invalid, id_allocation_schema, encode_value(invalid))
+    with pytest.raises(jsonschema.exceptions.ValidationError):
+        validate_schema(invalid, id_allocation_schema)
@@ -0,0 +1,53 @@
+import os
+import time
+
+from pcocc.Batch import SlurmJobCache
+
+squeue_output = """12|user1|node[1-2]|pcocc
+13|user2||job|with|pipes
+"""
+
+scontrol_output = """JobId=12 JobName=pcocc
+   UserId=user1(1000) GroupId=user1(1000)
+   MinCPUsNode=1 MinMemoryCPU=2000M MinTmpDiskNode=0
+"""
+
+def fake_slurm(cmd):
+    if cmd[0] == 'squeue':
+        return squeue_output
+    return scontrol_output
+
+def test_job_cache(tmpdir, mocker):
+    run = mocker.patch('pcocc.Batch.subprocess_check_output',
+                       side_effect=fake_slurm)
+    path = str(tmpdir.join('cache'))
+
+    jobs = SlurmJobCache(60, path).jobs()
+    assert jobs[12] == {'user': 'user1', 'nodes': 'node[1-2]', 'name': 'pcocc'}
+    assert jobs[13]['name'] == 'job|with|pipes'
+
+    # Other processes reuse the snapshot until it expires
+    assert SlurmJobCache(60, path).jobs() == jobs
+    assert run.call_count == 1
+    SlurmJobCache(60, path).jobs(refresh=True)
+    assert run.call_count == 2
+
+    # scontrol is only called once per job
+    assert SlurmJobCache(60, path).job_details(12)['MinMemoryCPU'] == '2000M'
+    assert SlurmJobCache(60, path).job_details(12)['UserId'] == 'user1(1000)'
+    assert run.call_count == 3
+
+    cache = SlurmJobCache(0, path)
+    time.sleep(0.01)
+    cache.jobs()
+    assert run.call_count == 4
+
+def test_job_cache_unsafe(tmpdir, mocker):
+    run = mocker.patch('pcocc.Batch.subprocess_check_output',
+                       side_effect=fake_slurm)
+    path = str(tmpdir.join('cache'))
+
+    SlurmJobCache(60, path).jobs()
+    os.chmod(path, 0o666)
+    SlurmJobCache(60, path).jobs()
+    assert run.call_count == 2
@@ -0,0 +1,55 @@
+from pcocc.Stats import phase_durations, percentile, StartupStats
+
+def history(*states):
+    return [{'state': state, 'desc': state, 'wall': 1000 + t, 'monotonic': t}
+            for state, t in states]
+
+def test_phase_durations():
+    durations = phase_durations(history(('topology', 0),
+                                        ('temporary-disk', 1),
+                                        ('qemu-start', 3.5),
+                                        ('complete', 4)))
+    assert durations.items() == [('topology', 1),
+                                 ('temporary-disk', 2.5),
+                                 ('qemu-start', 0.5),
+                                 ('total', 4)]
+
+def test_phase_durations_incomplete():
+    durations = phase_durations(history(('topology', 0),
+                                        ('temporary-disk', 1)))
+    assert durations.items() == [('topology', 1)]
+    assert phase_durations([]) == {}
+
+def test_percentile():
+    values = range(1, 101)
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([3], 99) == 3
+    assert percentile([5, 1], 0) == 1
+
+def test_startup_stats():
+    stats = StartupStats(now=1010)
+    stats.add('hosts', 'node1', 'node1',
+              history(('network-config', 0), ('complete', 1)))
+    stats.add('vms', 'vm0', 'node1',
+              history(('topology', 0), ('qemu-start', 1), ('complete', 2)))
+    stats.add('vms', 'vm1', 'node1',
+              history(('topology', 0), ('qemu-start', 3), ('complete', 7)))
+    stats.add('vms', 'vm2', 'node1',
+              history(('topology', 0), ('qemu-start', 1)))
+    stats.add('vms', 'vm3', 'node1', [])
+
+    phases = stats.phases('vms')
+    assert phases.keys() == ['topology', 'qemu-start', 'total']
+    assert phases['topology'] == {'count': 3, 'min': 1, 'median': 1,
+                                  'p99': 3, 'max': 3}
+    assert phases['total']['count'] == 2
+
+    # vm2 is still starting and has been for 10s
+    assert stats.nodes('vms')['vm2']['total'] == 10
+    assert stats.slowest('vms', 3) == ['vm3', 'vm2', 'vm1']
+
+    exported = stats.to_dict()
+    assert exported['hosts']['phases']['network-config']['max'] == 1
+    assert exported['vms']['nodes']['vm3']['state'] == 'not-started'
@@ -0,0 +1,126 @@
+import os
+import pytest
+
+from pcocc.Topology import Topology, TopologyError, parse_hwloc_cpuset
+
+# Two sockets with one NUMA node each, two cores per socket with two
+# hyperthreads. PU OS indexes are interleaved between sockets.
+HWLOC1_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE topology SYSTEM "hwloc.dtd">
+<topology>
+  <object type="Machine" os_index="0" cpuset="0x000000ff">
+    <object type="NUMANode" os_index="0" cpuset="0x00000033" local_memory="1024">
+      <object type="Package" os_index="0" cpuset="0x00000033">
+        <object type="Cache" cpuset="0x00000033" cache_size="1048576" depth="3" cache_type="0">
+          <object type="Core" os_index="0" cpuset="0x00000011">
+            <object type="PU" os_index="0" cpuset="0x00000001"/>
+            <object type="PU" os_index="4" cpuset="0x00000010"/>
+          </object>
+          <object type="Core" os_index="1" cpuset="0x00000022">
+            <object type="PU" os_index="1" cpuset="0x00000002"/>
+            <object type="PU" os_index="5" cpuset="0x00000020"/>
+          </object>
+        </object>
+      </object>
+    </object>
+    <object type="NUMANode" os_index="1" cpuset="0x000000cc" local_memory="1024">
+      <object type="Package" os_index="1" cpuset="0x000000cc">
+        <object type="Cache" cpuset="0x000000cc" cache_size="1048576" depth="3" cache_type="0">
+          <object type="Core" os_index="0" cpuset="0x00000044">
+            <object type="PU" os_index="2" cpuset="0x00000004"/>
+            <object type="PU" os_index="6" cpuset="0x00000040"/>
+          </object>
+          <object type="Core" os_index="1" cpuset="0x00000088">
+            <object type="PU" os_index="3" cpuset="0x00000008"/>
+            <object type="PU" os_index="7" cpuset="0x00000080"/>
+          </object>
+        </object>
+      </object>
+    </object>
+  </object>
+</topology>
+"""
+
+# hwloc 2 attaches NUMA nodes as memory children
+HWLOC2_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE topology SYSTEM "hwloc2.dtd">
+<topology version="2.0">
+  <object type="Machine" os_index="0" cpuset="0x0000000f">
+    <object type="Package" os_index="0" cpuset="0x0000000f">
+      <object type="L2Cache" cpuset="0x00000003" cache_size="524288" depth="2" cache_type="0">
+        <object type="L1iCache" cpuset="0x00000001" cache_size="32768" depth="1" cache_type="2">
+          <object type="Core" os_index="0" cpuset="0x00000001">
+            <object type="PU" os_index="0" cpuset="0x00000001"/>
+          </object>
+        </object>
+        <object type="Core" os_index="1" cpuset="0x00000002">
+          <object type="PU" os_index="1" cpuset="0x00000002"/>
+        </object>
+      </object>
+      <object type="Core" os_index="2" cpuset="0x00000004">
+        <object type="PU" os_index="2" cpuset="0x00000004"/>
+      </object>
+      <object type="Core" os_index="3" cpuset="0x00000008">
+        <object type="PU" os_index="3" cpuset="0x00000008"/>
+      </object>
+      <object type="NUMANode" os_index="1" cpuset="0x0000000c" local_memory="1024"/>
+      <object type="NUMANode" os_index="0" cpuset="0x00000003" local_memory="1024"/>
+    </object>
+  </object>
+</topology>
+"""
+
+def test_parse_cpuset():
+    assert parse_hwloc_cpuset('0x00000005') == set([0, 2])
+    assert parse_hwloc_cpuset('0x00000001,0x00000000') == set([32])
+    assert parse_hwloc_cpuset('0x00000001,,0x00000001') == set([0, 64])
+
+def test_hwloc1():
+    topo = Topology.from_xml(HWLOC1_XML)
+    assert topo.num_cores == 4
+    assert topo.core_pus(0) == [0, 4]
+    assert topo.core_pus('3') == [3, 7]
+    assert topo.core_pus(['1', '2']) == [1, 2, 5, 6]
+    assert [topo.core_numa(c) for c in range(4)] == [0, 0, 1, 1]
+    assert topo.numa_nodes == [0, 1]
+    assert str(topo.cores_from_pus([4, 6, 7])) == '0,2-3'
+    assert topo.all_pus == range(8)
+    assert topo.caches == [{'level': 3, 'size': 1048576, 'cores': '0-1'},
+                           {'level': 3, 'size': 1048576, 'cores': '2-3'}]
+
+    with pytest.raises(TopologyError):
+        topo.core_pus(4)
+
+def test_hwloc2():
+    topo = Topology.from_xml(HWLOC2_XML)
+    assert topo.num_cores == 4
+    assert [topo.core_numa(c) for c in range(4)] == [0, 0, 1, 1]
+    assert topo.numa_nodes == [0, 1]
+    assert topo.caches == [{'level': 2, 'size': 524288, 'cores': '0-1'}]
+
+def test_invalid_xml():
+    with pytest.raises(TopologyError):
+        Topology.from_xml('<topology>')
+    with pytest.raises(TopologyError):
+        Topology.from_xml('<topology></topology>')
+
+def test_save_load(tmpdir):
+    path = str(tmpdir.join('topology'))
+    assert Topology.load(path, owner=os.getuid()) is None
+
+    topo = Topology.from_xml(HWLOC1_XML)
+    topo.save(path)
+    loaded = Topology.load(path, owner=os.getuid())
+    assert loaded.core_pus(2) == [2, 6]
+    assert loaded.core_numa(2) == 1
+    assert loaded.caches == topo.caches
+
+    # Files which could have been tampered with are ignored
+    os.chmod(path, 0o666)
+    assert Topology.load(path, owner=os.getuid()) is None
+    os.chmod(path, 0o644)
+    assert Topology.load(path, owner=os.getuid() + 1) is None
+
+def test_process_coreset():
+    topo = Topology([{'pus': [pu]} for pu in range(1024)])
+    assert len(topo.process_coreset()) > 0
@@ -0,0 +1,50 @@
+import os
+import stat
+import socket
+import pytest
+
+from pcocc.Vsock import guest_cid, create_token, vsock_target, parse_target
+from pcocc.Vsock import vsock_opener, is_vsock_target, VSOCK_CID_BASE
+from pcocc.Relay import local_connect, target_opener
+
+def test_guest_cid():
+    cids = set(guest_cid(batchid, rank)
+               for batchid in [1, 2, 65535, 123456]
+               for rank in range(64))
+    assert len(cids) == 4 * 64
+    assert min(cids) >= VSOCK_CID_BASE
+    assert max(cids) < 2**32 - 1
+
+def test_target():
+    target = vsock_target(42, 5000, '/tmp/.pcocc_1_vm_0/vsock_token')
+    assert is_vsock_target(target)
+    assert not is_vsock_target('/tmp/.pcocc_1_vm_0/monitor_socket')
+    assert parse_target(target) == (42, 5000,
+                                    '/tmp/.pcocc_1_vm_0/vsock_token')
+
+def test_token(tmpdir):
+    path = str(tmpdir.join('vsock_token'))
+    token = create_token(path)
+    assert open(path).read() == token
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    with pytest.raises(OSError):
+        create_token(path)
+
+def test_missing_token(tmpdir):
+    target = vsock_target(42, 5000, str(tmpdir.join('missing')))
+    with pytest.raises(socket.error):
+        vsock_opener(target)
+
+    # Unreachable targets behave as sockets which couldn't be opened
+    chan = local_connect(target)
+    assert chan.poll() > 0
+
+def test_unix_target(tmpdir):
+    path = str(tmpdir.join('sock'))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    sock = target_opener(path)
+    conn, _ = server.accept()
+    sock.sendall('ping')
+    assert conn.recv(4) == 'ping'